@@ -0,0 +1,147 @@
+"""
+NovelAI 账号池：NAI_USERNAME / NAI_PASSWORD 为第一个账号，NAI_USERNAME_2 / NAI_PASSWORD_2、
+NAI_USERNAME_3 / NAI_PASSWORD_3 …… 依次为更多账号
+
+NovelAI 同一账号同时只能生成一张图，所以每个账号同一时间只分给一个上游请求。
+取消请求只会断开连接，上游可能还在生成，这时账号在 locked_until 之前尽量不再使用。
+每个账号的订阅等级和 Anlas 余额见 anlas.py；分配账号时优先选免费或费用最低的，余额不足的不分配。
+"""
+
+import asyncio
+import time
+from os import environ as env
+from typing import Any, Dict, List, Optional
+
+from fastapi import HTTPException
+
+from envfile import load_dotenv
+
+
+# Opus 订阅等级：步数和分辨率不超过限制的生成免费
+OPUS = 3
+
+
+class Account:
+    __slots__ = ("name", "username", "password", "busy", "locked_until", "generations",
+                 "tier", "anlas", "balance", "balance_at", "spent", "spent_since_refresh", "paid", "free")
+
+    def __init__(self, name: str, username: str, password: str):
+        self.name = name
+        self.username = username
+        self.password = password
+        self.busy = False
+        self.locked_until = 0.0
+        self.generations = 0
+        # 订阅等级和 Anlas 余额，从上游读取之前为 None（视为付得起）；anlas 是扣除本地估算费用后的余额
+        self.tier: Optional[int] = None
+        self.anlas: Optional[int] = None
+        self.balance: Optional[int] = None
+        self.balance_at: Optional[float] = None
+        self.spent = 0
+        self.spent_since_refresh = 0
+        self.paid = 0
+        self.free = 0
+
+    @property
+    def available(self) -> bool:
+        return not self.busy and time.time() >= self.locked_until
+
+    def cost(self, cost) -> int:
+        """这个账号生成一个任务的费用（cost 为 anlas.Cost）"""
+        return cost.opus if self.tier == OPUS else cost.standard
+
+    def can_afford(self, cost) -> bool:
+        return cost is None or self.anlas is None or self.anlas >= self.cost(cost)
+
+    def spend(self, amount: int):
+        self.spent += amount
+        self.spent_since_refresh += amount
+        if amount:
+            self.paid += 1
+        else:
+            self.free += 1
+        if self.anlas is not None:
+            self.anlas = max(0, self.anlas - amount)
+
+    def update_balance(self, tier: int, balance: int):
+        self.tier = tier
+        self.balance = self.anlas = balance
+        self.balance_at = time.time()
+        self.spent_since_refresh = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"name": self.name, "busy": self.busy, "available": self.available, "generations": self.generations}
+
+
+class AccountPool:
+    def __init__(self, accounts: List[Account]):
+        self.accounts = accounts
+        self._released: Optional[asyncio.Event] = None
+
+    @classmethod
+    def from_env(cls) -> "AccountPool":
+        load_dotenv()
+        accounts = []
+        if "NAI_USERNAME" in env and "NAI_PASSWORD" in env:
+            accounts.append(Account("1", env["NAI_USERNAME"], env["NAI_PASSWORD"]))
+        n = 2
+        while f"NAI_USERNAME_{n}" in env and f"NAI_PASSWORD_{n}" in env:
+            accounts.append(Account(str(n), env[f"NAI_USERNAME_{n}"], env[f"NAI_PASSWORD_{n}"]))
+            n += 1
+        return cls(accounts)
+
+    def __len__(self) -> int:
+        return len(self.accounts)
+
+    def _take(self, account: Account) -> Account:
+        account.busy = True
+        account.generations += 1
+        return account
+
+    def _cheapest(self, accounts: List[Account], cost) -> Optional[Account]:
+        """付得起的账号中费用最低的（能免费生成的优先），费用相同时按配置顺序"""
+        candidates = [a for a in accounts if a.can_afford(cost)]
+        if not candidates:
+            return None
+        if cost is None:
+            return candidates[0]
+        return min(candidates, key=lambda a: a.cost(cost))
+
+    def affordable(self, cost) -> bool:
+        """是否有账号付得起（没有配置账号或余额未知时视为付得起）"""
+        return not self.accounts or any(a.can_afford(cost) for a in self.accounts)
+
+    def try_acquire(self, cost=None) -> Optional[Account]:
+        """取一个可用且付得起的账号，没有时返回 None"""
+        account = self._cheapest([a for a in self.accounts if a.available], cost)
+        return self._take(account) if account is not None else None
+
+    async def acquire(self, cost=None) -> Optional[Account]:
+        """等待一个空闲且付得起的账号；没有配置账号时返回 None（由 API 自己报告缺少凭据）"""
+        if not self.accounts:
+            return None
+        while True:
+            if not self.affordable(cost):
+                raise HTTPException(status_code=402, detail="No account has enough Anlas for this job")
+            account = self.try_acquire(cost)
+            if account is not None:
+                return account
+            # 空闲的账号都可能还被上游占用时，用最早解除的那个，不让队列一直等
+            idle = [a for a in self.accounts if not a.busy and a.can_afford(cost)]
+            if idle:
+                return self._take(min(idle, key=lambda a: a.locked_until))
+            if self._released is None:
+                self._released = asyncio.Event()
+            self._released.clear()
+            await self._released.wait()
+
+    def release(self, account: Optional[Account], locked_until: float = 0.0):
+        if account is None:
+            return
+        account.busy = False
+        account.locked_until = locked_until
+        if self._released is not None:
+            self._released.set()
+
+    def status(self) -> List[Dict[str, Any]]:
+        return [a.to_dict() for a in self.accounts]
@@ -0,0 +1,150 @@
+"""
+Anlas 计费：用本地的计费模型估算每个任务的费用，跟踪每个账号的余额和花费
+
+NovelAI 生成图像消耗账号的 Anlas，费用取决于步数、分辨率和订阅等级（Opus 在 28 步以内、
+不超过 1024x1024 的生成免费）。以前只有在排完队、请求上游失败之后才知道账号余额不足，现在：
+
+- 提交时用 novelai_api 的 ImagePreset.calculate_cost 估算费用（Opus 和其他等级各一个），
+  没有任何账号付得起时直接返回 402，不进入队列
+- 分配账号时优先选能免费生成的，其次选费用最低的，余额不足的账号不分配（见 accounts.py）
+- 生成成功后从本地余额中扣除估算的费用；后台任务每 BALANCE_REFRESH_INTERVAL 秒（默认 300）
+  从 /user/subscription 读取订阅等级和实际余额（fixedTrainingStepsLeft + purchasedTrainingSteps）校正
+- 上游返回 402（余额不足）时把该账号的余额记为 0，并立即刷新
+
+放大不经过 ImagePreset，按网页端的计费表估算。
+"""
+
+import asyncio
+import os
+import sys
+from functools import lru_cache
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from accounts import OPUS
+from jobs import IMG2IMG, INPAINT, UPSCALE
+
+# 放大的费用：(像素数上限, Anlas)；Opus 在第一档以内免费
+UPSCALE_COSTS = ((640 * 640, 1), (512 * 1024, 2), (768 * 1024, 3), (1024 * 1024, 5))
+
+
+class Cost(NamedTuple):
+    """一个任务的费用：Opus 账号和其他账号各一个"""
+    opus: int
+    standard: int
+
+
+def model_version(model: str) -> int:
+    """calculate_cost 的模型版本：v1、v2 和 v3 及以后（v4、v4.5 与 v3 计费方式相同）"""
+    if model.endswith("_v2"):
+        return 2
+    if "_v3" in model or "_v4" in model:
+        return 3
+    return 1
+
+
+def cost_model_loaded() -> bool:
+    return "novelai_api.ImagePreset" in sys.modules
+
+
+def load_cost_model():
+    """导入 novelai_api 需要近 2 秒，在线程中调用"""
+    import novelai_api.ImagePreset  # noqa: F401
+
+
+def upscale_cost(width: int, height: int) -> Cost:
+    pixels = width * height
+    for limit, anlas in UPSCALE_COSTS:
+        if pixels <= limit:
+            break
+    return Cost(0 if pixels <= UPSCALE_COSTS[0][0] else anlas, anlas)
+
+
+@lru_cache(maxsize=1024)
+def generation_cost(kind: str, model: str, steps: int, resolution, strength: float) -> Cost:
+    """按 ImagePreset 的默认设置和任务的步数、分辨率估算费用；参数组合不多，结果缓存"""
+    from novelai_api.ImagePreset import ImageGenerationType, ImageModel, ImagePreset
+
+    preset = ImagePreset.from_default_config(ImageModel[model])
+    preset.steps = steps
+    preset.resolution = resolution
+    action = ImageGenerationType.NORMAL
+    if kind in (IMG2IMG, INPAINT):
+        preset.strength = strength
+        action = ImageGenerationType.IMG2IMG if kind == IMG2IMG else ImageGenerationType.INPAINTING
+    version = model_version(model)
+    return Cost(preset.calculate_cost(True, version, action), preset.calculate_cost(False, version, action))
+
+
+def estimate(job, image_size: Optional[Tuple[int, int]] = None) -> Cost:
+    """估算任务的费用；img2img、局部重绘和放大按输入图像的尺寸（image_size）计算"""
+    if job.kind == UPSCALE:
+        return upscale_cost(*image_size)
+    resolution = image_size if job.kind in (IMG2IMG, INPAINT) else job.resolution
+    strength = job.inputs["strength"] if job.kind in (IMG2IMG, INPAINT) else 1.0
+    return generation_cost(job.kind, job.model, job.steps, resolution, strength)
+
+
+class Ledger:
+    """各账号的余额刷新和花费统计"""
+
+    def __init__(self, sessions, interval: float = 300):
+        self.sessions = sessions
+        self.interval = interval
+
+    @classmethod
+    def from_env(cls, sessions) -> "Ledger":
+        return cls(sessions, float(os.environ.get("BALANCE_REFRESH_INTERVAL", 300)))
+
+    async def refresh(self, account):
+        """从上游读取订阅等级和实际余额；不占用账号的生成名额"""
+        try:
+            api = await self.sessions.get(account)
+            subscription = await api.low_level.get_subscription()
+            steps = subscription["trainingStepsLeft"]
+            estimated = account.anlas
+            account.update_balance(int(subscription["tier"]),
+                                   int(steps["fixedTrainingStepsLeft"]) + int(steps["purchasedTrainingSteps"]))
+            if estimated is not None and estimated != account.anlas:
+                print(f"Account {account.name}: estimated balance {estimated} Anlas, actual {account.anlas}")
+        except Exception as e:
+            print(f"Failed to refresh balance of account {account.name}: {e}")
+
+    async def run(self, accounts: List):
+        """后台任务：启动时和之后每隔 interval 秒刷新所有账号的余额"""
+        while True:
+            await asyncio.gather(*(self.refresh(account) for account in accounts))
+            await asyncio.sleep(self.interval)
+
+    def charge(self, account, cost: Optional[Cost]) -> int:
+        """生成成功后扣除费用，返回扣除的 Anlas"""
+        if account is None or cost is None:
+            return 0
+        amount = account.cost(cost)
+        account.spend(amount)
+        return amount
+
+    def note_error(self, account, error: BaseException):
+        """上游返回 402 时账号余额已不足，在刷新之前不再分配"""
+        if account is not None and getattr(error, "status", None) == 402:
+            account.anlas = 0
+            asyncio.get_running_loop().create_task(self.refresh(account))
+
+    def status(self, accounts: List) -> Dict[str, Any]:
+        per_account = [{
+            "account": account.name,
+            "tier": account.tier,
+            "opus": account.tier == OPUS,
+            # 上次刷新时的实际余额，以及扣除之后本地估算的花费后的余额
+            "balance": account.balance,
+            "balance_at": account.balance_at,
+            "estimated_balance": account.anlas,
+            "spent": account.spent,
+            "spent_since_refresh": account.spent_since_refresh,
+            "paid_generations": account.paid,
+            "free_generations": account.free,
+        } for account in accounts]
+        return {
+            "refresh_interval": self.interval,
+            "total_spent": sum(account.spent for account in accounts),
+            "accounts": per_account,
+        }
@@ -0,0 +1,228 @@
+"""
+API 密钥和按客户端的限流：令牌桶限速、并发任务上限和每日图像配额
+
+密钥在 API_KEYS_FILE（默认 api_keys.json）中配置；文件不存在时不做认证也不限流（与之前的行为相同）：
+
+    {
+      "defaults": {"rate_per_minute": 6, "burst": 3, "max_concurrent": 2, "daily_quota": 500},
+      "keys": [
+        {"name": "alice", "key": "<密钥>"},
+        {"name": "batch", "key_sha256": "<密钥的 SHA-256>", "max_concurrent": 4, "daily_quota": 0}
+      ]
+    }
+
+限制为 0 表示不限制。所有检查在入队前完成，每个客户端只做常数次运算。
+令牌和当日用量保存在内存中，由后台任务定期写入 results/client_usage.json，重启后继续计算。
+每日配额按 UTC 日期重置。
+"""
+
+import asyncio
+import hashlib
+import json
+import math
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from fastapi import HTTPException
+
+LIMIT_FIELDS = ("rate_per_minute", "burst", "max_concurrent", "daily_quota")
+DEFAULT_LIMITS = {"rate_per_minute": 6, "burst": 3, "max_concurrent": 2, "daily_quota": 500}
+
+
+def utc_day() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+def seconds_until_utc_midnight() -> int:
+    now = datetime.now(timezone.utc)
+    midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return max(1, math.ceil((midnight - now).total_seconds()))
+
+
+class Client:
+    """一个 API 密钥的限制和当前用量"""
+
+    __slots__ = ("name", "rate_per_minute", "burst", "max_concurrent", "daily_quota",
+                 "tokens", "refilled_at", "active", "day", "used", "total")
+
+    def __init__(self, name: str, limits: Dict[str, Any]):
+        self.name = name
+        self.rate_per_minute = float(limits["rate_per_minute"])
+        self.burst = max(1, int(limits["burst"]))
+        self.max_concurrent = int(limits["max_concurrent"])
+        self.daily_quota = int(limits["daily_quota"])
+        self.tokens = float(self.burst)
+        self.refilled_at = time.monotonic()
+        self.active = 0
+        self.day = utc_day()
+        self.used = 0
+        self.total = 0
+
+    def _refill(self, now: float):
+        if self.rate_per_minute > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate_per_minute / 60)
+        self.refilled_at = now
+
+    def _roll_day(self):
+        today = utc_day()
+        if today != self.day:
+            self.day = today
+            self.used = 0
+
+    def _reject(self, detail: str, retry_after: int):
+        raise HTTPException(status_code=429, detail=detail,
+                            headers={**self.headers(), "Retry-After": str(max(1, retry_after))})
+
+    def admit(self, retry_after_hint: int):
+        """入队前检查并扣除一个令牌、一个并发名额和一张配额；不满足时抛出 429"""
+        now = time.monotonic()
+        self._refill(now)
+        self._roll_day()
+        if self.max_concurrent and self.active >= self.max_concurrent:
+            self._reject(f"Too many concurrent jobs (limit {self.max_concurrent})", retry_after_hint)
+        if self.daily_quota and self.used >= self.daily_quota:
+            self._reject(f"Daily image quota of {self.daily_quota} exhausted", seconds_until_utc_midnight())
+        if self.rate_per_minute > 0 and self.tokens < 1:
+            self._reject("Rate limit exceeded", math.ceil((1 - self.tokens) * 60 / self.rate_per_minute))
+        if self.rate_per_minute > 0:
+            self.tokens -= 1
+        self.active += 1
+        self.used += 1
+        self.total += 1
+
+    def release(self, succeeded: bool = True):
+        """任务结束时归还并发名额；没有生成出图像的任务不计入配额"""
+        self.active = max(0, self.active - 1)
+        if not succeeded:
+            self.used = max(0, self.used - 1)
+            self.total = max(0, self.total - 1)
+
+    def headers(self) -> Dict[str, str]:
+        """告诉客户端剩余的额度，按此控制提交速度"""
+        self._refill(time.monotonic())
+        self._roll_day()
+        headers = {"X-Client": self.name}
+        if self.rate_per_minute > 0:
+            headers["X-RateLimit-Limit"] = str(self.burst)
+            headers["X-RateLimit-Remaining"] = str(int(self.tokens))
+            # 令牌桶补满还需要的秒数
+            headers["X-RateLimit-Reset"] = str(math.ceil((self.burst - self.tokens) * 60 / self.rate_per_minute))
+        if self.max_concurrent:
+            headers["X-Concurrency-Limit"] = str(self.max_concurrent)
+            headers["X-Concurrency-Remaining"] = str(max(0, self.max_concurrent - self.active))
+        if self.daily_quota:
+            headers["X-Quota-Limit"] = str(self.daily_quota)
+            headers["X-Quota-Remaining"] = str(max(0, self.daily_quota - self.used))
+            headers["X-Quota-Reset"] = str(seconds_until_utc_midnight())
+        return headers
+
+    def usage(self) -> Dict[str, Any]:
+        return {"day": self.day, "used": self.used, "total": self.total, "tokens": self.tokens}
+
+    def restore(self, usage: Dict[str, Any]):
+        self.total = int(usage.get("total", 0))
+        if usage.get("day") == self.day:
+            self.used = int(usage.get("used", 0))
+        self.tokens = min(self.burst, float(usage.get("tokens", self.burst)))
+
+    def status(self) -> Dict[str, Any]:
+        self._refill(time.monotonic())
+        self._roll_day()
+        return {
+            "name": self.name,
+            **{field: getattr(self, field) for field in LIMIT_FIELDS},
+            "tokens": round(self.tokens, 2),
+            "active": self.active,
+            "used_today": self.used,
+            "total": self.total,
+        }
+
+
+class ClientRegistry:
+    def __init__(self, clients: Dict[str, Client], usage_path: Path, persist_interval: float = 30):
+        # 按密钥的 SHA-256 查找，配置文件里可以只保存哈希
+        self.clients = clients
+        self.usage_path = usage_path
+        self.persist_interval = persist_interval
+
+    @classmethod
+    def from_env(cls, usage_path: Path) -> "ClientRegistry":
+        path = Path(os.environ.get("API_KEYS_FILE", "api_keys.json"))
+        clients: Dict[str, Client] = {}
+        if path.exists():
+            config = json.loads(path.read_text(encoding="utf-8"))
+            defaults = {**DEFAULT_LIMITS, **config.get("defaults", {})}
+            for entry in config.get("keys", []):
+                digest = entry.get("key_sha256") or hashlib.sha256(entry["key"].encode("utf-8")).hexdigest()
+                limits = {field: entry.get(field, defaults[field]) for field in LIMIT_FIELDS}
+                clients[digest.lower()] = Client(entry["name"], limits)
+        registry = cls(clients, usage_path, float(os.environ.get("CLIENT_USAGE_PERSIST_INTERVAL", 30)))
+        registry.load()
+        return registry
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.clients)
+
+    def authenticate(self, key: Optional[str]) -> Client:
+        client = self.clients.get(hashlib.sha256(key.encode("utf-8")).hexdigest()) if key else None
+        if client is None:
+            raise HTTPException(status_code=401, detail="Invalid or missing API key",
+                                headers={"WWW-Authenticate": "Bearer"})
+        return client
+
+    def load(self):
+        if not self.usage_path.exists():
+            return
+        try:
+            usage = json.loads(self.usage_path.read_text(encoding="utf-8"))
+        except ValueError:
+            return
+        for client in self.clients.values():
+            if client.name in usage:
+                client.restore(usage[client.name])
+
+    def save(self):
+        self.usage_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.usage_path.with_name(self.usage_path.name + ".tmp")
+        usage = {client.name: client.usage() for client in self.clients.values()}
+        tmp.write_text(json.dumps(usage, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, self.usage_path)
+
+    async def run(self):
+        """后台任务：定期保存用量"""
+        while True:
+            await asyncio.sleep(self.persist_interval)
+            try:
+                await asyncio.to_thread(self.save)
+            except Exception as e:
+                print(f"Failed to save client usage: {e}")
+
+    def status(self):
+        return [client.status() for client in self.clients.values()]
+
+
+class RateLimitHeaders:
+    """ASGI 中间件：把端点记录在 request.state.rate_limit 中的客户端额度写入响应头（包括错误响应）"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                client = scope.get("state", {}).get("rate_limit")
+                if client is not None:
+                    present = {name.lower() for name, _ in message.get("headers", [])}
+                    extra = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in client.headers().items()
+                             if k.lower().encode("latin-1") not in present]
+                    message = {**message, "headers": [*message.get("headers", []), *extra]}
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+内存基准 - 比较在内存中缓冲上游图像和流式写入磁盘时，并发生成的峰值内存
+
+    python bench_memory.py --size 1536 --jobs 4
+
+启动 mock_novelai.py（--noise，图像不可压缩，大小接近真实 PNG），
+每种模式在单独的子进程中用 --jobs 个账号并发生成，采样子进程 RSS 的峰值（仅限 Linux）：
+    buffered  novelai_api 原本的做法：整个 ZIP 读入内存、解压出 bytes，再复制一份作为响应
+    stream    upstream_stream：响应按块写入临时文件，解压到文件，响应直接从文件发送
+"""
+
+import argparse
+import asyncio
+import gc
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+
+PAGE_MB = os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+
+def rss_mb() -> float:
+    """当前 RSS（导入 novelai_api 时的峰值很高，ru_maxrss 会掩盖生成时的增长，所以采样当前值）"""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * PAGE_MB
+
+
+class PeakSampler(threading.Thread):
+    def __init__(self, interval: float = 0.002):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = rss_mb()
+        self._finished = threading.Event()
+
+    def run(self):
+        while not self._finished.wait(self.interval):
+            self.peak = max(self.peak, rss_mb())
+
+    def stop(self) -> float:
+        self._finished.set()
+        self.join()
+        return max(self.peak, rss_mb())
+
+
+async def generate(mode: str, index: int, directory: Path) -> int:
+    from boilerplate import API
+    from novelai_api.ImagePreset import ImageModel, ImagePreset
+    import upstream_stream
+
+    model = ImageModel.Anime_v45_Full
+    preset = ImagePreset.from_default_config(model)
+    preset.seed = index + 1
+    async with API(username=f"bench{index}@example.com", password="bench") as handler:
+        if mode == "stream":
+            upstream_stream.install(handler.api.low_level, directory)
+        async for _, img in handler.api.high_level.generate_image("bench", model, preset):
+            if mode == "stream":
+                size = img.stat().st_size
+                img.unlink()
+            else:
+                # 旧的同步端点把结果包进 BytesIO 返回
+                size = len(io.BytesIO(img).getvalue())
+            return size
+    return 0
+
+
+async def run_jobs(mode: str, jobs: int) -> int:
+    with tempfile.TemporaryDirectory() as tmp:
+        sizes = await asyncio.gather(*(generate(mode, i, Path(tmp)) for i in range(jobs)))
+    return sizes[0]
+
+
+def child(mode: str, jobs: int):
+    # 先完成导入和一次预热，基线不包括模块本身占用的内存
+    import boilerplate  # noqa: F401
+    import novelai_api.ImagePreset  # noqa: F401
+
+    # 预热用流式模式，不让缓冲的那份图像进入基线
+    asyncio.run(run_jobs("stream", 1))
+    gc.collect()
+    baseline = rss_mb()
+    sampler = PeakSampler()
+    sampler.start()
+    start = time.perf_counter()
+    size = asyncio.run(run_jobs(mode, jobs))
+    elapsed = time.perf_counter() - start
+    print(f"{baseline:.1f} {sampler.stop():.1f} {size} {elapsed:.2f}")
+
+
+def measure(mode: str, jobs: int, env: dict) -> tuple:
+    out = subprocess.run([sys.executable, __file__, "--child", mode, "--jobs", str(jobs)],
+                         env=env, capture_output=True, text=True, check=True).stdout.split()
+    return float(out[0]), float(out[1]), int(out[2]), float(out[3])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="上游图像缓冲与流式写入的峰值内存对比")
+    parser.add_argument("--size", type=int, default=1536, help="图像边长（像素）")
+    parser.add_argument("--jobs", type=int, default=4, help="并发生成数（每个使用单独的账号）")
+    parser.add_argument("--port", type=int, default=8011)
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.jobs)
+        return
+
+    mock = subprocess.Popen(
+        [sys.executable, str(Path(__file__).with_name("mock_novelai.py")), "--port", str(args.port),
+         "--latency", "0.5", "--jitter", "0", "--size", str(args.size), "--noise"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    env = {**os.environ, "NAI_BASE_URL": f"http://127.0.0.1:{args.port}"}
+    try:
+        time.sleep(1.5)
+        print(f"{args.jobs} 个并发生成，{args.size}x{args.size} 噪点图像")
+        results = {}
+        for mode in ("buffered", "stream"):
+            baseline, peak, size, elapsed = measure(mode, args.jobs, env)
+            results[mode] = peak - baseline
+            print(f"  {mode:9s} 图像 {size / 1e6:.1f}MB  基线 {baseline:6.1f}MB  峰值 {peak:6.1f}MB  "
+                  f"增加 {peak - baseline:6.1f}MB（每个任务 {(peak - baseline) / args.jobs:5.1f}MB）  用时 {elapsed:.2f}秒")
+        saved = results["buffered"] - results["stream"]
+        print(f"  流式写入少用 {saved:.1f}MB 峰值内存")
+    finally:
+        mock.terminate()
+        mock.wait()
+
+
+if __name__ == "__main__":
+    main()
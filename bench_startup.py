@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+启动耗时基准 - 测量从启动进程到 /health 返回 200、以及上游客户端加载完成所需的时间
+
+    python bench_startup.py --runs 5
+    python bench_startup.py --runs 5 --dev   # 同时测量开发模式（reload）
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+
+def probe(url: str):
+    try:
+        with urllib.request.urlopen(url, timeout=0.5) as resp:
+            return json.loads(resp.read())
+    except (urllib.error.URLError, ConnectionError, TimeoutError):
+        return None
+
+
+def measure(port: int, extra_args, timeout: float = 60.0):
+    """返回 (首次健康检查成功耗时, 上游客户端加载完成耗时)"""
+    here = Path(__file__).resolve().parent
+    env = dict(os.environ, SERVER_MODE="")
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, str(here / "start_server.py"), "--port", str(port), *extra_args],
+                            cwd=here, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    first_ok = loaded = None
+    try:
+        while time.perf_counter() - start < timeout:
+            body = probe(f"http://127.0.0.1:{port}/health")
+            if body is not None:
+                if first_ok is None:
+                    first_ok = time.perf_counter() - start
+                if body.get("upstream_client_loaded"):
+                    loaded = time.perf_counter() - start
+                    break
+            time.sleep(0.01)
+    finally:
+        proc.terminate()
+        proc.wait()
+    return first_ok, loaded
+
+
+def summarize(name: str, samples):
+    healthy = [s[0] for s in samples if s[0] is not None]
+    loaded = [s[1] for s in samples if s[1] is not None]
+    print(f"{name}:")
+    if healthy:
+        print(f"  首次健康检查: 中位数 {statistics.median(healthy) * 1000:.0f}ms, 最快 {min(healthy) * 1000:.0f}ms")
+    if loaded:
+        print(f"  上游客户端就绪: 中位数 {statistics.median(loaded) * 1000:.0f}ms, 最快 {min(loaded) * 1000:.0f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="服务器启动耗时基准")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8200)
+    parser.add_argument("--dev", action="store_true", help="同时测量开发模式")
+    args = parser.parse_args()
+
+    modes = [("生产模式", ["--prod"])]
+    if args.dev:
+        modes.append(("开发模式", []))
+
+    for name, extra in modes:
+        samples = [measure(args.port, extra) for _ in range(args.runs)]
+        summarize(name, samples)
+
+
+if __name__ == "__main__":
+    main()
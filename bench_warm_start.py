@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+热启动基准 - 在保存了大量结果时，比较重启后打开结果缓存的耗时和第一次命中的延迟
+
+    python bench_warm_start.py --results 100000
+
+依次测量：
+    1. 扫描目录（旧做法）
+    2. 第一次打开索引（从已有文件迁移）
+    3. 重启后打开索引（记录都在追加日志中）
+    4. 合并后重启打开索引（mmap 排序段）
+    5. 第一次命中：打开后查找一个键并读出图像
+"""
+
+import argparse
+import asyncio
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from result_cache import ResultCache, cache_key
+from result_index import ResultIndex
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def populate(directory: Path, count: int) -> list:
+    directory.mkdir(parents=True, exist_ok=True)
+    payload = b"\x89PNG\r\n\x1a\n" + bytes(256)
+    keys = []
+    for i in range(count):
+        key = cache_key({"prompt": f"bench {i}", "seed": i + 1})
+        (directory / f"{key}.png").write_bytes(payload)
+        keys.append(key)
+    return keys
+
+
+async def first_hit(directory: Path, key: str) -> float:
+    cache = ResultCache(directory)
+    start = time.perf_counter()
+    data = await cache.get(key)
+    elapsed = time.perf_counter() - start
+    cache.close()
+    assert data is not None
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="结果缓存热启动基准")
+    parser.add_argument("--results", type=int, default=100000)
+    parser.add_argument("--hits", type=int, default=20, help="第一次命中的测量次数")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp) / "cache"
+        print(f"生成 {args.results} 个结果文件...")
+        elapsed, keys = timed(lambda: populate(directory, args.results))
+        print(f"  用时 {elapsed:.1f}秒\n")
+
+        elapsed, found = timed(lambda: {p.stem for p in directory.glob("*.png")})
+        print(f"1. 扫描目录:               {elapsed * 1000:8.1f}ms ({len(found)} 个)")
+
+        index = ResultIndex(directory)
+        elapsed, _ = timed(index.open)
+        print(f"2. 首次打开索引（迁移）:   {elapsed * 1000:8.1f}ms")
+        index.close()
+
+        index = ResultIndex(directory)
+        elapsed, _ = timed(index.open)
+        print(f"3. 打开索引（追加日志）:   {elapsed * 1000:8.1f}ms ({index.tail_size} 条日志记录)")
+        compact_time, _ = timed(index.compact)
+        index.close()
+
+        index = ResultIndex(directory)
+        elapsed, _ = timed(index.open)
+        print(f"4. 打开索引（合并后）:     {elapsed * 1000:8.1f}ms ({len(index)} 条记录，合并用时 {compact_time * 1000:.0f}ms)")
+        index.close()
+
+        samples = [asyncio.run(first_hit(directory, random.choice(keys))) for _ in range(args.hits)]
+        print(f"5. 第一次命中（含打开）:   {statistics.median(samples) * 1000:8.2f}ms (中位数，{args.hits} 次)")
+
+
+if __name__ == "__main__":
+    main()
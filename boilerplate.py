@@ -2,17 +2,47 @@ import json
 from datetime import datetime
 from logging import Logger, StreamHandler
 from os import environ as env
-from pathlib import Path
 from typing import Any, Optional
 
 from aiohttp import ClientSession
 from msgpackr.constants import UNDEFINED
-from aiohttp import ClientSession, ClientTimeout
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
 
-# 你可以在这里改代理地址
 from novelai_api import NovelAIAPI
 from novelai_api.utils import get_encryption_key
-PROXY_URL = "http://127.0.0.1:7897"  # 或 socks5://127.0.0.1:1080
+
+import tracing
+# 代理地址通过 PROXY_URLS 配置（见 proxy_pool.py），可以填多个，包括 direct 直连
+from envfile import load_dotenv
+from proxy_pool import get_pool
+NOVELAI_HOSTS = ("https://api.novelai.net", "https://image.novelai.net", "https://text.novelai.net")
+UPSTREAM_TIMEOUT = 60
+
+
+def create_session(keepalive_timeout: Optional[float] = None) -> ClientSession:
+    """创建发往 NovelAI 的会话；keepalive_timeout 为连接池中空闲连接保留的秒数（None 为 aiohttp 默认的 15 秒）"""
+    # 设置了 NAI_BASE_URL 时（例如 mock_novelai.py），所有 NovelAI 请求改发到该地址且不走代理
+    base_url = env.get("NAI_BASE_URL")
+
+    # 注意：ClientSession 不支持全局 proxy 参数，我们用封装方式解决
+    class ProxyClientSession(ClientSession):
+        async def _request(self_inner, method, url, **kwargs):
+            if base_url:
+                url = str(url)
+                for host in NOVELAI_HOSTS:
+                    if url.startswith(host):
+                        url = base_url.rstrip("/") + url[len(host):]
+                        break
+                return await super()._request(method, url, **kwargs)
+            # 由代理池选择出口，连接失败时自动换下一个
+            return await get_pool().request(super()._request, method, url, **kwargs)
+
+    connector = None
+    if keepalive_timeout is not None:
+        # 长期复用的会话：空闲连接和 DNS 解析结果保留得更久，由保温任务定期使用
+        connector = TCPConnector(keepalive_timeout=keepalive_timeout, ttl_dns_cache=max(10, int(keepalive_timeout)))
+    return ProxyClientSession(timeout=ClientTimeout(total=UPSTREAM_TIMEOUT), connector=connector)
+
 
 class API:
     """
@@ -42,20 +72,20 @@ class API:
     logger: Logger
     api: Optional[NovelAIAPI]
 
-    def __init__(self, base_address: Optional[str] = None):
-        dotenv = Path(".env")
-        if dotenv.exists():
-            with dotenv.open("r") as f:
-                for line in f:
-                    if "=" in line:
-                        key, value = line.strip().split("=", 1)
-                        env[key] = value.strip()
+    def __init__(self, base_address: Optional[str] = None, username: Optional[str] = None,
+                 password: Optional[str] = None, keepalive_timeout: Optional[float] = None):
+        load_dotenv()
 
-        if "NAI_USERNAME" not in env or "NAI_PASSWORD" not in env:
-            raise RuntimeError("Please ensure that NAI_USERNAME and NAI_PASSWORD are set in your environment")
+        # 未指定账号时使用 NAI_USERNAME / NAI_PASSWORD（多账号见 accounts.py）
+        if username is None or password is None:
+            if "NAI_USERNAME" not in env or "NAI_PASSWORD" not in env:
+                raise RuntimeError("Please ensure that NAI_USERNAME and NAI_PASSWORD are set in your environment")
+            username, password = env["NAI_USERNAME"], env["NAI_PASSWORD"]
 
-        self._username = env["NAI_USERNAME"]
-        self._password = env["NAI_PASSWORD"]
+        self._username = username
+        self._password = password
+        self._keepalive_timeout = keepalive_timeout
+        self.access_token: Optional[str] = None
 
         self.logger = Logger("NovelAI")
         self.logger.addHandler(StreamHandler())
@@ -68,18 +98,27 @@ class API:
     def encryption_key(self):
         return get_encryption_key(self._username, self._password)
 
-    async def __aenter__(self):
-        # 注意：ClientSession 不支持全局 proxy 参数，我们用封装方式解决
-        class ProxyClientSession(ClientSession):
-            async def _request(self_inner, method, url, **kwargs):
-                kwargs.setdefault("proxy", PROXY_URL)
-                return await super()._request(method, url, **kwargs)
+    @property
+    def session(self) -> ClientSession:
+        return self._session
 
-        self._session = ProxyClientSession(timeout=ClientTimeout(total=60))
+    async def login(self) -> str:
+        """登录（或令牌快过期时重新登录），返回访问令牌"""
+        with tracing.span("api.login"):
+            self.access_token = await self.api.high_level.login(self._username, self._password)
+        return self.access_token
+
+    async def __aenter__(self):
+        self._session = create_session(self._keepalive_timeout)
         await self._session.__aenter__()
 
         self.api.attach_session(self._session)
-        await self.api.high_level.login(self._username, self._password)
+        try:
+            await self.login()
+        except BaseException as e:
+            # 登录失败时 __aexit__ 不会被调用，需要在这里关闭会话
+            await self._session.__aexit__(type(e), e, e.__traceback__)
+            raise
 
         return self
 
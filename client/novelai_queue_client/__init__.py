@@ -0,0 +1,16 @@
+"""
+novelai-local-api 队列服务的客户端
+
+    from novelai_queue_client import QueueClient
+
+    with QueueClient("http://localhost:8000") as client:
+        client.generate("1girl, masterpiece", path="out.png", seed=1000)
+
+asyncio 版本为 AsyncQueueClient，接口相同，方法都是协程。
+"""
+
+from novelai_queue_client._common import GenerationFailed, QueueError
+from novelai_queue_client.async_client import AsyncQueueClient
+from novelai_queue_client.client import QueueClient
+
+__all__ = ["AsyncQueueClient", "GenerationFailed", "QueueClient", "QueueError"]
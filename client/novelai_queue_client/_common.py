@@ -0,0 +1,122 @@
+"""
+同步和 asyncio 客户端共用的部分：错误类型、退避时间、SSE 解析
+"""
+
+import json
+import random
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+import httpx
+
+DEFAULT_BASE_URL = "http://localhost:8000"
+
+# 队列已满（423）或服务器排空、上游不可用（503）时按 Retry-After 重试
+RETRY_STATUSES = (423, 503)
+# 超过限速（429）时只在等待时间不长时重试；每日配额用完要等到 UTC 零点，直接抛出
+RATE_LIMIT_MAX_WAIT = 300
+FINISHED = ("completed", "failed")
+
+
+class QueueError(Exception):
+    """服务器返回的错误"""
+
+    def __init__(self, status_code: int, detail: Any):
+        super().__init__(f"HTTP {status_code}: {detail}")
+        self.status_code = status_code
+        self.detail = detail
+
+
+class GenerationFailed(QueueError):
+    """任务在服务器上失败"""
+
+
+def generation_params(prompt: str, params: Dict[str, Any]) -> Dict[str, Any]:
+    return {"prompt": prompt, **{k: v for k, v in params.items() if v is not None}}
+
+
+def idempotency_header(key: Optional[str]) -> Dict[str, str]:
+    """提交时总是带上幂等键，退避重试的是同一个请求，服务器不会重复入队"""
+    return {"Idempotency-Key": key or uuid.uuid4().hex}
+
+
+def backoff_delay(attempt: int, cap: float = 60.0) -> float:
+    """指数退避，加少量随机抖动，避免多个客户端同时重试"""
+    delay = min(cap, 2 ** attempt)
+    return delay + random.uniform(0, delay * 0.1)
+
+
+def should_retry(response: httpx.Response) -> bool:
+    if response.status_code in RETRY_STATUSES:
+        return True
+    header = response.headers.get("Retry-After", "")
+    return response.status_code == 429 and header.isdigit() and int(header) <= RATE_LIMIT_MAX_WAIT
+
+
+def client_headers(api_key: Optional[str], headers: Optional[Dict[str, str]]) -> Dict[str, str]:
+    return {**({"X-API-Key": api_key} if api_key else {}), **(headers or {})}
+
+
+def retry_delay(response: httpx.Response, attempt: int, cap: float = 60.0) -> float:
+    """优先使用 Retry-After，没有时指数退避；加少量随机抖动，避免多个客户端同时重试"""
+    header = response.headers.get("Retry-After", "")
+    if not header.isdigit():
+        return backoff_delay(attempt, cap)
+    delay = float(header)
+    return delay + random.uniform(0, delay * 0.1)
+
+
+def error_detail(response: httpx.Response) -> Any:
+    try:
+        return response.json().get("detail", response.text)
+    except ValueError:
+        return response.text
+
+
+def raise_for_status(response: httpx.Response):
+    if response.status_code >= 400:
+        raise QueueError(response.status_code, error_detail(response))
+
+
+def sse_unsupported(response: httpx.Response) -> bool:
+    """服务器没有 /events 路由（旧版本）时返回 FastAPI 默认的 404"""
+    return response.status_code == 404 and error_detail(response) == "Not Found"
+
+
+def finished_status(status: Dict[str, Any]) -> Dict[str, Any]:
+    """任务失败时抛出 GenerationFailed，否则原样返回"""
+    if status["status"] == "failed":
+        raise GenerationFailed(500, status.get("error") or "Generation failed")
+    return status
+
+
+class SSEParser:
+    """逐行解析 text/event-stream，一个事件结束（空行）时返回 (event, data)"""
+
+    def __init__(self):
+        self.event = "message"
+        self.data = []
+
+    def feed(self, line: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        if not line:
+            if not self.data:
+                return None
+            event, data = self.event, json.loads("\n".join(self.data))
+            self.event, self.data = "message", []
+            return event, data
+        if line.startswith(":"):
+            return None
+        field, _, value = line.partition(":")
+        value = value[1:] if value.startswith(" ") else value
+        if field == "event":
+            self.event = value
+        elif field == "data":
+            self.data.append(value)
+        return None
+
+
+def temp_path(path: Path) -> Path:
+    """下载先写到同目录的临时文件，完成后改名，不会留下写了一半的图像"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.part")
@@ -0,0 +1,187 @@
+"""
+同步客户端：一个 httpx.Client 连接池（keep-alive），可在多个线程中共用
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
+
+import httpx
+
+from novelai_queue_client._common import (
+    DEFAULT_BASE_URL, FINISHED, SSEParser, client_headers, finished_status, generation_params,
+    backoff_delay, idempotency_header, raise_for_status, retry_delay, should_retry, sse_unsupported, temp_path,
+)
+
+
+class QueueClient:
+    def __init__(self, base_url: str = DEFAULT_BASE_URL, *, timeout: float = 120.0, max_connections: int = 10,
+                 max_retries: int = 20, poll_interval: float = 1.0, headers: Optional[Dict[str, str]] = None,
+                 api_key: Optional[str] = None):
+        self._http = httpx.Client(
+            base_url=base_url,
+            timeout=httpx.Timeout(timeout, connect=10.0),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            headers=client_headers(api_key, headers),
+        )
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self.poll_interval = poll_interval
+        # 服务器是否支持 /events（None 表示还没试过）
+        self._sse: Optional[bool] = None
+
+    def __enter__(self) -> "QueueClient":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._http.close()
+
+    def _request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """发送请求，423 / 503 和短时间的 429 按 Retry-After 退避重试，网络错误时指数退避重试"""
+        attempt = 0
+        while True:
+            try:
+                response = self._http.request(method, url, **kwargs)
+            except httpx.TransportError:
+                if attempt >= self.max_retries:
+                    raise
+                time.sleep(backoff_delay(attempt))
+                attempt += 1
+                continue
+            if not should_retry(response) or attempt >= self.max_retries:
+                raise_for_status(response)
+                return response
+            time.sleep(retry_delay(response, attempt))
+            attempt += 1
+
+    def _stream_to(self, method: str, url: str, path: Path, **kwargs) -> httpx.Headers:
+        """把响应体流式写入文件，不在内存中保存整张图像"""
+        attempt = 0
+        while True:
+            try:
+                result = self._stream_once(method, url, path, attempt, **kwargs)
+            except httpx.TransportError:
+                if attempt >= self.max_retries:
+                    raise
+                result = backoff_delay(attempt)
+            if isinstance(result, httpx.Headers):
+                return result
+            time.sleep(result)
+            attempt += 1
+
+    def _stream_once(self, method: str, url: str, path: Path, attempt: int, **kwargs) -> Union[httpx.Headers, float]:
+        """发送一次请求：写入成功时返回响应头，需要退避重试时返回等待时间"""
+        with self._http.stream(method, url, **kwargs) as response:
+            if should_retry(response) and attempt < self.max_retries:
+                response.read()
+                return retry_delay(response, attempt)
+            if response.status_code >= 400:
+                response.read()
+                raise_for_status(response)
+            tmp = temp_path(path)
+            try:
+                with tmp.open("wb") as f:
+                    for chunk in response.iter_bytes():
+                        f.write(chunk)
+                tmp.replace(path)
+            finally:
+                tmp.unlink(missing_ok=True)
+            return response.headers
+
+    def generate(self, prompt: str, path: Union[str, Path, None] = None, idempotency_key: Optional[str] = None,
+                 **params) -> Union[bytes, Path]:
+        """同步生成：在服务器队列中等待结果。给出 path 时直接写入文件并返回路径，否则返回图像数据
+
+        每次调用带一个 Idempotency-Key（默认随机生成），重试不会在服务器上重复生成。
+        """
+        body = generation_params(prompt, params)
+        headers = idempotency_header(idempotency_key)
+        if path is None:
+            return self._request("POST", "/generate/img/priv", json=body, headers=headers).content
+        path = Path(path)
+        self._stream_to("POST", "/generate/img/priv", path, json=body, headers=headers)
+        return path
+
+    def submit(self, prompt: str, idempotency_key: Optional[str] = None, **params) -> Dict[str, Any]:
+        """异步提交，返回包含 request_id、seed 和 tokens 的响应；同一个 idempotency_key 重复提交返回同一个任务"""
+        return self._request("POST", "/generate/img/async", json=generation_params(prompt, params),
+                             headers=idempotency_header(idempotency_key)).json()
+
+    def status(self, request_id: str) -> Dict[str, Any]:
+        return self._request("GET", f"/status/{request_id}").json()
+
+    def statuses(self, request_ids: List[str]) -> Dict[str, Any]:
+        """批量查询状态（POST /status/bulk）"""
+        return self._request("POST", "/status/bulk", json={"request_ids": request_ids}).json()
+
+    def wait(self, request_id: str, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """等待任务完成：服务器支持时用 SSE 推送，否则轮询 /status。任务失败时抛出 GenerationFailed"""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        if self._sse is not False:
+            status = self._wait_sse(request_id, deadline)
+            if status is not None:
+                return finished_status(status)
+        return finished_status(self._wait_poll(request_id, deadline))
+
+    def _wait_sse(self, request_id: str, deadline: Optional[float]) -> Optional[Dict[str, Any]]:
+        parser = SSEParser()
+        # 服务器每 15 秒发送一次保活注释
+        with self._http.stream("GET", f"/events/{request_id}", timeout=httpx.Timeout(30.0, connect=10.0)) as response:
+            if response.status_code >= 400:
+                response.read()
+                if sse_unsupported(response):
+                    self._sse = False
+                    return None
+                raise_for_status(response)
+            self._sse = True
+            for line in response.iter_lines():
+                event = parser.feed(line)
+                if event is not None and event[1]["status"] in FINISHED:
+                    return event[1]
+                if deadline is not None and time.monotonic() > deadline:
+                    raise TimeoutError(f"Request {request_id} did not finish in time")
+        # 连接意外断开时退回轮询
+        return None
+
+    def _wait_poll(self, request_id: str, deadline: Optional[float]) -> Dict[str, Any]:
+        while True:
+            status = self.status(request_id)
+            if status["status"] in FINISHED:
+                return status
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"Request {request_id} did not finish in time")
+            time.sleep(self.poll_interval)
+
+    def download(self, request_id: str, path: Union[str, Path]) -> Path:
+        """把结果图像流式写入文件"""
+        path = Path(path)
+        self._stream_to("GET", f"/result/{request_id}", path)
+        return path
+
+    def run(self, prompt: str, path: Union[str, Path], timeout: Optional[float] = None, **params) -> Path:
+        """异步提交、等待完成并下载到 path"""
+        request_id = self.submit(prompt, **params)["request_id"]
+        self.wait(request_id, timeout)
+        return self.download(request_id, path)
+
+    def run_batch(self, jobs: List[Dict[str, Any]], directory: Union[str, Path],
+                  concurrency: Optional[int] = None) -> List[Union[Path, Exception]]:
+        """并发执行一批任务（每项为生成参数，必须包含 prompt），结果写入 directory/<序号>.png
+
+        返回与 jobs 顺序一致的列表，失败的任务对应位置是异常对象。
+        """
+        directory = Path(directory)
+
+        def run_one(index: int) -> Union[Path, Exception]:
+            params = dict(jobs[index])
+            try:
+                return self.run(params.pop("prompt"), directory / f"{index}.png", **params)
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=concurrency or self.max_connections) as pool:
+            return list(pool.map(run_one, range(len(jobs))))
@@ -0,0 +1,17 @@
+"""
+读取 .env 文件到环境变量
+"""
+
+from os import environ as env
+from pathlib import Path
+
+
+def load_dotenv(path: str = ".env"):
+    """把 .env 中的 KEY=VALUE 写入环境变量（覆盖已有的值）"""
+    dotenv = Path(path)
+    if dotenv.exists():
+        with dotenv.open("r") as f:
+            for line in f:
+                if "=" in line:
+                    key, value = line.strip().split("=", 1)
+                    env[key] = value.strip()
@@ -0,0 +1,26 @@
+"""
+快速 JSON 响应：安装了 orjson 时用它序列化，否则退回标准库 json（紧凑格式）
+
+直接返回 FastJSONResponse 会跳过 FastAPI 的 jsonable_encoder，内容必须已经是 JSON 基本类型。
+"""
+
+import json
+from typing import Any
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -0,0 +1,45 @@
+"""
+任务交接：排空的进程把未开始的异步任务写入 results/ 下的交接文件，后继进程认领后继续处理
+
+每个排空的进程写一个独立的文件（先写临时文件再改名，保证后继进程不会读到一半），
+后继进程通过改名认领文件，多个进程同时运行时每个文件只会被一个进程处理。
+"""
+
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+PENDING_PREFIX = "pending_jobs."
+
+
+def save_pending(directory: Path, records: List[Dict[str, Any]]) -> Path:
+    directory.mkdir(parents=True, exist_ok=True)
+    name = f"{PENDING_PREFIX}{os.getpid()}.{int(time.time() * 1000)}.jsonl"
+    path = directory / name
+    tmp = directory / f".{name}.tmp"
+    with tmp.open("w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return path
+
+
+def claim_pending(directory: Path) -> List[Dict[str, Any]]:
+    """认领并读取所有交接文件，按原提交时间排序"""
+    records = []
+    for path in directory.glob(f"{PENDING_PREFIX}*.jsonl"):
+        claimed = path.with_name(f".{path.name}.claimed.{os.getpid()}")
+        try:
+            os.replace(path, claimed)
+        except FileNotFoundError:
+            # 已被其他进程认领
+            continue
+        with claimed.open("r", encoding="utf-8") as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+        claimed.unlink()
+    records.sort(key=lambda r: r["timestamp"])
+    return records
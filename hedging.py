@@ -0,0 +1,116 @@
+"""
+对冲请求：生成耗时超过最近服务时间的某个分位数仍未完成时，用另一个空闲账号以相同参数（相同 seed）
+再发一次请求，先返回的结果生效，另一个被取消
+
+配置（环境变量）:
+    HEDGE_PERCENTILE    触发对冲的服务时间分位数，默认 95
+    HEDGE_MIN_SAMPLES   开始对冲前需要的最少服务时间样本数，默认 20
+    HEDGE_MAX_RATE      最近任务中允许对冲的最大比例，默认 0.1
+    HEDGE_WINDOW        统计服务时间和对冲比例的最近任务数，默认 200
+
+服务时间按任务类型（文生图、img2img、局部重绘、放大）分别统计，对冲延迟和 Retry-After 按各自的分布计算。
+
+对冲赢了时主请求被取消，不知道它本来还要多久，所以不对冲时的 p99 只能给出范围：
+下限按取消时已用的时间计，上限按主请求一直拖到上游超时（UPSTREAM_TIMEOUT）计。
+"""
+
+import asyncio
+import math
+import os
+from collections import defaultdict, deque
+from typing import Any, Dict, Iterable, List, Optional
+
+# 与 boilerplate.UPSTREAM_TIMEOUT 一致（这里不导入 boilerplate，避免提前加载 novelai_api）
+UPSTREAM_TIMEOUT = 60.0
+
+
+def percentile(values: Iterable[float], p: float) -> Optional[float]:
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+async def first_success(tasks: List[asyncio.Task]) -> asyncio.Task:
+    """返回最先成功完成的任务；全部失败时抛出第一个任务的异常"""
+    pending = set(tasks)
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() is None:
+                return task
+    raise tasks[0].exception()
+
+
+class Hedger:
+    """记录服务时间，决定何时对冲，并统计对冲的效果和额外开销"""
+
+    def __init__(self, percentile: float = 95, min_samples: int = 20, max_rate: float = 0.1, window: int = 200):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.max_rate = max_rate
+        self.service_times: Dict[str, deque] = defaultdict(lambda: deque(maxlen=window))
+        self.recent_hedged = deque(maxlen=window)
+        # 客户端看到的耗时，以及不对冲时耗时的下限和上限
+        self.latencies = deque(maxlen=window)
+        self.unhedged_min = deque(maxlen=window)
+        self.unhedged_max = deque(maxlen=window)
+        self.jobs = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    @classmethod
+    def from_env(cls) -> "Hedger":
+        return cls(
+            percentile=float(os.environ.get("HEDGE_PERCENTILE", 95)),
+            min_samples=int(os.environ.get("HEDGE_MIN_SAMPLES", 20)),
+            max_rate=float(os.environ.get("HEDGE_MAX_RATE", 0.1)),
+            window=int(os.environ.get("HEDGE_WINDOW", 200)),
+        )
+
+    def delay(self, kind: str = "txt2img") -> Optional[float]:
+        """这一类任务多久后发起对冲，样本不足时返回 None"""
+        samples = self.service_times.get(kind, ())
+        if len(samples) < self.min_samples:
+            return None
+        return percentile(samples, self.percentile)
+
+    def median(self, kind: str = "txt2img") -> Optional[float]:
+        return percentile(self.service_times.get(kind, ()), 50)
+
+    def allow(self) -> bool:
+        """对冲比例上限：算上这一次后，最近任务中对冲的比例不超过 max_rate"""
+        return (sum(self.recent_hedged) + 1) / (len(self.recent_hedged) + 1) <= self.max_rate
+
+    def observe(self, service_time: float, kind: str = "txt2img"):
+        self.service_times[kind].append(service_time)
+
+    def record(self, latency: float, hedged: bool, hedge_won: bool):
+        self.jobs += 1
+        self.hedged += hedged
+        self.hedge_wins += hedge_won
+        self.recent_hedged.append(hedged)
+        self.latencies.append(latency)
+        self.unhedged_min.append(latency)
+        self.unhedged_max.append(max(latency, UPSTREAM_TIMEOUT) if hedge_won else latency)
+
+    def status(self) -> Dict[str, Any]:
+        p99 = percentile(self.latencies, 99)
+        p99_unhedged = [percentile(self.unhedged_min, 99), percentile(self.unhedged_max, 99)]
+        return {
+            "delay": self.delay(),
+            "service_time": {
+                kind: {"samples": len(samples), "p50": percentile(samples, 50), "p95": percentile(samples, 95),
+                       "hedge_delay": self.delay(kind)}
+                for kind, samples in self.service_times.items()
+            },
+            "jobs": self.jobs,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            # 每次对冲都多发了一个上游生成请求
+            "extra_upstream_requests": self.hedged,
+            "extra_cost_ratio": self.hedged / self.jobs if self.jobs else 0.0,
+            "p99": p99,
+            "p99_unhedged": p99_unhedged,
+            "p99_saved": [v - p99 for v in p99_unhedged] if p99 is not None else None,
+        }
@@ -0,0 +1,197 @@
+"""
+生成历史：每个完成的任务记录在 results/history.db（SQLite）中，指向 results/ 下保存的图像文件
+
+按 id 倒序做 keyset 分页（``WHERE id < cursor``），配合 model / seed / created_at 索引和
+prompt 的 FTS5 全文索引，行数到百万级时每页查询仍然只读取需要的行。
+"""
+
+import asyncio
+import json
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS generations (
+    id INTEGER PRIMARY KEY,
+    request_id TEXT NOT NULL UNIQUE,
+    created_at REAL NOT NULL,
+    model TEXT NOT NULL,
+    seed INTEGER NOT NULL,
+    prompt TEXT NOT NULL,
+    negative_prompt TEXT NOT NULL,
+    guidance_scale REAL NOT NULL,
+    steps INTEGER NOT NULL,
+    resolution TEXT NOT NULL,
+    image_path TEXT NOT NULL,
+    kind TEXT NOT NULL DEFAULT 'txt2img',
+    metadata TEXT,
+    bytes_saved INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_generations_model ON generations (model, id);
+CREATE INDEX IF NOT EXISTS idx_generations_seed ON generations (seed, id);
+CREATE INDEX IF NOT EXISTS idx_generations_created_at ON generations (created_at);
+CREATE VIRTUAL TABLE IF NOT EXISTS generations_fts USING fts5(
+    prompt, content='generations', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS generations_ai AFTER INSERT ON generations BEGIN
+    INSERT INTO generations_fts (rowid, prompt) VALUES (new.id, new.prompt);
+END;
+CREATE TRIGGER IF NOT EXISTS generations_ad AFTER DELETE ON generations BEGIN
+    INSERT INTO generations_fts (generations_fts, rowid, prompt) VALUES ('delete', old.id, old.prompt);
+END;
+"""
+
+COLUMNS = ("id", "request_id", "created_at", "model", "seed", "prompt", "negative_prompt",
+           "guidance_scale", "steps", "resolution", "image_path", "kind", "metadata", "bytes_saved")
+# 旧版本的数据库缺少的列：已有的记录都是文生图，没有保存元数据
+ADDED_COLUMNS = {
+    "kind": "TEXT NOT NULL DEFAULT 'txt2img'",
+    "metadata": "TEXT",
+    "bytes_saved": "INTEGER NOT NULL DEFAULT 0",
+}
+
+
+def _entry(row) -> Dict[str, Any]:
+    """查询结果转为记录，元数据以 JSON 保存"""
+    entry = dict(zip(COLUMNS, row))
+    if entry["metadata"] is not None:
+        entry["metadata"] = json.loads(entry["metadata"])
+    return entry
+
+
+def tags_query(q: str) -> str:
+    """把逗号分隔的标签转换为 FTS5 查询：每个标签作为短语，全部都要匹配"""
+    tags = [t.strip().replace('"', '""') for t in q.split(",") if t.strip()]
+    return " AND ".join(f'"{t}"' for t in tags)
+
+
+class GenerationHistory:
+    """SQLite 生成历史，所有数据库操作在线程池中执行"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            existing = {row[1] for row in conn.execute("PRAGMA table_info(generations)")}
+            for column, definition in ADDED_COLUMNS.items():
+                if column not in existing:
+                    conn.execute(f"ALTER TABLE generations ADD COLUMN {column} {definition}")
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _value(row: Dict[str, Any], column: str) -> Any:
+        if column == "metadata":
+            return json.dumps(row["metadata"], ensure_ascii=False) if row.get("metadata") is not None else None
+        if column == "bytes_saved":
+            return row.get("bytes_saved", 0)
+        return row[column]
+
+    def _insert(self, row: Dict[str, Any]):
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    f"INSERT OR IGNORE INTO generations ({', '.join(COLUMNS[1:])}) "
+                    f"VALUES ({', '.join('?' for _ in COLUMNS[1:])})",
+                    [self._value(row, c) for c in COLUMNS[1:]],
+                )
+
+    async def record(self, row: Dict[str, Any]):
+        await asyncio.to_thread(self._insert, row)
+
+    def _search(self, limit: int, cursor: Optional[int], model: Optional[str], seed: Optional[int],
+                q: Optional[str], since: Optional[float], until: Optional[float]) -> List[Dict[str, Any]]:
+        where, args = [], []
+        # 只有逗号或空白的 q 没有标签，不做全文过滤（空的 MATCH 是 FTS5 语法错误）
+        match = tags_query(q) if q else ""
+        if match:
+            source = "generations_fts JOIN generations g ON g.id = generations_fts.rowid"
+            where.append("generations_fts MATCH ?")
+            args.append(match)
+            id_column = "generations_fts.rowid"
+        else:
+            source = "generations g"
+            id_column = "g.id"
+        if cursor is not None:
+            where.append(f"{id_column} < ?")
+            args.append(cursor)
+        if model is not None:
+            where.append("g.model = ?")
+            args.append(model)
+        if seed is not None:
+            where.append("g.seed = ?")
+            args.append(seed)
+        if since is not None:
+            where.append("g.created_at >= ?")
+            args.append(since)
+        if until is not None:
+            where.append("g.created_at < ?")
+            args.append(until)
+
+        sql = f"SELECT {', '.join('g.' + c for c in COLUMNS)} FROM {source}"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY {id_column} DESC LIMIT ?"
+        args.append(limit)
+
+        with self._lock:
+            rows = self._connect().execute(sql, args).fetchall()
+        return [_entry(row) for row in rows]
+
+    async def search(self, limit: int = 50, cursor: Optional[int] = None, model: Optional[str] = None,
+                     seed: Optional[int] = None, q: Optional[str] = None, since: Optional[float] = None,
+                     until: Optional[float] = None) -> List[Dict[str, Any]]:
+        """按 id 倒序查询一页，cursor 为上一页最后一条的 id"""
+        return await asyncio.to_thread(self._search, limit, cursor, model, seed, q, since, until)
+
+    def _fetch_one(self, column: str, value: Any) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._connect().execute(
+                f"SELECT {', '.join(COLUMNS)} FROM generations WHERE {column} = ?", (value,)
+            ).fetchone()
+        return _entry(row) if row else None
+
+    async def get(self, entry_id: int) -> Optional[Dict[str, Any]]:
+        return await asyncio.to_thread(self._fetch_one, "id", entry_id)
+
+    async def get_by_request_id(self, request_id: str) -> Optional[Dict[str, Any]]:
+        """按请求 ID 查找，用于重启后恢复已完成任务的状态"""
+        return await asyncio.to_thread(self._fetch_one, "request_id", request_id)
+
+    def _fetch_by_request_ids(self, request_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        found = {}
+        # 分批查询，不超过 SQLite 的参数个数上限
+        for i in range(0, len(request_ids), 500):
+            batch = request_ids[i:i + 500]
+            with self._lock:
+                rows = self._connect().execute(
+                    f"SELECT {', '.join(COLUMNS)} FROM generations "
+                    f"WHERE request_id IN ({', '.join('?' for _ in batch)})", batch
+                ).fetchall()
+            for row in rows:
+                entry = _entry(row)
+                found[entry["request_id"]] = entry
+        return found
+
+    async def get_by_request_ids(self, request_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """按请求 ID 批量查找，返回 request_id -> 记录"""
+        if not request_ids:
+            return {}
+        return await asyncio.to_thread(self._fetch_by_request_ids, request_ids)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,149 @@
+"""
+幂等键：客户端在提交时带上 Idempotency-Key 请求头，超时重试不会重复创建任务
+
+键到请求 ID 的映射保存在内存中（按创建时间排序，超过上限时淘汰最旧的），
+同时写入生成历史所在的 results/history.db，重启后仍然有效。
+超过有效期（运行时配置 idempotency_window）的键由清理任务删除。
+同一个键只能用于同一组参数，参数不同时返回 422。
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key TEXT PRIMARY KEY,
+    request_id TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_idempotency_created_at ON idempotency_keys (created_at);
+"""
+
+# (请求 ID, 参数指纹, 创建时间)
+Entry = Tuple[str, str, float]
+
+
+def fingerprint(endpoint: str, params: Dict[str, Any]) -> str:
+    payload = json.dumps({"endpoint": endpoint, **params}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class IdempotencyIndex:
+    """内存中的键索引，在第一次使用时（或由 lifespan 提前）从数据库载入"""
+
+    def __init__(self, path: Path, max_keys: int = 100000, window: float = 86400):
+        self.path = path
+        self.max_keys = max_keys
+        self.window = window
+        self._keys: "OrderedDict[str, Entry]" = OrderedDict()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._open_lock = asyncio.Lock()
+        self.opened = False
+
+    @classmethod
+    def from_env(cls, path: Path, window: float) -> "IdempotencyIndex":
+        return cls(path, int(os.environ.get("IDEMPOTENCY_MAX_KEYS", 100000)), window)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def _load(self):
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT key, request_id, fingerprint, created_at FROM idempotency_keys "
+                "WHERE created_at >= ? ORDER BY created_at DESC LIMIT ?",
+                (time.time() - self.window, self.max_keys),
+            ).fetchall()
+        for key, request_id, fp, created_at in reversed(rows):
+            self._keys[key] = (request_id, fp, created_at)
+
+    async def open(self):
+        if self.opened:
+            return
+        async with self._open_lock:
+            if not self.opened:
+                await asyncio.to_thread(self._load)
+                self.opened = True
+
+    def _get(self, key: str) -> Optional[Entry]:
+        entry = self._keys.get(key)
+        if entry is not None and time.time() - entry[2] > self.window:
+            del self._keys[key]
+            return None
+        return entry
+
+    async def claim(self, key: str, fp: str, request_id: str) -> Optional[str]:
+        """登记键；键已存在时返回原来的请求 ID，不登记。参数与原请求不同时抛出 422"""
+        await self.open()
+        # 查找和登记之间没有 await，同一个键的并发请求只有一个能登记成功
+        entry = self._get(key)
+        if entry is not None:
+            if entry[1] != fp:
+                raise HTTPException(
+                    status_code=422,
+                    detail="Idempotency-Key was already used with different request parameters",
+                )
+            return entry[0]
+
+        entry = (request_id, fp, time.time())
+        self._keys[key] = entry
+        while len(self._keys) > self.max_keys:
+            self._keys.popitem(last=False)
+        await asyncio.to_thread(self._execute, "INSERT OR REPLACE INTO idempotency_keys VALUES (?, ?, ?, ?)",
+                                (key, *entry))
+        return None
+
+    async def forget(self, key: str, request_id: str):
+        """任务没有进入队列或已失败时删除键，客户端重试会重新提交"""
+        entry = self._keys.get(key)
+        if entry is None or entry[0] != request_id:
+            return
+        del self._keys[key]
+        await asyncio.to_thread(self._execute, "DELETE FROM idempotency_keys WHERE key = ? AND request_id = ?",
+                                (key, request_id))
+
+    def _execute(self, sql: str, args: tuple) -> int:
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                return conn.execute(sql, args).rowcount
+
+    async def expire(self) -> int:
+        """删除过期的键，数据库中也只保留最新的 max_keys 个"""
+        cutoff = time.time() - self.window
+        while self._keys and next(iter(self._keys.values()))[2] < cutoff:
+            self._keys.popitem(last=False)
+        return await asyncio.to_thread(
+            self._execute,
+            "DELETE FROM idempotency_keys WHERE created_at < ? OR key NOT IN "
+            "(SELECT key FROM idempotency_keys ORDER BY created_at DESC LIMIT ?)",
+            (cutoff, self.max_keys),
+        )
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,161 @@
+"""
+输入图像存储：img2img / 局部重绘 / 放大的底图和蒙版保存在 results/inputs/<sha256>.png
+
+上传的请求体按块写入临时文件并同时计算 SHA-256，不在内存中保存整张图像；
+内容相同的图像只保存一份，客户端用返回的 image_id 引用，同一张底图做多次变化时不必重复上传。
+超过 INPUT_RETENTION 秒（默认 7 天）没有被使用的输入图像由清理任务删除。
+"""
+
+import asyncio
+import base64
+import hashlib
+import os
+import struct
+import time
+from pathlib import Path
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+
+from upstream_stream import temp_file
+
+CHUNK_SIZE = 64 * 1024
+# 上传的数据每攒够这么多写一次文件
+WRITE_SIZE = 1024 * 1024
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def png_size(header: bytes) -> Optional[Tuple[int, int]]:
+    """从文件开头（签名 + IHDR）读出宽高，不是 PNG 时返回 None"""
+    if len(header) < 24 or not header.startswith(PNG_SIGNATURE) or header[12:16] != b"IHDR":
+        return None
+    return struct.unpack(">II", header[16:24])
+
+
+def read_png_size(path: Path) -> Optional[Tuple[int, int]]:
+    """读出 PNG 文件的宽高，只读取文件开头"""
+    with path.open("rb") as f:
+        return png_size(f.read(24))
+
+
+class InputStore:
+    """按内容哈希保存的输入图像，image_id 是图像内容的 SHA-256"""
+
+    def __init__(self, directory: Path, max_bytes: int = 20 * 1024 * 1024, retention: float = 7 * 86400):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.retention = retention
+
+    @classmethod
+    def from_env(cls, directory: Path) -> "InputStore":
+        return cls(
+            directory,
+            max_bytes=int(os.environ.get("INPUT_MAX_BYTES", 20 * 1024 * 1024)),
+            retention=float(os.environ.get("INPUT_RETENTION", 7 * 86400)),
+        )
+
+    def path(self, image_id: str) -> Path:
+        return self.directory / f"{image_id}.png"
+
+    def _store(self, tmp: Path, image_id: str) -> bool:
+        """把写好的临时文件改名为 image_id 对应的文件，返回是否已经存在"""
+        path = self.path(image_id)
+        if path.exists():
+            # 内容相同的图像已经保存过，只更新最近使用时间
+            os.utime(path)
+            return True
+        os.replace(tmp, path)
+        return False
+
+    async def save(self, chunks: AsyncIterator[bytes]) -> Dict[str, object]:
+        """把上传的数据流写入存储，返回 image_id、宽高、大小以及是否已经存在
+
+        文件操作都在线程中进行，数据攒到 WRITE_SIZE 再写一次，不阻塞事件循环。
+        """
+        tmp = await asyncio.to_thread(temp_file, self.directory, ".upload")
+        digest = hashlib.sha256()
+        header = b""
+        size = 0
+        buffer = bytearray()
+        try:
+            f = await asyncio.to_thread(tmp.open, "wb")
+            try:
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise HTTPException(status_code=413, detail=f"Image is larger than {self.max_bytes} bytes")
+                    if len(header) < 24:
+                        header += chunk[:24 - len(header)]
+                    digest.update(chunk)
+                    buffer += chunk
+                    if len(buffer) >= WRITE_SIZE:
+                        await asyncio.to_thread(f.write, bytes(buffer))
+                        buffer.clear()
+                if buffer:
+                    await asyncio.to_thread(f.write, bytes(buffer))
+            finally:
+                await asyncio.to_thread(f.close)
+
+            dimensions = png_size(header)
+            if dimensions is None:
+                raise HTTPException(status_code=415, detail="Input images must be PNG")
+
+            image_id = digest.hexdigest()
+            existed = await asyncio.to_thread(self._store, tmp, image_id)
+        finally:
+            await asyncio.to_thread(tmp.unlink, missing_ok=True)
+
+        return {"image_id": image_id, "width": dimensions[0], "height": dimensions[1], "size": size,
+                "deduplicated": existed}
+
+    def info(self, image_id: str) -> Optional[Dict[str, object]]:
+        path = self.path(image_id)
+        try:
+            dimensions = read_png_size(path)
+            size = path.stat().st_size
+        except FileNotFoundError:
+            return None
+        return {"image_id": image_id, "width": dimensions[0], "height": dimensions[1], "size": size}
+
+    def require(self, image_id: str, field: str) -> Dict[str, object]:
+        """提交任务时检查引用的输入图像存在，并更新最近使用时间"""
+        info = self.info(image_id)
+        if info is None:
+            raise HTTPException(status_code=422, detail=f"Unknown {field}: upload it to /inputs first")
+        os.utime(self.path(image_id))
+        return info
+
+    def read_b64(self, image_id: str) -> str:
+        """上游接口要求把图像以 base64 放在 JSON 请求体中，只在发出请求时读取"""
+        return base64.b64encode(self.path(image_id).read_bytes()).decode("ascii")
+
+    def expire(self) -> int:
+        """删除长时间没有使用的输入图像和上传中断留下的临时文件"""
+        if not self.directory.exists():
+            return 0
+        cutoff = time.time() - self.retention
+        removed = 0
+        for path in self.directory.iterdir():
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                continue
+        return removed
+
+
+async def upload_chunks(upload) -> AsyncIterator[bytes]:
+    """读取 multipart 中的文件（Starlette 已把较大的文件放在磁盘上的临时文件中）"""
+    while True:
+        chunk = await upload.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def save_upload(store: InputStore, upload) -> Dict[str, object]:
+    try:
+        return await store.save(upload_chunks(upload))
+    finally:
+        await upload.close()
@@ -0,0 +1,239 @@
+"""
+生成任务：所有提交方式共用的参数校验和任务记录
+"""
+
+import asyncio
+import random
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from fastapi import HTTPException
+from pydantic import BaseModel, Field, ValidationError, field_validator
+
+# 任务状态
+QUEUED = "queued"
+PROCESSING = "processing"
+COMPLETED = "completed"
+FAILED = "failed"
+
+MAX_SEED = 0xFFFFFFFF
+
+# 任务类型
+TXT2IMG = "txt2img"
+IMG2IMG = "img2img"
+INPAINT = "inpaint"
+UPSCALE = "upscale"
+
+# 各类型任务在通用生成参数之外的参数
+KIND_FIELDS = {
+    TXT2IMG: (),
+    IMG2IMG: ("image", "strength", "noise"),
+    INPAINT: ("image", "mask", "strength", "noise"),
+    UPSCALE: ("image", "scale"),
+}
+
+IMAGE_ID_PATTERN = r"^[0-9a-f]{64}$"
+
+# 允许的状态转换
+_TRANSITIONS = {
+    QUEUED: (PROCESSING, COMPLETED, FAILED),
+    PROCESSING: (COMPLETED, FAILED),
+    COMPLETED: (),
+    FAILED: (),
+}
+
+
+class GenerationParams(BaseModel):
+    """图像生成参数，GET 查询参数和 JSON 请求体都经过这里校验"""
+
+    prompt: str = Field("1girl, 1boy", min_length=1)
+    negative_prompt: str = ""
+    guidance_scale: float = Field(5.5, ge=0, le=10)
+    seed: int = Field(0, ge=0, le=MAX_SEED)
+    model: str = "Anime_v45_Full"
+    # 提示词超过模型的 token 上限时按标签截断，而不是返回 422
+    truncate: bool = False
+
+    @field_validator("model")
+    @classmethod
+    def check_model(cls, value: str) -> str:
+        from novelai_api.ImagePreset import ImageModel
+
+        if value not in ImageModel.__members__:
+            raise ValueError("Invalid model name")
+        return value
+
+
+class Img2ImgParams(GenerationParams):
+    """以上传的图像（/inputs 返回的 image_id）为底图生成"""
+
+    image: str = Field(pattern=IMAGE_ID_PATTERN)
+    strength: float = Field(0.7, ge=0.01, le=0.99)
+    noise: float = Field(0.0, ge=0, le=0.99)
+
+
+class InpaintParams(Img2ImgParams):
+    """局部重绘：mask 中白色的区域重新生成，只能使用 Inpainting_ 模型"""
+
+    mask: str = Field(pattern=IMAGE_ID_PATTERN)
+    model: str = "Inpainting_Anime_v4_Full"
+
+    @field_validator("model")
+    @classmethod
+    def check_model(cls, value: str) -> str:
+        from novelai_api.ImagePreset import ImageModel
+
+        # 给出普通模型时换成对应的局部重绘模型
+        if not value.startswith("Inpainting_"):
+            value = "Inpainting_" + value
+        if value not in ImageModel.__members__:
+            raise ValueError("No inpainting model for this model name")
+        return value
+
+
+class UpscaleParams(BaseModel):
+    image: str = Field(pattern=IMAGE_ID_PATTERN)
+    scale: int = Field(4, ge=2, le=4)
+
+    @field_validator("scale")
+    @classmethod
+    def check_scale(cls, value: int) -> int:
+        if value not in (2, 4):
+            raise ValueError("Scale must be 2 or 4")
+        return value
+
+
+PARAMS_MODELS = {TXT2IMG: GenerationParams, IMG2IMG: Img2ImgParams, INPAINT: InpaintParams, UPSCALE: UpscaleParams}
+
+
+class Job:
+    """一个生成任务；同步等待者、异步查询和队列处理器共享同一个对象"""
+
+    __slots__ = ("request_id", "kind", "prompt", "negative_prompt", "guidance_scale", "seed", "model", "inputs",
+                 "steps", "resolution", "seed_source", "timestamp", "state", "result", "error", "sync", "trace",
+                 "tokens", "client", "cost", "metadata", "bytes_saved", "_done")
+
+    def __init__(self, params: BaseModel, steps: int, resolution: str, sync: bool = False, kind: str = TXT2IMG):
+        self.request_id = str(uuid.uuid4())
+        self.kind = kind
+        # 放大任务没有提示词、种子和模型
+        values = params.model_dump()
+        self.prompt = values.get("prompt", "")
+        self.negative_prompt = values.get("negative_prompt", "")
+        self.guidance_scale = values.get("guidance_scale", 0.0)
+        # seed 为 0 时由服务器在入队前选定随机种子（取值范围与 novelai_api 一致），
+        # 这样每个任务都有确定的参数，结果可以复现和缓存
+        if kind == UPSCALE:
+            self.seed = 0
+            self.seed_source = "none"
+        elif values["seed"]:
+            self.seed = values["seed"]
+            self.seed_source = "requested"
+        else:
+            self.seed = random.randint(1, MAX_SEED)
+            self.seed_source = "random"
+        self.model = values.get("model", "")
+        self.inputs = {k: values[k] for k in KIND_FIELDS[kind]}
+        # 提交时的生成默认值，运行中修改配置不影响已入队的任务
+        self.steps = steps
+        self.resolution = resolution
+        self.timestamp = time.time()
+        self.state = QUEUED
+        # 结果图像文件（缓存目录中的那一份）
+        self.result: Optional[Path] = None
+        self.error: Optional[str] = None
+        # 同步任务由端点等待结果并在响应发送后结束 trace
+        self.sync = sync
+        self.trace = None
+        # 入队前预检得到的 token 数
+        self.tokens: Optional[Dict[str, Any]] = None
+        # 提交任务的 API 客户端（api_keys.Client），任务结束时归还它的并发名额
+        self.client = None
+        # 估算的 Anlas 费用（anlas.Cost），用于分配账号和记账
+        self.cost = None
+        # 结果图像的元数据（png_optimize.metadata）和无损压缩节省的字节数
+        self.metadata: Optional[Dict[str, Any]] = None
+        self.bytes_saved = 0
+        # 只有同步等待者需要事件，异步任务不创建
+        self._done: Optional[asyncio.Event] = None
+
+    @classmethod
+    def from_record(cls, record: Dict[str, Any], steps: int, resolution: str) -> "Job":
+        """从交接记录恢复任务，保留原来的请求 ID、种子、生成设置和提交时间"""
+        kind = record.get("kind", TXT2IMG)
+        model = PARAMS_MODELS[kind]
+        job = cls(model(**{k: record[k] for k in model.model_fields if k in record}),
+                  record.get("steps", steps), record.get("resolution", resolution), kind=kind)
+        job.request_id = record["request_id"]
+        job.seed_source = record["seed_source"]
+        job.timestamp = record["timestamp"]
+        return job
+
+    def to_record(self) -> Dict[str, Any]:
+        return {
+            "request_id": self.request_id,
+            **self.params(),
+            "steps": self.steps,
+            "resolution": self.resolution,
+            "seed_source": self.seed_source,
+            "timestamp": self.timestamp,
+        }
+
+    def params(self) -> Dict[str, Any]:
+        params = {
+            "prompt": self.prompt,
+            "negative_prompt": self.negative_prompt,
+            "guidance_scale": self.guidance_scale,
+            "seed": self.seed,
+            "model": self.model,
+        }
+        # 文生图任务的参数（以及缓存键）保持原样
+        if self.kind != TXT2IMG:
+            params.update(kind=self.kind, **self.inputs)
+        return params
+
+    @property
+    def finished(self) -> bool:
+        return self.state in (COMPLETED, FAILED)
+
+    def _transition(self, state: str):
+        if state not in _TRANSITIONS[self.state]:
+            raise RuntimeError(f"Job {self.request_id}: invalid transition {self.state} -> {state}")
+        self.state = state
+
+    def start(self):
+        self._transition(PROCESSING)
+
+    def complete(self, result: Path):
+        self._transition(COMPLETED)
+        self.result = result
+        if self.client is not None:
+            self.client.release(succeeded=True)
+        if self._done is not None:
+            self._done.set()
+
+    def fail(self, error: str):
+        self._transition(FAILED)
+        self.error = error
+        if self.client is not None:
+            self.client.release(succeeded=False)
+        if self._done is not None:
+            self._done.set()
+
+    async def wait(self):
+        """等待任务完成或失败"""
+        if self.finished:
+            return
+        if self._done is None:
+            self._done = asyncio.Event()
+        await self._done.wait()
+
+
+def validate_params(params_model: type = GenerationParams, /, **values) -> BaseModel:
+    """校验 GET 查询参数或表单字段，校验失败时返回 422（与 JSON 请求体的校验错误格式一致）"""
+    try:
+        return params_model(**values)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False))
@@ -1,18 +1,80 @@
 import asyncio
 from pathlib import Path
-from fastapi import FastAPI, Query, HTTPException, logger
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, Depends, Query, HTTPException, Header, Request
+from fastapi.responses import StreamingResponse, PlainTextResponse, FileResponse, JSONResponse
+from starlette.background import BackgroundTask
+from starlette.datastructures import UploadFile
 from contextlib import asynccontextmanager
-from boilerplate import API
-from novelai_api.ImagePreset import ImageModel, ImagePreset
-import io
-from typing import Dict, Any
-import uuid
+from pydantic import BaseModel, Field, ValidationError
+from fast_json import FastJSONResponse
+from profiler import sample_stacks
+from traffic_capture import CaptureLog
+from proxy_pool import get_pool
+from result_cache import ResultCache, cache_key
+from upstream_health import UpstreamBreaker
+from png_metadata import parameters_seed
+from png_optimize import PngOptimizer
+from history import GenerationHistory
+from accounts import Account, AccountPool
+from handoff import save_pending, claim_pending
+from hedging import Hedger, UPSTREAM_TIMEOUT, first_success
+from prompt_tokens import PromptTokenizer, token_limit
+from runtime_config import ConfigStore
+from idempotency import IdempotencyIndex, fingerprint
+from jobs import (Job, GenerationParams, PARAMS_MODELS, IMAGE_ID_PATTERN, validate_params, QUEUED, PROCESSING,
+                  COMPLETED, FAILED, TXT2IMG, IMG2IMG, INPAINT, UPSCALE)
+from inputs import InputStore, read_png_size, save_upload
+from api_keys import Client, ClientRegistry, RateLimitHeaders
+from upstream_sessions import SessionPool
+from anlas import Cost, Ledger
+import anlas
+import tracing
+import upstream_stream
+import hmac
+import importlib
+import importlib.util
+import json
+import os
+import re
+import shutil
+import signal
+import sqlite3
+import sys
+from typing import Awaitable, Callable, Deque, Dict, Any, List, Literal, Optional, Tuple, Union
 import time
+from collections import deque
+
+# 排空时等待当前生成完成的最长时间（秒），需大于上游请求超时
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", 90))
+DRAIN_ERROR = "Server is draining. Please retry the request."
+# 以图像为输入的任务类型（路径中的名称与任务类型相同）
+ImageKind = Literal["img2img", "inpaint", "upscale"]
+# multipart 表单解析需要 python-multipart，没有安装时只能通过 PUT /inputs 上传
+MULTIPART_AVAILABLE = any(importlib.util.find_spec(name) for name in ("python_multipart", "multipart"))
+# 上游临时文件最多存在一次生成的时间，超过这个时间的是崩溃留下的
+TEMP_MAX_AGE = 3600
+# 重新压缩的结果写入缓存后，原图再保留这么多秒才删除，正在发送原图的响应不受影响
+RAW_RESULT_GRACE = 60
 
 # 全局变量声明
 request_queue = None
-request_results: Dict[str, Dict[str, Any]] = {}
+request_results: Dict[str, Job] = {}
+tracer = tracing.Tracer.from_env()
+capture_log = CaptureLog.from_env()
+profile_lock = asyncio.Lock()
+accounts = AccountPool.from_env()
+prompt_tokenizer = PromptTokenizer()
+hedger = Hedger.from_env()
+drain_lock = asyncio.Lock()
+drain_summary: Optional[Dict[str, Any]] = None
+# 配置修改后唤醒清理任务，新的清理间隔立即生效
+config_changed = asyncio.Event()
+
+def egress_available() -> bool:
+    """是否还有可用的出口（使用 NAI_BASE_URL 指向的后端时不经过代理池）"""
+    return bool(os.environ.get("NAI_BASE_URL")) or any(e.healthy for e in get_pool().egresses)
+
+upstream = UpstreamBreaker.from_env(egress_available)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -20,156 +82,531 @@ async def lifespan(app: FastAPI):
     global request_queue
 
     # 启动时初始化
-    request_queue = RequestQueue(max_queue_size=10)
+    request_queue = RequestQueue(max_queue_size=config.current.max_queue_size)
+
+    # novelai_api 导入需要近 2 秒，放到后台线程里加载，服务器可以先开始响应健康检查
+    preload_task = asyncio.create_task(asyncio.to_thread(preload_upstream_client))
 
     # 启动后台任务
-    queue_task = asyncio.create_task(request_queue.process_requests())
+    request_queue.set_workers(config.current.workers)
     cleanup_task = asyncio.create_task(cleanup_old_requests())
+    keep_warm_task = asyncio.create_task(after_preload(preload_task, lambda: sessions.run(accounts.accounts)))
+    balance_task = asyncio.create_task(after_preload(preload_task, lambda: ledger.run(accounts.accounts)))
+    capture_task = asyncio.create_task(capture_log.run())
+    egress_task = asyncio.create_task(get_pool().run())
+    # 结果索引在后台打开，不阻塞启动；启动耗时与已保存的结果数量无关
+    index_task = asyncio.create_task(result_cache.open())
+    idempotency_task = asyncio.create_task(idempotency.open())
+    clients_task = asyncio.create_task(clients.run()) if clients.enabled else None
+    # 接手排空的前任进程交接过来的任务
+    handoff_task = asyncio.create_task(adopt_pending_jobs())
+
+    # SIGUSR1 触发排空（SIGTERM 由 uvicorn 处理，关闭时同样会排空）
+    drain_signal = install_drain_signal()
 
     print("Request queue processor started")
     print("Request cleanup task started")
+    if capture_log.enabled:
+        print(f"Capturing requests to {capture_log.path}")
 
     yield
 
+    # 关闭时先排空：等当前生成完成，把排队的任务交给后继进程
+    await drain_server()
+
     # 关闭时清理
-    queue_task.cancel()
+    if drain_signal:
+        asyncio.get_running_loop().remove_signal_handler(signal.SIGUSR1)
+    handoff_task.cancel()
+    preload_task.cancel()
+    request_queue.stop_workers()
     cleanup_task.cancel()
+    keep_warm_task.cancel()
+    balance_task.cancel()
+    capture_task.cancel()
+    egress_task.cancel()
+    index_task.cancel()
+    idempotency_task.cancel()
+    if clients_task is not None:
+        clients_task.cancel()
+        clients.save()
+    await sessions.close()
+    # 已完成的任务等重新压缩写入缓存和生成历史后再关闭
+    await png_optimizer.wait_pending(DRAIN_TIMEOUT)
+    png_optimizer.close()
+    tracer.close()
+    history.close()
+    idempotency.close()
+    result_cache.close()
     print("Background tasks stopped")
 
+def preload_upstream_client():
+    """预先导入上游客户端模块，避免第一个请求承担导入耗时"""
+    prompt_tokenizer.load()
+    importlib.import_module("boilerplate")
+    importlib.import_module("novelai_api.ImagePreset")
+
+async def after_preload(preload_task: asyncio.Task, start: Callable[[], Awaitable[Any]]):
+    """访问上游的后台任务（保温、刷新余额）等 novelai_api 在后台线程中导入完成后再开始，不阻塞事件循环"""
+    await asyncio.wait({preload_task})
+    await start()
+
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(RateLimitHeaders)
 output_dir = Path("results")
 output_dir.mkdir(exist_ok=True)
+result_cache = ResultCache(output_dir / "cache")
+# 上游响应的临时文件，生成完成后改名进缓存目录
+upstream_tmp_dir = output_dir / "tmp"
+# img2img / 局部重绘 / 放大的输入图像，按内容哈希去重
+input_store = InputStore.from_env(output_dir / "inputs")
+# API 密钥和各客户端的限额，用量定期保存
+clients = ClientRegistry.from_env(output_dir / "client_usage.json")
+history = GenerationHistory(output_dir / "history.db")
+config = ConfigStore.from_env(output_dir / "config_audit.jsonl")
+# 幂等键与生成历史保存在同一个数据库中
+idempotency = IdempotencyIndex.from_env(output_dir / "history.db", config.current.idempotency_window)
+# 每个账号一个已登录的上游会话，在任务之间复用，由保温任务刷新令牌和保持连接
+sessions = SessionPool.from_env(upstream_tmp_dir, config.current.keep_warm_interval)
+# 各账号的 Anlas 余额和花费，定期从上游刷新
+ledger = Ledger.from_env(sessions)
+png_optimizer = PngOptimizer.from_env()
+
+def upstream_prompt(prompt: str) -> str:
+    """实际发给上游的提示词"""
+    return prompt.replace("pOwOq", "penis")
+
+async def check_prompt_tokens(params: GenerationParams) -> Tuple[GenerationParams, Dict[str, Any]]:
+    """入队前检查 token 数：超过模型上限时返回 422，请求了 truncate 时按标签截断"""
+    if not prompt_tokenizer.loaded:
+        await asyncio.to_thread(prompt_tokenizer.load)
+
+    limit = token_limit(params.model)
+    tokens: Dict[str, Any] = {"limit": limit, "truncated": False}
+    updates = {}
+    for field in ("prompt", "negative_prompt"):
+        text = getattr(params, field)
+        count = prompt_tokenizer.count(upstream_prompt(text)) if text else 0
+        if count > limit and params.truncate:
+            truncated = prompt_tokenizer.truncate(text, limit)
+            if truncated is not None:
+                updates[field] = truncated
+                count = prompt_tokenizer.count(upstream_prompt(truncated))
+                tokens["truncated"] = True
+        if count > limit:
+            raise HTTPException(status_code=422, detail=[{
+                "type": "token_limit",
+                "loc": ["body", field],
+                "msg": f"{field} has {count} tokens, model {params.model} allows {limit}",
+                "input": count,
+            }])
+        tokens[field] = count
+
+    return (params.model_copy(update=updates) if updates else params), tokens
+
+def discard_result(task: asyncio.Task):
+    """删除对冲中输掉但也生成成功的一方留下的临时文件"""
+    if not task.cancelled() and task.exception() is None:
+        task.result()[0].unlink(missing_ok=True)
+
+def result_cache_key(job: Job) -> str:
+    return cache_key({**job.params(), 'steps': job.steps, 'resolution': job.resolution})
+
+async def cached_result_or_503(job: Job) -> Path:
+    """降级模式下的处理：有缓存的确定性请求直接返回缓存，否则立即以 503 拒绝"""
+    # 服务器随机选定的种子不可能命中缓存，只查找客户端指定了种子的请求
+    if job.seed_source == "requested":
+        cached = await result_cache.get_path(result_cache_key(job))
+        if cached is not None:
+            return cached
+    raise HTTPException(
+        status_code=503,
+        detail="NovelAI is currently unavailable and no cached result exists for this request. Please try again later.",
+        headers={"Retry-After": str(upstream.retry_after())}
+    )
 
 class RequestQueue:
     """请求队列管理器，用于处理 NovelAI 的并发限制"""
 
     def __init__(self, max_queue_size: int = 10):
         self.max_queue_size = max_queue_size
-        self.queue = asyncio.Queue(maxsize=max_queue_size)
-        self.processing = False
-        self.current_request_id = None
-        self._lock = asyncio.Lock()
+        # 排队中的任务；上限在 add_job 中检查，运行中修改上限只需改 max_queue_size
+        self.pending: Deque[Job] = deque()
+        self._job_added = asyncio.Event()
+        # 处理器编号 -> 任务；处理器编号 -> 正在处理的任务
+        self.workers: Dict[int, asyncio.Task] = {}
+        self.target_workers = 0
+        self.active: Dict[int, Job] = {}
+        # 排空模式下不再接收新任务，处理器也不再开始新的任务
+        self.draining = False
+        self.held: List[Job] = []
+        # 接手的交接任务在队列满时暂存于此，排空时和排队的任务一起再次交接
+        self.backlog: List[Job] = []
 
-    async def add_request(self, request_data: Dict[str, Any]) -> str:
-        """添加请求到队列，返回请求ID"""
-        request_id = str(uuid.uuid4())
-        request_data['request_id'] = request_id
-        request_data['timestamp'] = time.time()
+    @property
+    def processing_jobs(self) -> List[Job]:
+        """已分配到账号、正在生成的任务；处理器取出后还在等待空闲账号的任务仍是排队状态"""
+        return [job for job in self.active.values() if job.state == PROCESSING]
 
-        try:
-            # 尝试立即放入队列，如果队列满了会抛出异常
-            self.queue.put_nowait(request_data)
-            return request_id
-        except asyncio.QueueFull:
-            raise HTTPException(status_code=423, detail="Request queue is full. Please try again later.")
-
-    async def process_requests(self):
-        """处理队列中的请求"""
-        while True:
+    @property
+    def processing(self) -> bool:
+        return bool(self.processing_jobs)
+
+    @property
+    def current_request_id(self) -> Optional[str]:
+        jobs = self.processing_jobs
+        return jobs[0].request_id if jobs else None
+
+    def full(self) -> bool:
+        return len(self.pending) >= self.max_queue_size
+
+    def resize(self, max_queue_size: int):
+        """修改队列上限；缩小时已排队的任务都保留，队列降到新上限以下之前新任务返回 423"""
+        self.max_queue_size = max_queue_size
+
+    def _put(self, job: Job):
+        self.pending.append(job)
+        self._job_added.set()
+
+    async def _get(self) -> Job:
+        """取出下一个排队的任务，没有任务时等待"""
+        while not self.pending:
+            self._job_added.clear()
+            await self._job_added.wait()
+        return self.pending.popleft()
+
+    def set_workers(self, count: int):
+        """调整处理器数量：多出的空闲处理器立即停止，忙碌的处理完当前任务后退出"""
+        self.target_workers = count
+        for worker_id in range(count):
+            if worker_id not in self.workers:
+                self.workers[worker_id] = asyncio.create_task(self.process_requests(worker_id))
+        for worker_id in [w for w in self.workers if w >= count and w not in self.active]:
+            self.workers.pop(worker_id).cancel()
+
+    def stop_workers(self):
+        for task in self.workers.values():
+            task.cancel()
+        self.workers.clear()
+
+    def add_job(self, job: Job):
+        """添加任务到队列，队列已满时返回 423，排空中返回 503"""
+        if self.draining:
+            raise HTTPException(status_code=503, detail=DRAIN_ERROR, headers={"Retry-After": "5"})
+        if self.full():
+            raise HTTPException(status_code=423, detail="Request queue is full. Please try again later.",
+                                headers={"Retry-After": str(self.retry_after())})
+        self._put(job)
+
+    def retry_after(self) -> int:
+        """估计队列空出一个位置需要的秒数：正在处理的各类任务的服务时间中位数的平均 / 处理器数量"""
+        medians = [m for m in (hedger.median(job.kind) for job in self.active.values()) if m is not None]
+        if not medians:
+            median = hedger.median(TXT2IMG)
+            if median is None:
+                return 5
+            medians = [median]
+        return max(1, round(sum(medians) / len(medians) / max(len(self.workers), 1)))
+
+    async def process_requests(self, worker_id: int = 0):
+        """处理队列中的请求；处理器编号超出目标数量时退出"""
+        while worker_id < self.target_workers:
             try:
                 # 从队列中获取请求
-                request_data = await self.queue.get()
-                request_id = request_data['request_id']
+                job = await self._get()
+                if self.draining:
+                    # 排空期间取出的任务留给交接，不再处理
+                    self.held.append(job)
+                    continue
 
-                async with self._lock:
-                    self.processing = True
-                    self.current_request_id = request_id
+                trace_token = tracing.use_trace(job.trace)
+                if job.trace is not None:
+                    job.trace.record("queue.wait", job.timestamp, time.time())
 
-                try:
-                    # 处理请求
-                    result = await self._process_single_request(request_data)
-
-                    # 将结果存储到结果容器中
-                    if 'result_container' in request_data:
-                        request_data['result_container']['result'] = result
+                self.active[worker_id] = job
 
-                    # 更新全局结果存储（如果存在）
-                    if request_id in request_results:
-                        request_results[request_id]['result'] = result
-                        request_results[request_id]['status'] = 'completed'
+                try:
+                    # 处理请求；降级模式下不调用上游，队列中注定失败的任务会被立即清空。
+                    # 生成的任务在分配到账号后才进入处理中状态（见 _execute）
+                    if upstream.degraded:
+                        job.start()
+                        result = await cached_result_or_503(job)
+                    else:
+                        result = await self._generate(job)
+                    job.complete(result)
 
                 except Exception as e:
-                    logger.error(f"Request {request_id} failed: {e}")
-                    # 将错误存储到结果容器中
-                    if 'result_container' in request_data:
-                        request_data['result_container']['error'] = str(e)
-
-                    # 更新全局结果存储（如果存在）
-                    if request_id in request_results:
-                        request_results[request_id]['error'] = str(e)
-                        request_results[request_id]['status'] = 'failed'
-                    print(f"Request {request_id} failed: {e}")
+                    job.fail(str(e))
+                    print(f"Request {job.request_id} failed: {e}")
                 finally:
-                    # 通知等待的请求完成
-                    if 'completion_event' in request_data:
-                        request_data['completion_event'].set()
+                    tracing.reset_trace(trace_token)
 
-                    # 标记任务完成
-                    self.queue.task_done()
-                    async with self._lock:
-                        self.processing = False
-                        self.current_request_id = None
+                    # 同步请求的 trace 由端点在响应发送后结束，异步请求在这里结束
+                    if job.trace is not None and not job.sync:
+                        job.trace.finish(error=job.error)
+
+                    del self.active[worker_id]
 
             except Exception as e:
                 print(f"Queue processing error: {e}")
                 await asyncio.sleep(1)
 
-    async def _process_single_request(self, request_data: Dict[str, Any]) -> bytes:
-        """处理单个图像生成请求"""
-        prompt = request_data['prompt']
-        negative_prompt = request_data['negative_prompt']
-        guidance_scale = request_data['guidance_scale']
-        prompt = request_data['prompt'].replace("pOwOq", "penis")
-        seed = request_data['seed']
-        model = request_data['model']
+        self.workers.pop(worker_id, None)
+
+    async def _generate(self, job: Job) -> Path:
+        """调用上游生成，并把结果计入上游健康状态和结果缓存"""
+        try:
+            with tracing.span("process", request_id=job.request_id):
+                result = await self._execute(job)
+        except HTTPException as e:
+            if e.status_code >= 500:
+                upstream.record_failure(str(e.detail))
+            raise
+        except Exception as e:
+            upstream.record_failure(str(e))
+            raise
+
+        upstream.record_success()
 
+        # 读出图像元数据，按配置删除文本块（只是一次顺序复制）；处理失败时保留原文件
+        settings = config.current
         try:
-            model_enum = getattr(ImageModel, model)
-        except AttributeError:
-            raise HTTPException(status_code=400, detail="Invalid model name")
+            info = await png_optimizer.process(result, settings.png_strip_text)
+            job.metadata = info["metadata"]
+            job.bytes_saved = info["bytes_saved"]
+        except Exception as e:
+            print(f"Failed to post-process result of {job.request_id}: {e}")
+            job.metadata = {}
 
-        async with API() as api_handler:
-            api = api_handler.api
+        # 以图像元数据中实际使用的种子为准（放大任务没有种子）
+        actual_seed = parameters_seed(job.metadata.get("parameters", {})) if job.kind != UPSCALE else None
+        if actual_seed is not None and actual_seed != job.seed:
+            print(f"Request {job.request_id}: upstream used seed {actual_seed} instead of {job.seed}")
+            job.seed = actual_seed
+
+        # 种子已经确定，每个完成的任务都可以写入缓存
+        key = result_cache_key(job)
+        if settings.png_optimize:
+            # 任务先以原图完成，不占用处理器和账号；重新压缩后再写入缓存和生成历史
+            png_optimizer.submit(self._publish_optimized(job, key, result))
+            return result
+
+        # 临时文件直接改名为缓存文件
+        result = await result_cache.put_file(key, result, job.seed)
+        await self._record_history(job, key, result)
+        return result
+
+    async def _publish_optimized(self, job: Job, key: str, raw: Path):
+        """后台：重新压缩原图，写入缓存和生成历史，之后的请求改为发送缓存中的文件"""
+        try:
+            optimized = raw.with_name(raw.name + ".recompressed")
+            try:
+                info = await png_optimizer.recompress(raw, optimized)
+                job.bytes_saved += info["bytes_saved"]
+            except Exception as e:
+                print(f"Failed to recompress result of {job.request_id}: {e}")
+                await asyncio.to_thread(shutil.copyfile, raw, optimized)
+            job.result = await result_cache.put_file(key, optimized, job.seed)
+            await self._record_history(job, key, job.result)
+        except Exception as e:
+            print(f"Failed to store result of {job.request_id}: {e}")
+            return
+        # 发送原图的响应可能已经读取了文件信息、还没有打开文件，过一段时间再删除原图
+        asyncio.get_running_loop().call_later(RAW_RESULT_GRACE, raw.unlink, True)
+
+    async def _record_history(self, job: Job, key: str, result: Path):
+        """记录到生成历史，图像文件就是缓存中的那一份
+
+        img2img、局部重绘和放大的尺寸由输入图像决定，记录结果图像的实际宽高而不是默认分辨率。
+        """
+        resolution = job.resolution
+        if job.kind != TXT2IMG:
+            size = await asyncio.to_thread(read_png_size, result)
+            if size is not None:
+                resolution = f"{size[0]}x{size[1]}"
+        try:
+            await history.record({
+                **job.params(),
+                "request_id": job.request_id,
+                "kind": job.kind,
+                "created_at": time.time(),
+                "steps": job.steps,
+                "resolution": resolution,
+                "image_path": result_cache.path(key).relative_to(output_dir).as_posix(),
+                "metadata": job.metadata,
+                "bytes_saved": job.bytes_saved,
+            })
+        except Exception as e:
+            print(f"Failed to record history for {job.request_id}: {e}")
+
+    async def _execute(self, job: Job) -> Path:
+        """执行生成；配置了多个账号时，耗时超过服务时间分位数的任务用空闲账号发起对冲请求"""
+        # 优先分配能免费生成或费用最低的账号；处理器多于账号时在这里等待，任务保持排队状态
+        account = await accounts.acquire(job.cost)
+        job.start()
+        start = time.monotonic()
+        primary = asyncio.create_task(self._attempt(job, account))
+        tasks = [primary]
+        try:
+            delay = hedger.delay(job.kind) if len(accounts) > 1 else None
+            if delay is not None:
+                done, _ = await asyncio.wait({primary}, timeout=delay)
+                if not done and hedger.allow():
+                    account = accounts.try_acquire(job.cost)
+                    if account is not None:
+                        print(f"Request {job.request_id}: hedging on account {account.name} after {delay:.1f}s")
+                        tasks.append(asyncio.create_task(self._attempt(job, account)))
+
+            winner = await first_success(tasks)
+        finally:
+            # 取消未完成的请求（对冲中输掉的一方，或任务本身被取消）
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                    task.add_done_callback(discard_result)
+
+        # 两边都已成功时，输掉一方的临时文件不再需要
+        for task in tasks:
+            if task is not winner and task.done():
+                discard_result(task)
+
+        result, service_time = winner.result()
+        latency = time.monotonic() - start
+        hedger.observe(service_time, job.kind)
+        hedger.record(latency, hedged=len(tasks) > 1, hedge_won=winner is not primary)
+        return result
+
+    async def _attempt(self, job: Job, account: Optional[Account]) -> Tuple[Path, float]:
+        """用指定账号生成一次，返回图像和耗时"""
+        start = time.monotonic()
+        try:
+            result = await self._process_single_request(job, account)
+        except asyncio.CancelledError:
+            # 取消只断开了连接，上游可能还在生成，超时前账号仍可能被占用
+            accounts.release(account, locked_until=time.time() + UPSTREAM_TIMEOUT - (time.monotonic() - start))
+            raise
+        except BaseException as e:
+            sessions.invalidate(account, e)
+            ledger.note_error(account, e)
+            accounts.release(account)
+            raise
+        ledger.charge(account, job.cost)
+        accounts.release(account)
+        return result, time.monotonic() - start
+
+    async def _process_single_request(self, job: Job, account: Optional[Account] = None) -> Path:
+        """处理单个图像生成请求，返回 results/tmp/ 下的临时文件"""
+        from novelai_api.ImagePreset import ImageGenerationType, ImageModel, ImagePreset
+
+        # 复用这个账号已登录的会话（响应按块写入磁盘，见 upstream_sessions）
+        with tracing.span("upstream.session"):
+            api = await sessions.get(account)
+
+        if job.kind == UPSCALE:
+            image = input_store.require(job.inputs["image"], "image")
+            data = await asyncio.to_thread(input_store.read_b64, image["image_id"])
+            with tracing.span("upstream.upscale", account=account.name if account else None):
+                _, img_path = await api.low_level.upscale_image(data, image["width"], image["height"],
+                                                                job.inputs["scale"])
+            return img_path
+
+        prompt = upstream_prompt(job.prompt)
+        model_enum = ImageModel[job.model]
+        with tracing.span("preset.build"):
             preset = ImagePreset.from_default_config(model_enum)
-            preset.steps = 28
-            preset.seed = seed
-            preset.resolution = "Normal_Square_v3"
+            preset.steps = job.steps
+            preset.seed = job.seed
+            preset.resolution = job.resolution
             preset.characters = []
-            preset.scale = guidance_scale
-            preset.uc = negative_prompt+ "," + preset.uc 
+            preset.scale = job.guidance_scale
+            preset.uc = job.negative_prompt + "," + preset.uc
 
-            img_bytes = None
-            async for _, img in api.high_level.generate_image(prompt, model_enum, preset):
-                img_bytes = img
-                break
+            # 底图和蒙版在发出请求时才读入（上游要求以 base64 放在请求体中）
+            action = ImageGenerationType.NORMAL
+            if job.kind in (IMG2IMG, INPAINT):
+                image = input_store.require(job.inputs["image"], "image")
+                preset.image = await asyncio.to_thread(input_store.read_b64, image["image_id"])
+                preset.resolution = (image["width"], image["height"])
+                preset.strength = job.inputs["strength"]
+                preset.noise = job.inputs["noise"]
+                action = ImageGenerationType.IMG2IMG
+            if job.kind == INPAINT:
+                preset.mask = await asyncio.to_thread(input_store.read_b64, job.inputs["mask"])
+                action = ImageGenerationType.INPAINTING
 
-        if img_bytes is None:
+        img_path = None
+        with tracing.span("upstream.generate", model=job.model, account=account.name if account else None):
+            images = api.high_level.generate_image(prompt, model_enum, preset, action)
+            try:
+                async for _, img in images:
+                    img_path = img
+                    break
+            finally:
+                # 立即关闭生成器，删除没有取用的其他图像并释放连接
+                await images.aclose()
+
+        if img_path is None:
             raise HTTPException(status_code=500, detail="Image generation failed")
 
-        return img_bytes
+        return img_path
+
+    async def wait_idle(self, timeout: float) -> bool:
+        """等待正在处理的任务完成，超时返回 False"""
+        deadline = time.time() + timeout
+        while self.active:
+            if time.time() >= deadline:
+                return False
+            await asyncio.sleep(0.1)
+        return True
+
+    def adopt(self, jobs: List[Job]):
+        """放入接手的交接任务，队列放不下的按顺序暂存"""
+        self.backlog.extend(jobs)
+        self.fill_backlog()
+
+    def fill_backlog(self):
+        """队列有空位时放入暂存的交接任务；排空期间留给 take_pending"""
+        while self.backlog and not self.draining and not self.full():
+            self._put(self.backlog.pop(0))
+
+    def take_pending(self) -> List[Job]:
+        """取出所有尚未开始的任务（包括暂存的交接任务），保持原来的顺序"""
+        pending, self.held = self.held, []
+        pending.extend(self.pending)
+        self.pending.clear()
+        pending.extend(self.backlog)
+        self.backlog = []
+        return pending
+
+    def positions(self) -> Dict[str, int]:
+        """排队任务的位置（0 表示下一个处理），批量查询时只计算一次"""
+        return {job.request_id: i for i, job in enumerate(self.pending)}
 
     def get_queue_status(self) -> Dict[str, Any]:
         """获取队列状态"""
         return {
-            "queue_size": self.queue.qsize(),
+            "queue_size": len(self.pending),
             "max_queue_size": self.max_queue_size,
             "is_processing": self.processing,
-            "current_request_id": self.current_request_id
+            "current_request_id": self.current_request_id,
+            "active_request_ids": [job.request_id for job in self.processing_jobs],
+            "workers": len(self.workers),
+            "draining": self.draining,
+            "upstream": upstream.status()
         }
 
 # 全局队列实例将在lifespan中初始化
 
 async def cleanup_old_requests():
-    """定期清理过期的请求结果（超过1小时的请求）"""
+    """定期清理过期的请求结果（保留时间和清理间隔见运行时配置）"""
     while True:
+        settings = config.current
         try:
             current_time = time.time()
-            expired_requests = []
-
-            for request_id, request_info in request_results.items():
-                # 清理超过1小时的请求
-                if current_time - request_info['timestamp'] > 3600:
-                    expired_requests.append(request_id)
+            expired_requests = [
+                request_id for request_id, job in request_results.items()
+                if current_time - job.timestamp > settings.retention
+            ]
 
             for request_id in expired_requests:
                 del request_results[request_id]
@@ -177,133 +614,607 @@ async def cleanup_old_requests():
             if expired_requests:
                 print(f"Cleaned up {len(expired_requests)} expired requests")
 
+            # 顺便合并结果索引的追加日志，删除过期的幂等键、长时间未使用的输入图像和崩溃留下的上游临时文件
+            await result_cache.maybe_compact()
+            await idempotency.expire()
+            await asyncio.to_thread(input_store.expire)
+            stale = await asyncio.to_thread(upstream_stream.clear_stale, upstream_tmp_dir, TEMP_MAX_AGE)
+            if stale:
+                print(f"Removed {stale} stale upstream temp files")
+
         except Exception as e:
             print(f"Cleanup error: {e}")
 
-        # 每10分钟清理一次
-        await asyncio.sleep(600)
+        # 等到下一次清理，配置修改后立即按新的间隔重新计时
+        try:
+            await asyncio.wait_for(config_changed.wait(), timeout=settings.cleanup_interval)
+        except asyncio.TimeoutError:
+            pass
+        config_changed.clear()
 
-@app.get("/generate/img/priv")
-async def generate_image(
-    prompt: str = Query("1girl, 1boy"),
-    negative_prompt: str = Query(""),
-    guidance_scale: float = Query(5.5),
-    seed: int = Query(0),
-    model: str = Query("Anime_v45_Full")
-):
-    """同步处理图像生成请求，在队列中等待并直接返回结果"""
-    request_data = {
-        'prompt': prompt,
-        'seed': seed,
-        'model': model,
-        'negative_prompt': negative_prompt,
-        'guidance_scale': guidance_scale
-    }
+async def drain_server() -> Dict[str, Any]:
+    """排空：停止接收新任务，等待当前生成完成，把排队的异步任务交给后继进程"""
+    global drain_summary
+
+    async with drain_lock:
+        if drain_summary is not None:
+            return drain_summary
+
+        request_queue.draining = True
+        print("Draining: no longer accepting new jobs")
+        finished = await request_queue.wait_idle(DRAIN_TIMEOUT)
+        if not finished:
+            print(f"Draining: in-flight job {request_queue.current_request_id} did not finish in {DRAIN_TIMEOUT}s")
 
-    # 检查队列是否已满
-    if request_queue.queue.qsize() >= request_queue.max_queue_size:
-        raise HTTPException(status_code=423, detail="Request queue is full. Please try again later.")
+        pending = request_queue.take_pending()
+        handed_off = [job for job in pending if not job.sync]
+        # 同步请求的连接无法交接，让等待者立即收到 503 去重试
+        for job in pending:
+            if job.sync:
+                job.fail(DRAIN_ERROR)
 
-    # 添加请求到队列并等待处理完成
-    request_id = str(uuid.uuid4())
-    request_data['request_id'] = request_id
-    request_data['timestamp'] = time.time()
+        handoff_file = None
+        if handed_off:
+            handoff_file = await asyncio.to_thread(save_pending, output_dir, [job.to_record() for job in handed_off])
+            print(f"Draining: handed off {len(handed_off)} queued jobs via {handoff_file.name}")
 
-    # 创建一个事件来等待处理完成
-    completion_event = asyncio.Event()
-    result_container = {'result': None, 'error': None}
+        drain_summary = {
+            "in_flight_finished": finished,
+            "handed_off": len(handed_off),
+            "rejected_sync": len(pending) - len(handed_off),
+            "handoff_file": handoff_file.name if handoff_file else None
+        }
+        return drain_summary
 
-    # 将完成事件和结果容器添加到请求数据中
-    request_data['completion_event'] = completion_event
-    request_data['result_container'] = result_container
+def install_drain_signal() -> bool:
+    """注册 SIGUSR1 排空信号；Windows 或非主线程运行时不可用"""
+    if not hasattr(signal, "SIGUSR1"):
+        return False
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, lambda: asyncio.create_task(drain_server()))
+    except (NotImplementedError, RuntimeError):
+        return False
+    return True
 
-    # 添加到队列
-    await request_queue.queue.put(request_data)
+async def adopt_pending_jobs():
+    """后台任务：认领前任进程交接的任务，按原请求 ID 放回队列"""
+    while True:
+        try:
+            if not request_queue.draining:
+                records = await asyncio.to_thread(claim_pending, output_dir)
+                adopted = []
+                for record in records:
+                    job = Job.from_record(record, config.current.steps, config.current.resolution)
+                    job.cost = await estimate_cost(job)
+                    request_results[job.request_id] = job
+                    adopted.append(job)
+                if records:
+                    print(f"Adopted {len(records)} jobs handed off by a previous process")
 
-    # 等待处理完成
-    await completion_event.wait()
+                # 队列满时暂存在 request_queue.backlog 中，留到下一轮再放入
+                request_queue.adopt(adopted)
+        except Exception as e:
+            print(f"Handoff error: {e}")
+
+        await asyncio.sleep(2)
+
+def check_inputs(params: BaseModel, kind: str):
+    """检查引用的输入图像存在，底图尺寸符合上游要求"""
+    if kind == TXT2IMG:
+        return
+    image = input_store.require(params.image, "image")
+    if kind in (IMG2IMG, INPAINT) and (image["width"] % 64 or image["height"] % 64):
+        raise HTTPException(status_code=422, detail="Base image width and height must be multiples of 64")
+    if kind == INPAINT:
+        mask = input_store.require(params.mask, "mask")
+        if (mask["width"], mask["height"]) != (image["width"], image["height"]):
+            raise HTTPException(status_code=422, detail="Mask must have the same size as the base image")
+
+async def build_job(params: BaseModel, kind: str, sync: bool = False) -> Job:
+    """入队前的检查（提示词 token 数、引用的输入图像），通过后按当前的生成默认值创建任务"""
+    tokens = None
+    if kind != UPSCALE:
+        params, tokens = await check_prompt_tokens(params)
+    check_inputs(params, kind)
+    settings = config.current
+    job = Job(params, settings.steps, settings.resolution, sync=sync, kind=kind)
+    job.tokens = tokens
+    job.cost = await estimate_cost(job)
+    if not accounts.affordable(job.cost):
+        raise HTTPException(
+            status_code=402,
+            detail=f"No account has enough Anlas for this job (costs {job.cost.standard}, {job.cost.opus} on Opus)",
+        )
+    return job
+
+async def estimate_cost(job: Job) -> Optional[Cost]:
+    """按本地计费模型估算任务的 Anlas 费用（img2img、局部重绘和放大按输入图像的尺寸）；输入图像已删除时返回 None"""
+    if not anlas.cost_model_loaded():
+        await asyncio.to_thread(anlas.load_cost_model)
+    size = None
+    if job.kind != TXT2IMG:
+        image = input_store.info(job.inputs["image"])
+        if image is None:
+            return None
+        size = (image["width"], image["height"])
+    return anlas.estimate(job, size)
+
+async def claim_idempotency_key(key: str, fp: str, job: Job) -> Union[Job, Dict[str, Any], None]:
+    """为新任务登记幂等键；键已对应一个可用的任务时返回它（内存中的任务或生成历史中的记录）
+
+    新任务在登记前先放进 request_results，并发的重试能找到它而不是当作已丢失。
+    """
+    request_results[job.request_id] = job
+    while True:
+        request_id = await idempotency.claim(key, fp, job.request_id)
+        if request_id is None:
+            return None
+        existing = request_results.get(request_id)
+        if existing is not None and existing.state != FAILED:
+            del request_results[job.request_id]
+            return existing
+        if existing is None:
+            entry = await history.get_by_request_id(request_id)
+            if entry is not None:
+                del request_results[job.request_id]
+                return entry
+        # 原任务失败或已丢失（例如重启前还在排队）：删除键，按新请求处理
+        await idempotency.forget(key, request_id)
+
+def authenticate_client(request: Request, authorization: Optional[str] = Header(None),
+                        x_api_key: Optional[str] = Header(None)) -> Optional[Client]:
+    """生成和上传端点的 API 密钥认证（X-API-Key 或 Authorization: Bearer）；没有配置密钥时不认证"""
+    if not clients.enabled:
+        return None
+    key = x_api_key
+    if key is None and authorization and authorization.startswith("Bearer "):
+        key = authorization[len("Bearer "):]
+    client = clients.authenticate(key)
+    # 响应头中带上这个客户端的剩余额度（RateLimitHeaders 中间件）
+    request.state.rate_limit = client
+    return client
+
+async def enqueue(job: Job, idempotency_key: Optional[str], client: Optional[Client] = None):
+    """检查客户端的限额后加入队列；被拒绝时删除刚登记的幂等键，客户端重试会重新提交"""
+    try:
+        if client is not None:
+            client.admit(request_queue.retry_after())
+        try:
+            request_queue.add_job(job)
+        except HTTPException:
+            if client is not None:
+                client.release(succeeded=False)
+            raise
+    except HTTPException:
+        if idempotency_key:
+            request_results.pop(job.request_id, None)
+            await idempotency.forget(idempotency_key, job.request_id)
+        raise
+    # 任务结束（完成或失败）时归还客户端的并发名额
+    job.client = client
+
+def replayed_result(existing: Union[Job, Dict[str, Any]]) -> FileResponse:
+    headers = {"Idempotent-Replayed": "true"}
+    if isinstance(existing, Job):
+        if existing.state == FAILED:
+            if existing.error == DRAIN_ERROR:
+                raise HTTPException(status_code=503, detail=DRAIN_ERROR, headers={"Retry-After": "5"})
+            raise HTTPException(status_code=500, detail=f"Image generation failed: {existing.error}")
+        return FileResponse(existing.result, media_type="image/png", headers={**headers, "X-Seed": str(existing.seed)})
+    return FileResponse(output_dir / existing["image_path"], media_type="image/png",
+                        headers={**headers, "X-Seed": str(existing["seed"])})
+
+async def submit_sync(params: BaseModel, route: str, endpoint: str, idempotency_key: Optional[str] = None,
+                      kind: str = TXT2IMG, client: Optional[Client] = None):
+    """同步提交：在队列中等待并直接返回图像"""
+    capture_log.record(endpoint, params.model_dump())
+    fp = fingerprint(endpoint, params.model_dump())
+    # 幂等键按客户端区分，不同客户端用了相同的键也互不影响
+    if idempotency_key and client is not None:
+        idempotency_key = f"{client.name}:{idempotency_key}"
+    job = await build_job(params, kind, sync=True)
+
+    # 上游不可用时不进入队列：有缓存直接返回，没有则立即 503
+    if upstream.degraded:
+        cached = await cached_result_or_503(job)
+        return FileResponse(cached, media_type="image/png", headers={"X-Cache": "stale", "X-Seed": str(job.seed)})
+
+    # 重试的请求等待原任务完成并返回同一张图像
+    if idempotency_key:
+        existing = await claim_idempotency_key(idempotency_key, fp, job)
+        if existing is not None:
+            if isinstance(existing, Job):
+                await existing.wait()
+            return replayed_result(existing)
+
+    job.trace = tracer.start_trace(route, request_id=job.request_id, model=job.model)
+
+    # 添加到队列并等待处理完成（带幂等键的同步任务已登记在 request_results 中，重试时可以找到）
+    await enqueue(job, idempotency_key, client)
+    await job.wait()
 
     # 检查结果
-    if result_container['error']:
-        raise HTTPException(status_code=500, detail=f"Image generation failed: {result_container['error']}")
+    if job.state == FAILED:
+        job.trace.finish(error=job.error)
+        if job.error == DRAIN_ERROR:
+            raise HTTPException(status_code=503, detail=DRAIN_ERROR, headers={"Retry-After": "5"})
+        raise HTTPException(status_code=500, detail=f"Image generation failed: {job.error}")
 
-    if result_container['result'] is None:
-        raise HTTPException(status_code=500, detail="Image generation failed")
+    # 响应体发送完毕后再结束 trace，这样 response.stream 覆盖了真实的传输时间
+    stream_start = time.time()
+
+    def finish_trace():
+        job.trace.record("response.stream", stream_start, time.time())
+        job.trace.finish()
+
+    return FileResponse(
+        job.result,
+        media_type="image/png",
+        headers={"X-Seed": str(job.seed)},
+        background=BackgroundTask(finish_trace),
+    )
+
+async def submit_async(params: BaseModel, route: str, endpoint: str, idempotency_key: Optional[str] = None,
+                       kind: str = TXT2IMG, client: Optional[Client] = None):
+    """异步提交：放入队列后立即返回 request_id"""
+    capture_log.record(endpoint, params.model_dump())
+    fp = fingerprint(endpoint, params.model_dump())
+    # 幂等键按客户端区分，不同客户端用了相同的键也互不影响
+    if idempotency_key and client is not None:
+        idempotency_key = f"{client.name}:{idempotency_key}"
+    job = await build_job(params, kind)
+
+    # 重试的请求返回原来的任务，不再次入队
+    if idempotency_key:
+        existing = await claim_idempotency_key(idempotency_key, fp, job)
+        if isinstance(existing, Job):
+            return {
+                "request_id": existing.request_id,
+                "status": existing.state,
+                "seed": existing.seed,
+                "tokens": existing.tokens,
+                "replayed": True,
+                "message": "Request was already submitted with this Idempotency-Key.",
+                "queue_status": request_queue.get_queue_status()
+            }
+        if existing is not None:
+            return {
+                "request_id": existing["request_id"],
+                "status": COMPLETED,
+                "seed": existing["seed"],
+                "replayed": True,
+                "message": "Request was already submitted with this Idempotency-Key.",
+                "result_url": f"/result/{existing['request_id']}"
+            }
+
+    # 上游不可用时不进入队列：有缓存直接作为已完成的请求返回，没有则立即 503
+    if upstream.degraded:
+        try:
+            job.complete(await cached_result_or_503(job))
+        except HTTPException:
+            if idempotency_key:
+                request_results.pop(job.request_id, None)
+                await idempotency.forget(idempotency_key, job.request_id)
+            raise
+        request_results[job.request_id] = job
+        return {
+            "request_id": job.request_id,
+            "status": job.state,
+            "seed": job.seed,
+            "tokens": job.tokens,
+            "message": "NovelAI is unavailable; served from cache. Use /result/{request_id} to fetch the image.",
+            "queue_status": request_queue.get_queue_status()
+        }
+
+    job.trace = tracer.start_trace(route, request_id=job.request_id, model=job.model)
+
+    # 添加请求到队列，并存储以便后续查询
+    await enqueue(job, idempotency_key, client)
+    request_results[job.request_id] = job
+
+    return {
+        "request_id": job.request_id,
+        "status": job.state,
+        "seed": job.seed,
+        "tokens": job.tokens,
+        "message": "Request added to queue. Use /status/{request_id} to check progress.",
+        "queue_status": request_queue.get_queue_status()
+    }
+
+@app.get("/generate/img/priv")
+async def generate_image(
+    prompt: str = Query("1girl, 1boy"),
+    negative_prompt: str = Query(""),
+    guidance_scale: float = Query(5.5),
+    seed: int = Query(0),
+    model: str = Query("Anime_v45_Full"),
+    truncate: bool = Query(False),
+    idempotency_key: Optional[str] = Header(None, max_length=255),
+    client: Optional[Client] = Depends(authenticate_client)
+):
+    """同步处理图像生成请求，在队列中等待并直接返回结果"""
+    params = validate_params(prompt=prompt, negative_prompt=negative_prompt,
+                             guidance_scale=guidance_scale, seed=seed, model=model,
+                             truncate=truncate)
+    return await submit_sync(params, "GET /generate/img/priv", "/generate/img/priv", idempotency_key, client=client)
 
-    return StreamingResponse(io.BytesIO(result_container['result']), media_type="image/png")
+@app.post("/generate/img/priv")
+async def generate_image_json(params: GenerationParams, idempotency_key: Optional[str] = Header(None, max_length=255),
+                              client: Optional[Client] = Depends(authenticate_client)):
+    """同步处理图像生成请求（JSON 请求体）"""
+    return await submit_sync(params, "POST /generate/img/priv", "/generate/img/priv", idempotency_key, client=client)
 
 @app.get("/generate/img/async")
 async def generate_image_async(
     prompt: str = Query("1girl, 1boy"),
+    negative_prompt: str = Query(""),
+    guidance_scale: float = Query(5.5),
     seed: int = Query(0),
-    model: str = Query("Anime_v45_Full")
+    model: str = Query("Anime_v45_Full"),
+    truncate: bool = Query(False),
+    idempotency_key: Optional[str] = Header(None, max_length=255),
+    client: Optional[Client] = Depends(authenticate_client)
 ):
     """异步提交图像生成请求到队列，返回request_id用于后续查询"""
-    request_data = {
-        'prompt': prompt,
-        'seed': seed,
-        'model': model
-    }
+    params = validate_params(prompt=prompt, negative_prompt=negative_prompt,
+                             guidance_scale=guidance_scale, seed=seed, model=model,
+                             truncate=truncate)
+    return await submit_async(params, "GET /generate/img/async", "/generate/img/async", idempotency_key, client=client)
 
-    # 添加请求到队列
-    request_id = await request_queue.add_request(request_data)
+@app.post("/generate/img/async")
+async def generate_image_async_json(params: GenerationParams,
+                                    idempotency_key: Optional[str] = Header(None, max_length=255),
+                                    client: Optional[Client] = Depends(authenticate_client)):
+    """异步提交图像生成请求（JSON 请求体）"""
+    return await submit_async(params, "POST /generate/img/async", "/generate/img/async", idempotency_key, client=client)
 
-    # 存储请求数据以便后续查询
-    request_results[request_id] = {
-        'status': 'queued',
-        'request_data': request_data,
-        'timestamp': time.time()
-    }
+async def image_job_params(request: Request, kind: str) -> BaseModel:
+    """解析 img2img / 局部重绘 / 放大的请求体：JSON（用 image_id 引用 /inputs 中的图像）或 multipart 表单（直接上传）"""
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        if not MULTIPART_AVAILABLE:
+            raise HTTPException(
+                status_code=415,
+                detail="multipart uploads need python-multipart; upload images to PUT /inputs and send JSON instead",
+            )
+        values: Dict[str, Any] = {}
+        # Starlette 按流解析表单，超过 1MB 的文件放在磁盘上的临时文件中
+        async with request.form(max_files=2, max_fields=20) as form:
+            for name, value in form.multi_items():
+                if not isinstance(value, UploadFile):
+                    values[name] = value
+                elif name in ("image", "mask"):
+                    values[name] = (await save_upload(input_store, value))["image_id"]
+                else:
+                    raise HTTPException(status_code=422, detail=f"Unexpected file field: {name}")
+    else:
+        try:
+            values = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=422, detail="Request body must be JSON or multipart/form-data")
+        if not isinstance(values, dict):
+            raise HTTPException(status_code=422, detail="Request body must be a JSON object")
+    return validate_params(PARAMS_MODELS[kind], **values)
 
-    return {
-        "request_id": request_id,
-        "status": "queued",
-        "message": "Request added to queue. Use /status/{request_id} to check progress.",
-        "queue_status": request_queue.get_queue_status()
-    }
+@app.post("/generate/{kind}/priv")
+async def generate_from_image(kind: ImageKind, request: Request,
+                              idempotency_key: Optional[str] = Header(None, max_length=255),
+                              client: Optional[Client] = Depends(authenticate_client)):
+    """同步处理 img2img / 局部重绘 / 放大请求"""
+    params = await image_job_params(request, kind)
+    return await submit_sync(params, f"POST /generate/{kind}/priv", f"/generate/{kind}/priv", idempotency_key, kind,
+                             client)
+
+@app.post("/generate/{kind}/async")
+async def generate_from_image_async(kind: ImageKind, request: Request,
+                                    idempotency_key: Optional[str] = Header(None, max_length=255),
+                                    client: Optional[Client] = Depends(authenticate_client)):
+    """异步提交 img2img / 局部重绘 / 放大请求"""
+    params = await image_job_params(request, kind)
+    return await submit_async(params, f"POST /generate/{kind}/async", f"/generate/{kind}/async",
+                              idempotency_key, kind, client)
+
+@app.put("/inputs", dependencies=[Depends(authenticate_client)])
+async def upload_input(request: Request):
+    """上传输入图像（请求体为 PNG 数据），返回 image_id；内容相同的图像只保存一份"""
+    return await input_store.save(request.stream())
+
+@app.get("/inputs/{image_id}")
+async def get_input(image_id: str):
+    """查询输入图像是否已经上传，客户端可以先按本地计算的 SHA-256 查询，已存在时不必再上传"""
+    info = input_store.info(image_id) if re.fullmatch(IMAGE_ID_PATTERN, image_id) else None
+    if info is None:
+        raise HTTPException(status_code=404, detail="Input image not found")
+    return info
 
 @app.get("/status/{request_id}")
 async def get_request_status(request_id: str):
     """查询请求状态"""
-    if request_id not in request_results:
-        raise HTTPException(status_code=404, detail="Request not found")
-
-    request_info = request_results[request_id]
-
-    # 检查队列中是否有结果更新
-    if request_info['status'] == 'queued':
-        # 检查是否正在处理
-        if request_queue.current_request_id == request_id:
-            request_info['status'] = 'processing'
+    job = request_results.get(request_id)
+    if job is None:
+        # 已过期或服务器重启前完成的任务可以从生成历史中找回
+        entry = await history.get_by_request_id(request_id)
+        if entry is None:
+            raise HTTPException(status_code=404, detail="Request not found")
+        return {
+            "request_id": request_id,
+            "status": COMPLETED,
+            "seed": entry["seed"],
+            "seed_source": None,
+            "tokens": None,
+            "metadata": entry["metadata"],
+            "bytes_saved": entry["bytes_saved"],
+            "timestamp": entry["created_at"],
+            "queue_status": request_queue.get_queue_status()
+        }
 
     return {
         "request_id": request_id,
-        "status": request_info['status'],
-        "timestamp": request_info['timestamp'],
+        "status": job.state,
+        "seed": job.seed,
+        "seed_source": job.seed_source,
+        "tokens": job.tokens,
+        "metadata": job.metadata,
+        "bytes_saved": job.bytes_saved,
+        "timestamp": job.timestamp,
         "queue_status": request_queue.get_queue_status()
     }
 
+class BulkStatusRequest(BaseModel):
+    request_ids: List[str] = Field(min_length=1, max_length=1000)
+
+@app.post("/status/bulk")
+async def get_bulk_status(body: BulkStatusRequest):
+    """批量查询请求状态：队列状态只返回一次，每个任务只返回状态、位置和结果地址"""
+    positions = request_queue.positions()
+    jobs: Dict[str, Dict[str, Any]] = {}
+    unknown = []
+    for request_id in dict.fromkeys(body.request_ids):
+        job = request_results.get(request_id)
+        if job is None:
+            unknown.append(request_id)
+            continue
+        entry: Dict[str, Any] = {"status": job.state, "seed": job.seed}
+        if job.state == QUEUED and request_id in positions:
+            entry["position"] = positions[request_id]
+        elif job.state == COMPLETED:
+            entry["result_url"] = f"/result/{request_id}"
+        elif job.state == FAILED:
+            entry["error"] = job.error
+        jobs[request_id] = entry
+
+    # 内存中没有的任务一次性从生成历史中找回
+    found = await history.get_by_request_ids(unknown)
+    for request_id in unknown:
+        entry = found.get(request_id)
+        if entry is not None:
+            jobs[request_id] = {"status": COMPLETED, "seed": entry["seed"], "result_url": f"/result/{request_id}"}
+
+    return FastJSONResponse({
+        "queue_status": request_queue.get_queue_status(),
+        "jobs": jobs,
+        "not_found": [r for r in unknown if r not in found]
+    })
+
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.get("/events/{request_id}")
+async def stream_request_events(request_id: str):
+    """以 Server-Sent Events 推送任务状态变化，任务完成或失败后结束；客户端不必轮询"""
+    job = request_results.get(request_id)
+    if job is None:
+        entry = await history.get_by_request_id(request_id)
+        if entry is None:
+            raise HTTPException(status_code=404, detail="Request not found")
+
+        async def finished_events():
+            yield sse_event(COMPLETED, {"request_id": request_id, "status": COMPLETED, "seed": entry["seed"],
+                                        "result_url": f"/result/{request_id}"})
+
+        return StreamingResponse(finished_events(), media_type="text/event-stream")
+
+    def snapshot() -> Dict[str, Any]:
+        data = {"request_id": request_id, "status": job.state, "seed": job.seed}
+        if job.state == QUEUED:
+            data["position"] = request_queue.positions().get(request_id)
+        elif job.state == COMPLETED:
+            data["result_url"] = f"/result/{request_id}"
+        elif job.state == FAILED:
+            data["error"] = job.error
+        return data
+
+    async def events():
+        last = None
+        idle = 0
+        # 每个连接只有一个等待任务；客户端断开时在 finally 中取消，不留下悬挂的任务
+        waiter = asyncio.create_task(job.wait())
+        try:
+            while True:
+                data = snapshot()
+                if data != last:
+                    yield sse_event(job.state if job.finished else "status", data)
+                    last = data
+                if job.finished:
+                    return
+                # 完成时立即唤醒；排队和处理中每秒检查一次位置变化，每 15 秒发一次保活注释
+                done, _ = await asyncio.wait({waiter}, timeout=1)
+                if not done:
+                    idle += 1
+                    if idle % 15 == 0:
+                        yield ": keep-alive\n\n"
+        finally:
+            waiter.cancel()
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.get("/result/{request_id}")
 async def get_request_result(request_id: str):
     """获取请求结果"""
-    if request_id not in request_results:
-        raise HTTPException(status_code=404, detail="Request not found")
-
-    request_info = request_results[request_id]
+    job = request_results.get(request_id)
+    if job is None:
+        entry = await history.get_by_request_id(request_id)
+        if entry is None or not (output_dir / entry["image_path"]).exists():
+            raise HTTPException(status_code=404, detail="Request not found")
+        return FileResponse(output_dir / entry["image_path"], media_type="image/png",
+                            headers={"X-Seed": str(entry["seed"])})
 
-    if request_info['status'] == 'queued':
+    if job.state == QUEUED:
         raise HTTPException(status_code=202, detail="Request is still in queue")
-    elif request_info['status'] == 'processing':
+    elif job.state == PROCESSING:
         raise HTTPException(status_code=202, detail="Request is being processed")
-    elif request_info['status'] == 'failed':
-        raise HTTPException(status_code=500, detail=f"Request failed: {request_info.get('error', 'Unknown error')}")
-    elif request_info['status'] == 'completed':
-        if 'result' in request_info:
-            return StreamingResponse(io.BytesIO(request_info['result']), media_type="image/png")
-        else:
-            raise HTTPException(status_code=500, detail="Result not found")
+    elif job.state == FAILED:
+        raise HTTPException(status_code=500, detail=f"Request failed: {job.error or 'Unknown error'}")
     else:
-        raise HTTPException(status_code=500, detail="Unknown request status")
+        return FileResponse(job.result, media_type="image/png", headers={"X-Seed": str(job.seed)})
+
+@app.get("/history")
+async def list_history(
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[int] = Query(None, description="上一页返回的 next_cursor"),
+    model: Optional[str] = Query(None),
+    seed: Optional[int] = Query(None),
+    q: Optional[str] = Query(None, description="逗号分隔的 prompt 标签，全部匹配"),
+    since: Optional[float] = Query(None, description="起始时间（Unix 时间戳）"),
+    until: Optional[float] = Query(None, description="结束时间（Unix 时间戳）")
+):
+    """分页查询生成历史（按时间倒序）"""
+    try:
+        entries = await history.search(limit, cursor, model, seed, q, since, until)
+    except sqlite3.OperationalError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid search query: {e}")
+
+    for entry in entries:
+        entry["image_url"] = f"/history/{entry['id']}/image"
+
+    return {
+        "entries": entries,
+        "next_cursor": entries[-1]["id"] if len(entries) == limit else None
+    }
+
+@app.get("/history/{entry_id}/image")
+async def get_history_image(entry_id: int):
+    """获取历史记录对应的图像"""
+    entry = await history.get(entry_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="History entry not found")
+
+    path = output_dir / entry["image_path"]
+    if not path.exists():
+        raise HTTPException(status_code=410, detail="Image file no longer exists")
+
+    return FileResponse(path, media_type="image/png", headers={"X-Seed": str(entry["seed"])})
+
+@app.get("/health")
+async def health():
+    """健康检查，不等待上游客户端模块加载；排空中返回 503，负载均衡器据此摘除实例"""
+    if request_queue.draining:
+        return JSONResponse(status_code=503, content={"status": "draining"})
+    return {
+        "status": "ok",
+        "upstream_client_loaded": "novelai_api" in sys.modules
+    }
 
 @app.get("/queue/status")
 async def get_queue_status():
@@ -313,14 +1224,119 @@ async def get_queue_status():
 @app.delete("/queue/clear")
 async def clear_queue():
     """清空队列（仅用于管理）"""
-    # 创建新的队列来替换当前队列
-    old_queue = request_queue.queue
-    request_queue.queue = asyncio.Queue(maxsize=request_queue.max_queue_size)
+    # 原地取出所有排队的任务（包括暂存的交接任务）并标记失败，同步等待者会立即得到错误响应
+    cleared = 0
+    for job in request_queue.take_pending():
+        job.fail("Queue cleared")
+        cleared += 1
 
     # 清理结果存储
     request_results.clear()
 
     return {
         "message": "Queue cleared",
-        "cleared_requests": old_queue.qsize()
+        "cleared_requests": cleared
     }
+
+@app.get("/admin/clients")
+async def client_status(authorization: Optional[str] = Header(None)):
+    """各 API 密钥的限制和当前用量"""
+    require_admin(authorization)
+    return {"enabled": clients.enabled, "clients": clients.status()}
+
+@app.get("/admin/sessions")
+async def upstream_session_status(authorization: Optional[str] = Header(None)):
+    """各账号上游会话的令牌有效期和最近一次保温"""
+    require_admin(authorization)
+    return sessions.status()
+
+@app.get("/admin/accounts")
+async def account_spend(authorization: Optional[str] = Header(None)):
+    """各账号的订阅等级、Anlas 余额和花费"""
+    require_admin(authorization)
+    return ledger.status(accounts.accounts)
+
+@app.get("/admin/png")
+async def png_optimize_status(authorization: Optional[str] = Header(None)):
+    """PNG 后处理的累计统计：处理的图像数、节省的字节和平均耗时"""
+    require_admin(authorization)
+    return {**png_optimizer.status(), "optimize": config.current.png_optimize,
+            "strip_text": config.current.png_strip_text}
+
+@app.get("/admin/hedging")
+async def hedging_status(authorization: Optional[str] = Header(None)):
+    """对冲请求统计和各账号状态"""
+    require_admin(authorization)
+    return {**hedger.status(), "accounts": accounts.status()}
+
+def require_admin(authorization: Optional[str]):
+    """校验管理令牌：请求头 Authorization: Bearer <ADMIN_TOKEN>；未配置 ADMIN_TOKEN 时管理端点不可用"""
+    token = os.environ.get("ADMIN_TOKEN")
+    if not token:
+        raise HTTPException(status_code=403, detail="Set ADMIN_TOKEN to enable this endpoint")
+    if not authorization or not hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token", headers={"WWW-Authenticate": "Bearer"})
+
+def apply_config():
+    """把当前配置应用到运行中的队列；总是按最新配置设置，多次修改先后应用也不会错乱"""
+    settings = config.current
+    request_queue.resize(settings.max_queue_size)
+    request_queue.set_workers(settings.workers)
+    idempotency.window = settings.idempotency_window
+    sessions.set_interval(settings.keep_warm_interval)
+    config_changed.set()
+
+@app.get("/admin/config")
+async def get_config(audit_limit: int = Query(20, ge=0, le=500), authorization: Optional[str] = Header(None)):
+    """当前配置和最近的修改记录（含操作者地址）"""
+    require_admin(authorization)
+    return {
+        "config": config.current.model_dump(),
+        "audit": await asyncio.to_thread(config.audit_log, audit_limit)
+    }
+
+@app.put("/admin/config")
+async def update_config(changes: Dict[str, Any], request: Request, authorization: Optional[str] = Header(None)):
+    """修改运行时配置（只需给出要修改的字段），立即生效，不丢失排队中的任务"""
+    require_admin(authorization)
+    actor = request.client.host if request.client else "unknown"
+    if request.headers.get("X-Admin-User"):
+        actor = f"{request.headers['X-Admin-User']}@{actor}"
+
+    try:
+        new = await asyncio.to_thread(config.update, changes, actor)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False))
+
+    apply_config()
+    print(f"Config updated by {actor}: {changes}")
+    return {"config": new.model_dump()}
+
+@app.post("/admin/drain")
+async def drain(authorization: Optional[str] = Header(None)):
+    """进入排空模式（用于滚动部署），返回交接结果；排空不可撤销，只用于即将退出的进程"""
+    require_admin(authorization)
+    return await drain_server()
+
+@app.get("/admin/egress")
+async def get_egress_status(authorization: Optional[str] = Header(None)):
+    """查看各出口代理的健康状态和延迟（按当前路由优先级排序）"""
+    require_admin(authorization)
+    return get_pool().status()
+
+@app.get("/admin/profile")
+async def profile_process(
+    seconds: float = Query(10.0, gt=0, le=120),
+    interval_ms: float = Query(5.0, ge=1, le=1000),
+    authorization: Optional[str] = Header(None)
+):
+    """对运行中的进程采样 N 秒，返回 folded stacks 格式的火焰图数据"""
+    require_admin(authorization)
+    if profile_lock.locked():
+        raise HTTPException(status_code=409, detail="A profiling session is already running")
+
+    async with profile_lock:
+        # 采样在独立线程中进行，事件循环保持正常服务，其调用栈也会被采到
+        folded = await asyncio.to_thread(sample_stacks, seconds, interval_ms / 1000)
+
+    return PlainTextResponse(folded)
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+模拟 NovelAI 后端，用于回放测试和容量规划
+
+实现登录、图像生成（包括 img2img 和局部重绘）和放大接口，生成的是带 NovelAI 风格元数据的小 PNG（打包在 zip 里），
+耗时按 --latency/--jitter 随机模拟。和真实服务一样，同一账号同时只能生成一张图，并发请求返回 429；
+登录返回 --token-ttl 秒后过期的 JWT 访问令牌，用过期的令牌请求返回 401。
+账号按第一次登录的顺序依次取 --tiers 和 --anlas 中的订阅等级和余额，生成按 v3 的计费公式扣除 Anlas
+（Opus 在 28 步以内、不超过 1024x1024 免费），余额不足时返回 402。
+
+启动服务器时设置 NAI_BASE_URL 指向这里即可：
+
+    python mock_novelai.py --port 8001
+    NAI_BASE_URL=http://127.0.0.1:8001 NAI_USERNAME=mock NAI_PASSWORD=mock uvicorn main:app
+"""
+
+import argparse
+import asyncio
+import base64
+import io
+import json
+import math
+import os
+import random
+import struct
+import time
+import zipfile
+import zlib
+from typing import Optional, Tuple
+
+from aiohttp import web
+
+
+def _chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+
+def make_png(width: int, height: int, text: dict, fill: int = 0, noise: bool = False) -> bytes:
+    """生成一张纯色（noise 时为随机噪点，大小接近真实图像）RGB PNG，附带 tEXt 元数据"""
+    if noise:
+        raw = b"".join(b"\x00" + os.urandom(width * 3) for _ in range(height))
+    else:
+        row = b"\x00" + bytes((fill, (fill * 7) & 0xFF, (fill * 13) & 0xFF)) * width
+        raw = row * height
+    chunks = [_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))]
+    for key, value in text.items():
+        chunks.append(_chunk(b"tEXt", key.encode("latin-1") + b"\x00" + value.encode("latin-1", "replace")))
+    chunks.append(_chunk(b"IDAT", zlib.compress(raw, 1)))
+    chunks.append(_chunk(b"IEND", b""))
+    return b"\x89PNG\r\n\x1a\n" + b"".join(chunks)
+
+
+def zip_response(png: bytes) -> web.Response:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as z:
+        z.writestr("image_0.png", png)
+    return web.Response(body=buffer.getvalue(), content_type="application/x-zip-compressed")
+
+
+class MockNovelAI:
+    def __init__(self, latency: float, jitter: float, size: int, error_rate: float, stall_rate: float = 0.0,
+                 stall: float = 0.0, noise: bool = False, token_ttl: float = 30 * 86400, login_latency: float = 0.0,
+                 tiers: Tuple[int, ...] = (3,), anlas: Tuple[int, ...] = (10000,)):
+        self.latency = latency
+        self.jitter = jitter
+        self.size = size
+        self.error_rate = error_rate
+        self.stall_rate = stall_rate
+        self.stall = stall
+        self.noise = noise
+        self.token_ttl = token_ttl
+        self.login_latency = login_latency
+        self.tiers = tiers
+        self.initial_anlas = anlas
+        self.busy_accounts = set()
+        # 账号 -> [订阅等级, 余额]
+        self.balances = {}
+        self.generated = 0
+        self.logins = 0
+
+    async def login(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        await asyncio.sleep(self.login_latency)
+        self.logins += 1
+        now = time.time()
+        claims = {"sub": f"mock-{body.get('key', '')[:16]}", "iat": now, "exp": now + self.token_ttl}
+        if claims["sub"] not in self.balances:
+            n = len(self.balances)
+            self.balances[claims["sub"]] = [self.tiers[n % len(self.tiers)],
+                                            self.initial_anlas[n % len(self.initial_anlas)]]
+        segments = [base64.urlsafe_b64encode(json.dumps(part).encode()).rstrip(b"=").decode()
+                    for part in ({"alg": "none", "typ": "JWT"}, claims)]
+        return web.json_response({"accessToken": ".".join(segments) + ".mock"}, status=201)
+
+    def _authorize(self, request: web.Request) -> Tuple[str, Optional[web.Response]]:
+        """从访问令牌中取出账号；令牌无效或过期时返回 401，账号正在生成时返回 429"""
+        token = request.headers.get("Authorization", "").removeprefix("Bearer ")
+        try:
+            payload = token.split(".")[1]
+            claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        except (IndexError, ValueError):
+            return "", web.json_response({"statusCode": 401, "message": "Invalid access token"}, status=401)
+        if claims["exp"] < time.time():
+            return "", web.json_response({"statusCode": 401, "message": "Access token expired"}, status=401)
+        if claims["sub"] in self.busy_accounts:
+            return claims["sub"], web.json_response({"statusCode": 429, "message": "Concurrent generation is locked"}, status=429)
+        return claims["sub"], None
+
+    def _balance(self, account: str) -> list:
+        return self.balances.setdefault(account, [self.tiers[0], self.initial_anlas[0]])
+
+    def _insufficient(self, account: str, cost: int) -> Optional[web.Response]:
+        if self._balance(account)[1] < cost:
+            return web.json_response({"statusCode": 402, "message": "Not enough Anlas"}, status=402)
+        return None
+
+    def _generation_cost(self, account: str, params: dict) -> int:
+        tier = self._balance(account)[0]
+        steps = params.get("steps", 28)
+        r = max(65536, params.get("width", 1024) * params.get("height", 1024))
+        if tier == 3 and steps <= 28 and r <= 1024 * 1024:
+            return 0
+        cost = max(math.ceil(2.951823174884865e-6 * r + 5.753298233447344e-7 * r * steps), 2)
+        return math.ceil(cost * params.get("strength", 1.0))
+
+    def _upscale_cost(self, account: str, width: int, height: int) -> int:
+        tier = self._balance(account)[0]
+        pixels = width * height
+        for limit, cost in ((640 * 640, 1), (512 * 1024, 2), (768 * 1024, 3), (1024 * 1024, 5)):
+            if pixels <= limit:
+                break
+        return 0 if tier == 3 and pixels <= 640 * 640 else cost
+
+    async def subscription(self, request: web.Request) -> web.Response:
+        account, error = self._authorize(request)
+        if error is not None and error.status != 429:
+            return error
+        tier, anlas = self._balance(account)
+        return web.json_response({
+            "tier": tier, "active": True, "expiresAt": int(time.time()) + 30 * 86400,
+            "perks": {"maxPriorityActions": 1000, "startPriority": 10, "contextTokens": 8192,
+                      "unlimitedMaxPriority": tier == 3, "moduleTrainingSteps": 10000},
+            "trainingStepsLeft": {"fixedTrainingStepsLeft": anlas, "purchasedTrainingSteps": 0},
+        })
+
+    async def generate_image(self, request: web.Request) -> web.Response:
+        account, error = self._authorize(request)
+        if error is not None:
+            return error
+
+        body = await request.json()
+        params = body.get("parameters", {})
+        # img2img / 局部重绘必须带上底图（和蒙版）
+        action = body.get("action", "generate")
+        missing = [k for k in {"img2img": ("image",), "infill": ("image", "mask")}.get(action, ()) if not params.get(k)]
+        if missing:
+            return web.json_response({"statusCode": 400, "message": f"Missing {', '.join(missing)}"}, status=400)
+        cost = self._generation_cost(account, params)
+        error = self._insufficient(account, cost) or await self._simulate(account)
+        if error is not None:
+            return error
+        self._balance(account)[1] -= cost
+
+        seed = params.get("seed") or random.randint(1, 0xFFFFFFFF)
+        comment = {
+            "prompt": body.get("input", ""),
+            "steps": params.get("steps"),
+            "scale": params.get("scale"),
+            "seed": seed,
+            "uc": params.get("negative_prompt", ""),
+            "sampler": params.get("sampler"),
+        }
+        png = make_png(self.size, self.size, {
+            "Title": "NovelAI generated image",
+            "Description": body.get("input", ""),
+            "Software": "NovelAI",
+            "Source": f"Mock {body.get('model', '')}",
+            "Generation time": f"{time.time():.3f}",
+            "Comment": json.dumps(comment),
+        }, fill=seed & 0xFF, noise=self.noise)
+        self.generated += 1
+        return zip_response(png)
+
+    async def upscale_image(self, request: web.Request) -> web.Response:
+        account, error = self._authorize(request)
+        if error is not None:
+            return error
+
+        body = await request.json()
+        if not body.get("image") or body.get("scale") not in (2, 4):
+            return web.json_response({"statusCode": 400, "message": "Invalid upscale request"}, status=400)
+        cost = self._upscale_cost(account, body["width"], body["height"])
+        error = self._insufficient(account, cost) or await self._simulate(account)
+        if error is not None:
+            return error
+        self._balance(account)[1] -= cost
+
+        scale = body["scale"]
+        png = make_png(body["width"] * scale, body["height"] * scale, {"Software": "NovelAI", "Title": "Upscaled"},
+                       noise=self.noise)
+        self.generated += 1
+        return zip_response(png)
+
+    async def _simulate(self, account: str) -> Optional[web.Response]:
+        """占用账号并等待模拟的耗时，按 error_rate 随机返回 500"""
+        self.busy_accounts.add(account)
+        try:
+            delay = max(0.0, random.uniform(self.latency - self.jitter, self.latency + self.jitter))
+            if random.random() < self.stall_rate:
+                delay += self.stall
+            await asyncio.sleep(delay)
+        finally:
+            self.busy_accounts.discard(account)
+
+        if random.random() < self.error_rate:
+            return web.json_response({"statusCode": 500, "message": "Mock upstream error"}, status=500)
+        return None
+
+    async def root(self, request: web.Request) -> web.Response:
+        return web.Response(text="mock novelai")
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_get("/", self.root)
+        app.router.add_post("/user/login", self.login)
+        app.router.add_get("/user/subscription", self.subscription)
+        app.router.add_post("/ai/generate-image", self.generate_image)
+        app.router.add_post("/ai/upscale", self.upscale_image)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模拟 NovelAI 后端")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=7.5, help="平均生成耗时（秒）")
+    parser.add_argument("--jitter", type=float, default=2.5, help="耗时的随机浮动范围（秒）")
+    parser.add_argument("--size", type=int, default=64, help="生成图片的边长（像素）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="随机返回 500 的比例")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="随机卡顿的请求比例")
+    parser.add_argument("--stall", type=float, default=30.0, help="卡顿请求额外的耗时（秒）")
+    parser.add_argument("--noise", action="store_true", help="生成随机噪点图像（不可压缩，文件大小接近真实图像）")
+    parser.add_argument("--token-ttl", type=float, default=30 * 86400, help="访问令牌的有效期（秒）")
+    parser.add_argument("--login-latency", type=float, default=0.0, help="登录耗时（秒）")
+    parser.add_argument("--tiers", default="3", help="逗号分隔的订阅等级，按登录顺序分给各账号（3 为 Opus）")
+    parser.add_argument("--anlas", default="10000", help="逗号分隔的初始 Anlas 余额，按登录顺序分给各账号")
+    args = parser.parse_args()
+
+    mock = MockNovelAI(args.latency, args.jitter, args.size, args.error_rate, args.stall_rate, args.stall, args.noise,
+                       args.token_ttl, args.login_latency, tuple(int(t) for t in args.tiers.split(",")),
+                       tuple(int(a) for a in args.anlas.split(",")))
+    web.run_app(mock.app(), host=args.host, port=args.port, print=lambda *_: print(f"Mock NovelAI running on http://{args.host}:{args.port}"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+读取 NovelAI 写在 PNG 文本块里的生成参数
+
+参数可以是 PNG 数据，也可以是文件路径；读文件时跳过图像数据块，只读取文本块。
+已经取出的文本块（例如 png_optimize 重新压缩时）用 parse_text_chunks / parse_parameters 解析。
+"""
+
+import json
+import struct
+import zlib
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple, Union
+
+PNG = Union[bytes, Path]
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+TEXT_CHUNKS = (b"tEXt", b"zTXt", b"iTXt")
+
+
+def _iter_chunks_bytes(png: bytes) -> Iterator[Tuple[bytes, bytes]]:
+    view = memoryview(png)
+    offset = len(PNG_SIGNATURE)
+    while offset + 8 <= len(png):
+        length, kind = struct.unpack_from(">I4s", png, offset)
+        data = bytes(view[offset + 8:offset + 8 + length]) if kind in TEXT_CHUNKS else b""
+        offset += 12 + length
+        yield kind, data
+
+
+def _iter_chunks_file(f) -> Iterator[Tuple[bytes, bytes]]:
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        length, kind = struct.unpack(">I4s", header)
+        if kind in TEXT_CHUNKS:
+            data = f.read(length)
+            f.seek(4, 1)
+        else:
+            data = b""
+            f.seek(length + 4, 1)
+        yield kind, data
+
+
+def read_text_chunks(png: PNG) -> Dict[str, str]:
+    """返回 PNG 中所有 tEXt / zTXt / iTXt 文本块，格式不对时返回空字典"""
+    if isinstance(png, Path):
+        with png.open("rb") as f:
+            if f.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+                return {}
+            return parse_text_chunks(_iter_chunks_file(f))
+    if not png.startswith(PNG_SIGNATURE):
+        return {}
+    return parse_text_chunks(_iter_chunks_bytes(png))
+
+
+def parse_text_chunks(chunks: Iterable[Tuple[bytes, bytes]]) -> Dict[str, str]:
+    """解析 (块类型, 块数据)，返回文本块的 关键字 -> 文本"""
+    texts: Dict[str, str] = {}
+    for kind, data in chunks:
+        try:
+            if kind == b"tEXt":
+                key, _, value = data.partition(b"\x00")
+                texts[key.decode("latin-1")] = value.decode("latin-1")
+            elif kind == b"zTXt":
+                key, _, rest = data.partition(b"\x00")
+                texts[key.decode("latin-1")] = zlib.decompress(rest[1:]).decode("latin-1")
+            elif kind == b"iTXt":
+                key, _, rest = data.partition(b"\x00")
+                compressed, rest = rest[0], rest[2:]
+                _, _, rest = rest.partition(b"\x00")  # 语言标签
+                _, _, text = rest.partition(b"\x00")  # 翻译后的关键字
+                texts[key.decode("latin-1")] = (zlib.decompress(text) if compressed else text).decode("utf-8")
+            elif kind == b"IEND":
+                break
+        except (zlib.error, UnicodeDecodeError, IndexError):
+            continue
+
+    return texts
+
+
+def parse_parameters(texts: Dict[str, str]) -> Dict[str, Any]:
+    """NovelAI 把生成参数以 JSON 形式写在 Comment 文本块中"""
+    comment = texts.get("Comment")
+    if not comment:
+        return {}
+    try:
+        params = json.loads(comment)
+    except ValueError:
+        return {}
+    return params if isinstance(params, dict) else {}
+
+
+def parameters_seed(params: Dict[str, Any]) -> Optional[int]:
+    seed = params.get("seed")
+    return int(seed) if isinstance(seed, (int, float)) and seed else None
@@ -0,0 +1,228 @@
+"""
+生成结果的后处理：无损重新压缩 PNG，按配置保留或删除生成参数文本块，并取出元数据
+
+NovelAI 返回的 PNG 压缩率不高，保存的每一份和每次响应都要付出这些字节。重新压缩只处理 IDAT：
+把所有 IDAT 块中的压缩流解压，再用 zlib 按 PNG_OPTIMIZE_LEVEL（默认 6）压缩；扫描行数据（包括每行的过滤类型）逐字节不变，
+解码出的像素完全相同。其他块原样保留，tEXt / zTXt / iTXt 文本块（NovelAI 的生成参数）在
+png_strip_text 打开时删除。重新压缩后没有变小的保留原图。
+
+处理分两步：任务完成前只读取（或删除）文本块，只是一次顺序复制；文本块解析为元数据（png_metadata），
+写入任务和生成历史，查询状态和历史时不必再打开图像文件。重新压缩在任务完成之后进行，写出新文件，
+原图保持不变，不占用处理器和账号。两步都在 PNG_OPTIMIZE_WORKERS 个线程（默认 2）中进行：
+zlib 压缩时释放 GIL，多张图像可以并行；数据按块读写，内存占用与图像大小无关。
+"""
+
+import asyncio
+import os
+import shutil
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Awaitable, Dict, Iterator, List, Optional, Set, Tuple
+
+from png_metadata import PNG_SIGNATURE, TEXT_CHUNKS, parse_parameters, parse_text_chunks, read_text_chunks
+
+CHUNK_SIZE = 64 * 1024
+# 写出的每个 IDAT 块的大小
+IDAT_SIZE = 256 * 1024
+
+
+def _write_chunk(f, kind: bytes, data: bytes):
+    f.write(struct.pack(">I", len(data)) + kind)
+    f.write(data)
+    f.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind)) & 0xFFFFFFFF))
+
+
+def _inflate(decompressor, data: bytes) -> Iterator[bytes]:
+    """分段解压，纯色图像的压缩比可达上千倍，不一次性展开"""
+    while data:
+        yield decompressor.decompress(data, CHUNK_SIZE * 16)
+        data = decompressor.unconsumed_tail
+
+
+def metadata(texts: Dict[str, str]) -> Dict[str, Any]:
+    """文本块中的元数据：Comment 中的生成参数解析为 parameters，其他文本块原样保留"""
+    result: Dict[str, Any] = {key: value for key, value in texts.items() if key != "Comment"}
+    params = parse_parameters(texts)
+    if params:
+        result["parameters"] = params
+    return result
+
+
+def _copy_chunk(src, dst, kind: bytes, length: int):
+    """原样复制一个块（只删除文本块、不重新压缩时）"""
+    dst.write(struct.pack(">I", length) + kind)
+    crc = zlib.crc32(kind)
+    remaining = length
+    while remaining:
+        piece = src.read(min(CHUNK_SIZE, remaining))
+        if not piece:
+            raise ValueError("Truncated PNG file")
+        remaining -= len(piece)
+        crc = zlib.crc32(piece, crc)
+        dst.write(piece)
+    src.seek(4, 1)
+    dst.write(struct.pack(">I", crc & 0xFFFFFFFF))
+
+
+def _rewrite(path: Path, out: Path, strip_text: bool, level: Optional[int]) -> Dict[str, str]:
+    """把 path 重写到 out，返回文本块
+
+    level 不为 None 时按该级别重新压缩 IDAT，为 None 时原样复制；strip_text 时删除文本块。
+    """
+    texts: List[Tuple[bytes, bytes]] = []
+    with path.open("rb") as src, out.open("wb") as dst:
+        if src.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+            raise ValueError("Not a PNG file")
+        dst.write(PNG_SIGNATURE)
+        decompressor = zlib.decompressobj()
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 15, 9) if level is not None else None
+        pending = bytearray()
+        in_idat = False
+        while True:
+            header = src.read(8)
+            if len(header) < 8:
+                raise ValueError("Truncated PNG file")
+            length, kind = struct.unpack(">I4s", header)
+            if kind == b"IDAT" and level is None:
+                _copy_chunk(src, dst, kind, length)
+                continue
+            if kind == b"IDAT":
+                in_idat = True
+                remaining = length
+                while remaining:
+                    piece = src.read(min(CHUNK_SIZE, remaining))
+                    if not piece:
+                        raise ValueError("Truncated PNG file")
+                    remaining -= len(piece)
+                    for raw in _inflate(decompressor, piece):
+                        pending += compressor.compress(raw)
+                    while len(pending) >= IDAT_SIZE:
+                        _write_chunk(dst, b"IDAT", bytes(pending[:IDAT_SIZE]))
+                        del pending[:IDAT_SIZE]
+                src.seek(4, 1)
+                continue
+
+            if in_idat:
+                # IDAT 结束：写出剩余的压缩数据
+                if not decompressor.eof:
+                    raise ValueError("Corrupt image data")
+                pending += compressor.flush()
+                while pending:
+                    _write_chunk(dst, b"IDAT", bytes(pending[:IDAT_SIZE]))
+                    del pending[:IDAT_SIZE]
+                in_idat = False
+
+            data = src.read(length)
+            src.seek(4, 1)
+            if kind in TEXT_CHUNKS:
+                texts.append((kind, data))
+                if strip_text:
+                    continue
+            _write_chunk(dst, kind, data)
+            if kind == b"IEND":
+                break
+
+    return parse_text_chunks(texts)
+
+
+def rewrite(path: Path, strip_text: bool, level: Optional[int] = 6) -> Tuple[Dict[str, str], int]:
+    """重写 path，变小时原地替换，返回文本块和新的文件大小"""
+    tmp = path.with_name(path.name + ".opt")
+    try:
+        texts = _rewrite(path, tmp, strip_text, level)
+        size = tmp.stat().st_size
+        if size < path.stat().st_size:
+            os.replace(tmp, path)
+        else:
+            size = path.stat().st_size
+    finally:
+        tmp.unlink(missing_ok=True)
+    return texts, size
+
+
+def process(path: Path, strip_text: bool) -> Dict[str, Any]:
+    """任务完成前的处理：读取文本块，strip_text 时原地删除；不重新压缩"""
+    original = path.stat().st_size
+    if strip_text:
+        texts, size = rewrite(path, True, None)
+    else:
+        texts, size = read_text_chunks(path), original
+    return {"metadata": metadata(texts), "original_size": original, "size": size, "bytes_saved": original - size}
+
+
+def recompress(path: Path, out: Path, level: int = 6) -> Dict[str, Any]:
+    """按 level 重新压缩 path 写到 out，path 保持不变；没有变小时 out 是原图的副本"""
+    original = path.stat().st_size
+    start = time.perf_counter()
+    try:
+        _rewrite(path, out, False, level)
+        if out.stat().st_size >= original:
+            shutil.copyfile(path, out)
+    except BaseException:
+        out.unlink(missing_ok=True)
+        raise
+    size = out.stat().st_size
+    return {"original_size": original, "size": size, "bytes_saved": original - size,
+            "elapsed": time.perf_counter() - start}
+
+
+class PngOptimizer:
+    """后处理的线程池、任务完成后进行的重新压缩和累计统计"""
+
+    def __init__(self, workers: int = 2, level: int = 6):
+        self.workers = workers
+        self.level = level
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="png")
+        self._pending: Set[asyncio.Task] = set()
+        self.images = 0
+        self.original_bytes = 0
+        self.bytes_saved = 0
+        self.elapsed = 0.0
+        self.stripped_bytes = 0
+
+    @classmethod
+    def from_env(cls) -> "PngOptimizer":
+        return cls(int(os.environ.get("PNG_OPTIMIZE_WORKERS", 2)), int(os.environ.get("PNG_OPTIMIZE_LEVEL", 6)))
+
+    async def process(self, path: Path, strip_text: bool) -> Dict[str, Any]:
+        info = await asyncio.get_running_loop().run_in_executor(self._executor, process, path, strip_text)
+        self.stripped_bytes += info["bytes_saved"]
+        return info
+
+    async def recompress(self, path: Path, out: Path) -> Dict[str, Any]:
+        loop = asyncio.get_running_loop()
+        info = await loop.run_in_executor(self._executor, recompress, path, out, self.level)
+        self.images += 1
+        self.original_bytes += info["original_size"]
+        self.bytes_saved += info["bytes_saved"]
+        self.elapsed += info["elapsed"]
+        return info
+
+    def submit(self, work: Awaitable):
+        """在后台运行任务完成后的处理；关闭前由 wait_pending 等待"""
+        task = asyncio.ensure_future(work)
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def wait_pending(self, timeout: float):
+        if self._pending:
+            await asyncio.wait(set(self._pending), timeout=timeout)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "level": self.level,
+            "images": self.images,
+            "original_bytes": self.original_bytes,
+            "bytes_saved": self.bytes_saved,
+            "saved_ratio": round(self.bytes_saved / self.original_bytes, 4) if self.original_bytes else None,
+            "avg_ms": round(self.elapsed / self.images * 1000, 1) if self.images else None,
+            "pending": len(self._pending),
+            "stripped_bytes": self.stripped_bytes,
+        }
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,40 @@
+"""
+采样分析器：在运行中的进程里定时抓取所有线程的调用栈，输出 folded stacks 格式
+
+输出的每一行形如 ``线程名;模块:函数:行号;... 次数``，
+可以直接交给 flamegraph.pl、speedscope 或 inferno 生成火焰图。
+"""
+
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    module = frame.f_globals.get("__name__", "?")
+    return f"{module}:{code.co_name}:{frame.f_lineno}"
+
+
+def sample_stacks(seconds: float, interval: float = 0.005) -> str:
+    """阻塞采样 seconds 秒，返回 folded stacks 文本（应在独立线程中调用）"""
+    counts: Counter = Counter()
+    own_id = threading.get_ident()
+    deadline = time.monotonic() + seconds
+
+    while time.monotonic() < deadline:
+        names: Dict[int, str] = {t.ident: t.name for t in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            counts[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+
+    return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
@@ -0,0 +1,70 @@
+"""
+提示词 token 长度预检：入队前用 novelai_api 自带的 CLIP 分词器计算 prompt 和 negative_prompt 的 token 数
+
+novelai_api 只带了 CLIP 分词器。V1-V3 模型本身使用 CLIP（3 段 x 75 = 225 个 token）；
+V4/V4.5 使用 T5（512 个 token），其分词器没有随 novelai_api 发布，这里同样用 CLIP 计数作为近似。
+"""
+
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+CLIP_TOKEN_LIMIT = 225
+T5_TOKEN_LIMIT = 512
+
+
+def token_limit(model: str) -> int:
+    return T5_TOKEN_LIMIT if model.startswith(("Anime_v4", "Inpainting_Anime_v4")) else CLIP_TOKEN_LIMIT
+
+
+class PromptTokenizer:
+    """分词器只加载一次，最近计数过的文本保存在 LRU 中（轮询重复提交同一提示词很常见）"""
+
+    def __init__(self, cache_size: int = 1024):
+        self.cache_size = cache_size
+        self._tokenizer = None
+        self._cache: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._tokenizer is not None
+
+    def load(self):
+        """加载分词器（导入 novelai_api 需要一两秒，由 lifespan 在线程中预先调用）"""
+        if self._tokenizer is not None:
+            return
+        # 在锁内导入，预加载线程和请求不会同时导入 novelai_api
+        with self._load_lock:
+            if self._tokenizer is None:
+                from novelai_api.tokenizers.simple_tokenizer import SimpleTokenizer
+
+                self._tokenizer = SimpleTokenizer()
+
+    def count(self, text: str) -> int:
+        with self._lock:
+            cached = self._cache.get(text)
+            if cached is not None:
+                self._cache.move_to_end(text)
+                return cached
+        self.load()
+        tokens = len(self._tokenizer.encode(text))
+        with self._lock:
+            self._cache[text] = tokens
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return tokens
+
+    def truncate(self, text: str, limit: int) -> Optional[str]:
+        """按逗号分隔的标签从末尾截断到 limit 个 token 以内；第一个标签就超长时返回 None"""
+        tags: List[str] = text.split(",")
+        # token 数随保留的标签数单调增加，二分查找最多能保留几个
+        lo, hi = 0, len(tags)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.count(",".join(tags[:mid])) <= limit:
+                lo = mid
+            else:
+                hi = mid - 1
+        return ",".join(tags[:lo]) if lo else None
@@ -0,0 +1,161 @@
+"""
+出口代理池：在多个代理（以及直连）之间选择最健康、延迟最低的出口，并在连接失败时切换
+
+配置（环境变量）:
+    PROXY_URLS              逗号分隔的代理地址，``direct`` 表示直连，默认 http://127.0.0.1:7897
+    PROXY_CHECK_URL         健康检查访问的地址，默认 https://image.novelai.net/
+    PROXY_CHECK_INTERVAL    健康检查间隔（秒），默认 30
+    PROXY_CHECK_TIMEOUT     单次健康检查超时（秒），默认 5
+"""
+
+import asyncio
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from urllib.parse import urlsplit, urlunsplit
+
+from aiohttp import ClientConnectorError, ClientProxyConnectionError, ClientSession, ClientTimeout
+
+from envfile import load_dotenv
+
+DEFAULT_PROXY_URL = "http://127.0.0.1:7897"
+
+# 只有连接阶段的失败才会换出口重试：此时请求还没有发到 NovelAI，不会重复扣费
+FAILOVER_ERRORS = (ClientProxyConnectionError, ClientConnectorError)
+
+
+def redact(url: str) -> str:
+    """去掉代理地址中的用户名和密码，用于日志和状态输出"""
+    parts = urlsplit(url)
+    if "@" not in parts.netloc:
+        return url
+    return urlunsplit(parts._replace(netloc="***@" + parts.netloc.rsplit("@", 1)[1]))
+
+
+class Egress:
+    """一个出口：代理地址，或 None 表示直连"""
+
+    def __init__(self, proxy: Optional[str]):
+        self.proxy = proxy
+        self.healthy = True
+        self.latency: Optional[float] = None
+        self.failures = 0
+        self.last_checked: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    @property
+    def name(self) -> str:
+        """显示用的名称，不含代理的登录凭据"""
+        return redact(self.proxy) if self.proxy else "direct"
+
+    def mark_success(self, latency: Optional[float] = None):
+        self.healthy = True
+        self.failures = 0
+        self.last_error = None
+        if latency is not None:
+            # 指数加权平均，避免单次抖动改变路由
+            self.latency = latency if self.latency is None else 0.7 * self.latency + 0.3 * latency
+
+    def mark_failure(self, error: str):
+        self.healthy = False
+        self.failures += 1
+        self.last_error = error
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "egress": self.name,
+            "healthy": self.healthy,
+            "latency_ms": round(self.latency * 1000, 1) if self.latency is not None else None,
+            "failures": self.failures,
+            "last_checked": self.last_checked,
+            "last_error": self.last_error,
+        }
+
+
+class ProxyPool:
+    """出口代理池"""
+
+    def __init__(self, proxies: List[Optional[str]], check_url: str = "https://image.novelai.net/",
+                 check_interval: float = 30.0, check_timeout: float = 5.0):
+        if not proxies:
+            raise ValueError("At least one egress is required")
+        self.egresses = [Egress(p) for p in proxies]
+        self.check_url = check_url
+        self.check_interval = check_interval
+        self.check_timeout = check_timeout
+
+    @classmethod
+    def from_env(cls) -> "ProxyPool":
+        load_dotenv()
+        raw = os.environ.get("PROXY_URLS", DEFAULT_PROXY_URL)
+        proxies = [None if p.strip() == "direct" else p.strip() for p in raw.split(",") if p.strip()]
+        return cls(
+            proxies,
+            check_url=os.environ.get("PROXY_CHECK_URL", "https://image.novelai.net/"),
+            check_interval=float(os.environ.get("PROXY_CHECK_INTERVAL", 30)),
+            check_timeout=float(os.environ.get("PROXY_CHECK_TIMEOUT", 5)),
+        )
+
+    def ordered(self) -> List[Egress]:
+        """按优先级排列的出口：健康的在前，其中延迟低的在前；不健康的留作最后手段"""
+        return sorted(self.egresses, key=lambda e: (not e.healthy, e.failures,
+                                                    e.latency if e.latency is not None else float("inf")))
+
+    async def request(self, send: Callable[..., Awaitable[Any]], method: str, url, **kwargs):
+        """通过最优出口发送请求，连接失败时依次换下一个出口"""
+        if "proxy" in kwargs:
+            return await send(method, url, **kwargs)
+
+        last_error = None
+        for egress in self.ordered():
+            try:
+                response = await send(method, url, proxy=egress.proxy, **kwargs)
+            except FAILOVER_ERRORS as e:
+                egress.mark_failure(f"{type(e).__name__}: {e}")
+                print(f"Egress {egress.name} failed, trying next: {e}")
+                last_error = e
+                continue
+            if not egress.healthy:
+                egress.mark_success()
+            return response
+        raise last_error
+
+    async def check(self, session: ClientSession, egress: Egress):
+        start = time.perf_counter()
+        egress.last_checked = time.time()
+        try:
+            async with session.head(self.check_url, proxy=egress.proxy, allow_redirects=False,
+                                    timeout=ClientTimeout(total=self.check_timeout)):
+                pass
+        except Exception as e:
+            egress.mark_failure(f"{type(e).__name__}: {e}")
+            return
+        # 任何 HTTP 响应都说明出口可用，状态码不重要
+        egress.mark_success(time.perf_counter() - start)
+
+    async def check_all(self):
+        async with ClientSession() as session:
+            await asyncio.gather(*(self.check(session, e) for e in self.egresses))
+
+    async def run(self):
+        """后台任务：定期主动检查所有出口"""
+        while True:
+            try:
+                await self.check_all()
+            except Exception as e:
+                print(f"Proxy health check error: {e}")
+            await asyncio.sleep(self.check_interval)
+
+    def status(self) -> List[Dict[str, Any]]:
+        return [e.to_dict() for e in self.ordered()]
+
+
+_pool: Optional[ProxyPool] = None
+
+
+def get_pool() -> ProxyPool:
+    """进程内共享的代理池，第一次使用时按环境变量创建"""
+    global _pool
+    if _pool is None:
+        _pool = ProxyPool.from_env()
+    return _pool
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+流量回放工具 - 按捕获日志中的到达间隔重新发出请求，并统计延迟分布
+
+    # 针对已在运行的服务器，按原速回放
+    python replay_traffic.py results/capture.jsonl --target http://localhost:8000
+
+    # 自动启动 mock 后端和一个服务器实例，以 10 倍速回放
+    python replay_traffic.py results/capture.jsonl --launch --speed 10
+
+--speed 0 表示不等待到达间隔，尽快发出全部请求。
+img2img / 局部重绘 / 放大请求以 POST JSON 回放，引用的输入图像需要已经上传到目标服务器（PUT /inputs），
+否则返回 422。
+"""
+
+import argparse
+import asyncio
+import os
+import re
+import subprocess
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+
+from traffic_capture import load_capture
+
+# 以图像为输入的端点只接受 POST，参数放在 JSON 请求体中
+JSON_ENDPOINTS = re.compile(r"^/generate/(img2img|inpaint|upscale)/")
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def query_params(params: Dict[str, Any]) -> Dict[str, Any]:
+    """捕获的参数转换为查询参数：去掉 None，布尔值写成 true / false（yarl 不接受 bool）"""
+    return {k: ("true" if v else "false") if isinstance(v, bool) else v for k, v in params.items() if v is not None}
+
+
+async def replay_one(session: aiohttp.ClientSession, target: str, record: Dict[str, Any],
+                     poll_interval: float) -> Dict[str, Any]:
+    """发出一个请求；异步接口会轮询到完成为止，延迟按端到端计算"""
+    endpoint = record["endpoint"]
+    if JSON_ENDPOINTS.match(endpoint):
+        body = {k: v for k, v in record["params"].items() if v is not None}
+        request = session.post(f"{target}{endpoint}", json=body)
+    else:
+        request = session.get(f"{target}{endpoint}", params=query_params(record["params"]))
+    start = time.time()
+    try:
+        async with request as resp:
+            status = resp.status
+            body = await resp.read()
+            if status != 200 or not endpoint.endswith("/async"):
+                return {"endpoint": endpoint, "status": status, "latency": time.time() - start}
+            request_id = (await resp.json())["request_id"] if body else None
+
+        while True:
+            await asyncio.sleep(poll_interval)
+            async with session.get(f"{target}/status/{request_id}") as resp:
+                if resp.status != 200:
+                    return {"endpoint": endpoint, "status": resp.status, "latency": time.time() - start}
+                state = (await resp.json())["status"]
+            if state in ("completed", "failed"):
+                return {"endpoint": endpoint, "status": 200 if state == "completed" else 500,
+                        "latency": time.time() - start}
+    except aiohttp.ClientError as e:
+        return {"endpoint": endpoint, "status": type(e).__name__, "latency": time.time() - start}
+
+
+async def replay(records: List[Dict[str, Any]], target: str, speed: float, poll_interval: float) -> List[Dict[str, Any]]:
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=None)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        tasks = []
+        origin = records[0]["ts"]
+        start = time.monotonic()
+        for record in records:
+            if speed > 0:
+                delay = (record["ts"] - origin) / speed - (time.monotonic() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(replay_one(session, target, record, poll_interval)))
+        return await asyncio.gather(*tasks)
+
+
+def report(results: List[Dict[str, Any]], wall_time: float):
+    print(f"\n=== 回放结果: {len(results)} 个请求, 用时 {wall_time:.1f}秒 ===")
+    print("状态码分布:", dict(Counter(str(r["status"]) for r in results)))
+
+    for endpoint in sorted({r["endpoint"] for r in results}):
+        latencies = [r["latency"] for r in results if r["endpoint"] == endpoint and r["status"] == 200]
+        if not latencies:
+            print(f"{endpoint}: 没有成功的请求")
+            continue
+        print(f"{endpoint}: 成功 {len(latencies)} 个")
+        print(f"  p50={percentile(latencies, 50):.2f}s  p90={percentile(latencies, 90):.2f}s  "
+              f"p99={percentile(latencies, 99):.2f}s  max={max(latencies):.2f}s")
+    if wall_time > 0:
+        ok = sum(1 for r in results if r["status"] == 200)
+        print(f"吞吐量: {ok / wall_time:.2f} 张/秒")
+
+
+def launch(server_port: int, mock_port: int, latency: float, jitter: float) -> List[subprocess.Popen]:
+    """启动 mock 后端和一个指向它的服务器实例"""
+    here = Path(__file__).resolve().parent
+    mock = subprocess.Popen([sys.executable, str(here / "mock_novelai.py"), "--port", str(mock_port),
+                             "--latency", str(latency), "--jitter", str(jitter)], cwd=here)
+    env = dict(os.environ, NAI_BASE_URL=f"http://127.0.0.1:{mock_port}")
+    env.setdefault("NAI_USERNAME", "replay@example.com")
+    env.setdefault("NAI_PASSWORD", "replay")
+    env.pop("CAPTURE_FILE", None)
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(server_port),
+                               "--log-level", "warning"], cwd=here, env=env)
+    return [server, mock]
+
+
+async def wait_ready(target: str, timeout: float = 30.0):
+    deadline = time.time() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.time() < deadline:
+            try:
+                async with session.get(f"{target}/queue/status") as resp:
+                    if resp.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"Server at {target} did not become ready")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="回放捕获的请求流量")
+    parser.add_argument("capture", type=Path, help="捕获文件（CAPTURE_FILE）")
+    parser.add_argument("--target", default="http://localhost:8000")
+    parser.add_argument("--speed", type=float, default=1.0, help="回放倍速，0 表示尽快发出")
+    parser.add_argument("--limit", type=int, default=None, help="只回放前 N 个请求")
+    parser.add_argument("--poll-interval", type=float, default=0.5, help="异步请求的轮询间隔（秒）")
+    parser.add_argument("--launch", action="store_true", help="自动启动 mock 后端和服务器")
+    parser.add_argument("--server-port", type=int, default=8100)
+    parser.add_argument("--mock-port", type=int, default=8101)
+    parser.add_argument("--mock-latency", type=float, default=7.5)
+    parser.add_argument("--mock-jitter", type=float, default=2.5)
+    args = parser.parse_args()
+
+    records = load_capture(args.capture)[:args.limit]
+    if not records:
+        print("捕获文件中没有请求")
+        return
+
+    processes: Optional[List[subprocess.Popen]] = None
+    target = args.target
+    if args.launch:
+        target = f"http://127.0.0.1:{args.server_port}"
+        processes = launch(args.server_port, args.mock_port, args.mock_latency, args.mock_jitter)
+
+    try:
+        if processes:
+            await wait_ready(target)
+        image_jobs = sum(1 for r in records if JSON_ENDPOINTS.match(r["endpoint"]))
+        if image_jobs:
+            print(f"注意: {image_jobs} 个请求引用了输入图像，目标服务器上没有这些图像时返回 422")
+        span = records[-1]["ts"] - records[0]["ts"]
+        print(f"回放 {len(records)} 个请求（原始时长 {span:.1f}秒，倍速 {args.speed or '最快'}）-> {target}")
+        start = time.time()
+        results = await replay(records, target, args.speed, args.poll_interval)
+        report(results, time.time() - start)
+    finally:
+        for p in processes or []:
+            p.terminate()
+            p.wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,85 @@
+"""
+生成结果缓存：按生成参数（包括确定的 seed）的哈希保存在 results/cache/ 下
+
+哪些键存在由 result_index.ResultIndex 记录，启动时不扫描目录。
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from result_index import IndexEntry, ResultIndex
+
+# 参与缓存键计算的参数，顺序无关
+CACHE_KEY_FIELDS = ("prompt", "negative_prompt", "guidance_scale", "seed", "model", "steps", "resolution")
+# 以图像为输入的任务还包括任务类型和输入；只在存在时加入，文生图的缓存键不变
+INPUT_KEY_FIELDS = ("kind", "image", "mask", "strength", "noise", "scale")
+
+
+def cache_key(params: Dict[str, Any]) -> str:
+    payload = {k: params.get(k) for k in CACHE_KEY_FIELDS}
+    payload.update({k: params[k] for k in INPUT_KEY_FIELDS if params.get(k) is not None})
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """磁盘上的结果缓存，索引在第一次使用时（或由 lifespan 提前）在线程中打开"""
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.index = ResultIndex(directory)
+        self._open_lock = asyncio.Lock()
+
+    def path(self, key: str) -> Path:
+        return self.directory / f"{key}.png"
+
+    async def open(self):
+        if self.index.opened:
+            return
+        async with self._open_lock:
+            if not self.index.opened:
+                await asyncio.to_thread(self.index.open)
+
+    async def lookup(self, key: str) -> Optional[IndexEntry]:
+        await self.open()
+        return self.index.get(key)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        if await self.lookup(key) is None:
+            return None
+        try:
+            return await asyncio.to_thread(self.path(key).read_bytes)
+        except FileNotFoundError:
+            return None
+
+    async def get_path(self, key: str) -> Optional[Path]:
+        """缓存文件的路径，不读取内容（响应直接从文件发送）"""
+        if await self.lookup(key) is None:
+            return None
+        path = self.path(key)
+        return path if path.exists() else None
+
+    async def put_file(self, key: str, src: Path, seed: int = 0) -> Path:
+        """把已写好的文件（同一文件系统上的临时文件）改名为缓存文件，返回缓存路径
+
+        键已存在时删除 src，返回已有的文件。
+        """
+        path = self.path(key)
+        if await self.lookup(key) is not None and path.exists():
+            src.unlink(missing_ok=True)
+            return path
+        size = src.stat().st_size
+        os.replace(src, path)
+        self.index.add(key, seed, size)
+        return path
+
+    async def maybe_compact(self):
+        """追加日志超过阈值时合并索引"""
+        if self.index.opened and self.index.tail_size >= self.index.compact_threshold:
+            await asyncio.to_thread(self.index.compact)
+
+    def close(self):
+        self.index.close()
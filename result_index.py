@@ -0,0 +1,175 @@
+"""
+结果缓存的磁盘索引：参数哈希 -> 元数据，重启后无需扫描 results/cache/ 目录
+
+由两个定长记录文件组成:
+    index.sorted    按哈希排序，用 mmap 打开后二分查找，打开耗时与记录数无关
+    index.log       新记录追加写入，打开时读入内存；超过阈值后合并进 index.sorted
+
+每条记录 52 字节：sha256 摘要(32) + seed(4) + 文件大小(8) + 创建时间(8)。
+"""
+
+import heapq
+import mmap
+import os
+import struct
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterator, NamedTuple, Optional, Tuple
+
+RECORD = struct.Struct("<32sIQd")
+
+
+class IndexEntry(NamedTuple):
+    seed: int
+    size: int
+    created_at: float
+
+
+class ResultIndex:
+    """mmap 排序段 + 追加日志的结果索引"""
+
+    def __init__(self, directory: Path, compact_threshold: int = 10000):
+        self.directory = directory
+        self.sorted_path = directory / "index.sorted"
+        self.log_path = directory / "index.log"
+        self.compact_threshold = compact_threshold
+        self._lock = threading.Lock()
+        self._sorted_file = None
+        self._sorted: Optional[mmap.mmap] = None
+        self._sorted_count = 0
+        self._tail: Dict[bytes, Tuple[int, int, float]] = {}
+        self._log = None
+        self.opened = False
+
+    def open(self):
+        """打开索引：映射排序段并读入追加日志（只读取自上次合并以来的新记录）"""
+        with self._lock:
+            if self.opened:
+                return
+            self.directory.mkdir(parents=True, exist_ok=True)
+            if not self.sorted_path.exists() and not self.log_path.exists():
+                self._migrate_directory()
+            self._map_sorted()
+            if self.log_path.exists():
+                data = self.log_path.read_bytes()
+                # 截掉崩溃时可能残留的半条记录
+                usable = len(data) - len(data) % RECORD.size
+                for digest, seed, size, created_at in RECORD.iter_unpack(data[:usable]):
+                    self._tail[digest] = (seed, size, created_at)
+                if usable != len(data):
+                    with self.log_path.open("r+b") as f:
+                        f.truncate(usable)
+            self._log = self.log_path.open("ab")
+            self.opened = True
+
+    def _migrate_directory(self):
+        """第一次使用索引时，把已有的缓存文件登记进日志"""
+        with self.log_path.open("ab") as log:
+            for path in self.directory.glob("*.png"):
+                stat = path.stat()
+                log.write(RECORD.pack(bytes.fromhex(path.stem), 0, stat.st_size, stat.st_mtime))
+
+    def _map_sorted(self):
+        if self._sorted is not None:
+            self._sorted.close()
+            self._sorted_file.close()
+            self._sorted = self._sorted_file = None
+        self._sorted_count = 0
+        if self.sorted_path.exists() and self.sorted_path.stat().st_size >= RECORD.size:
+            self._sorted_file = self.sorted_path.open("rb")
+            self._sorted = mmap.mmap(self._sorted_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._sorted_count = len(self._sorted) // RECORD.size
+
+    def _search_sorted(self, digest: bytes) -> Optional[Tuple[int, int, float]]:
+        lo, hi = 0, self._sorted_count
+        mm = self._sorted
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = mid * RECORD.size
+            probe = mm[offset:offset + 32]
+            if probe < digest:
+                lo = mid + 1
+            elif probe > digest:
+                hi = mid
+            else:
+                return RECORD.unpack_from(mm, offset)[1:]
+        return None
+
+    def get(self, key: str) -> Optional[IndexEntry]:
+        digest = bytes.fromhex(key)
+        with self._lock:
+            found = self._tail.get(digest)
+            if found is None and self._sorted is not None:
+                found = self._search_sorted(digest)
+        return IndexEntry(*found) if found is not None else None
+
+    def add(self, key: str, seed: int, size: int):
+        digest = bytes.fromhex(key)
+        record = (seed, size, time.time())
+        with self._lock:
+            self._log.write(RECORD.pack(digest, *record))
+            self._log.flush()
+            self._tail[digest] = record
+
+    @property
+    def tail_size(self) -> int:
+        return len(self._tail)
+
+    def __len__(self) -> int:
+        # 近似值：合并前日志中的记录可能与排序段重复
+        return self._sorted_count + len(self._tail)
+
+    def _iter_sorted(self) -> Iterator[Tuple[bytes, int, int, float]]:
+        if self._sorted is None:
+            return iter(())
+        return RECORD.iter_unpack(self._sorted[:self._sorted_count * RECORD.size])
+
+    def compact(self):
+        """把追加日志合并进排序段；合并期间的新记录保留在新日志中"""
+        with self._lock:
+            if not self._tail:
+                return
+            snapshot = dict(self._tail)
+            log_position = self._log.tell()
+
+        # 归并两个有序序列，同一个键以日志中的为准
+        tail_records = sorted((d, *v) for d, v in snapshot.items())
+        merged = heapq.merge(tail_records, self._iter_sorted(), key=lambda r: r[0])
+        tmp = self.sorted_path.with_name("index.sorted.tmp")
+        with tmp.open("wb") as f:
+            previous = None
+            for record in merged:
+                if record[0] == previous:
+                    continue
+                previous = record[0]
+                f.write(RECORD.pack(*record))
+            f.flush()
+            os.fsync(f.fileno())
+
+        with self._lock:
+            self._log.flush()
+            with self.log_path.open("rb") as f:
+                f.seek(log_position)
+                newer = f.read()
+            os.replace(tmp, self.sorted_path)
+            self._map_sorted()
+
+            # 只保留合并开始后写入的记录
+            self._log.close()
+            log_tmp = self.log_path.with_name("index.log.tmp")
+            log_tmp.write_bytes(newer)
+            os.replace(log_tmp, self.log_path)
+            self._log = self.log_path.open("ab")
+            self._tail = {d: (s, z, c) for d, s, z, c in RECORD.iter_unpack(newer)}
+
+    def close(self):
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+            if self._sorted is not None:
+                self._sorted.close()
+                self._sorted_file.close()
+                self._sorted = self._sorted_file = None
+            self.opened = False
@@ -0,0 +1,115 @@
+"""
+运行时配置：队列长度、处理器数量、生成默认值、结果保留时间、幂等键有效期、上游保温间隔和 PNG 后处理
+
+启动时依次读取默认值、配置文件（CONFIG_FILE，默认 config.json）和环境变量，后者覆盖前者。
+运行中通过 PUT /admin/config 修改（需要 ADMIN_TOKEN），修改写回配置文件并追加到审计日志。
+每次修改都生成一个新的不可变 ServerConfig 并整体替换，读取方拿到的总是一份完整一致的配置。
+"""
+
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+from pydantic import BaseModel, ConfigDict, Field, ValidationInfo, field_validator
+
+# 字段对应的环境变量
+ENV_VARS = {
+    "max_queue_size": "QUEUE_MAX_SIZE",
+    "workers": "QUEUE_WORKERS",
+    "steps": "DEFAULT_STEPS",
+    "resolution": "DEFAULT_RESOLUTION",
+    "retention": "RESULT_RETENTION",
+    "cleanup_interval": "CLEANUP_INTERVAL",
+    "idempotency_window": "IDEMPOTENCY_WINDOW",
+    "keep_warm_interval": "KEEP_WARM_INTERVAL",
+    "png_optimize": "PNG_OPTIMIZE",
+    "png_strip_text": "PNG_STRIP_TEXT",
+}
+
+
+class ServerConfig(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
+    max_queue_size: int = Field(10, ge=1, le=10000)
+    # 并发处理器数量；超过账号数量的处理器会等待空闲账号
+    workers: int = Field(1, ge=1, le=32)
+    steps: int = Field(28, ge=1, le=50)
+    resolution: str = "Normal_Square_v3"
+    # 内存中保留任务结果的时间（秒）和清理间隔（秒）
+    retention: float = Field(3600, gt=0)
+    cleanup_interval: float = Field(600, gt=0)
+    # Idempotency-Key 的有效期（秒）
+    idempotency_window: float = Field(86400, gt=0)
+    # 上游保温（刷新令牌、保持连接）的间隔（秒），0 表示关闭
+    keep_warm_interval: float = Field(30, ge=0)
+    # 生成结果无损重新压缩；删除 PNG 中的生成参数文本块（见 png_optimize.py）
+    png_optimize: bool = False
+    png_strip_text: bool = False
+
+    @field_validator("resolution")
+    @classmethod
+    def check_resolution(cls, value: str, info: ValidationInfo) -> str:
+        # 启动时不检查，避免为此导入 novelai_api；运行中修改时检查
+        if info.context and info.context.get("check_resolution"):
+            from novelai_api.ImagePreset import ImageResolution
+
+            if value not in ImageResolution.__members__:
+                raise ValueError("Invalid resolution name")
+        return value
+
+
+class ConfigStore:
+    def __init__(self, path: Path, audit_path: Path):
+        self.path = path
+        self.audit_path = audit_path
+        self._lock = threading.Lock()
+        self.current = self.load()
+
+    @classmethod
+    def from_env(cls, audit_path: Path) -> "ConfigStore":
+        return cls(Path(os.environ.get("CONFIG_FILE", "config.json")), audit_path)
+
+    def load(self) -> ServerConfig:
+        values: Dict[str, Any] = {}
+        if self.path.exists():
+            values.update(json.loads(self.path.read_text(encoding="utf-8")))
+        for field, var in ENV_VARS.items():
+            if var in os.environ:
+                values[field] = os.environ[var]
+        return ServerConfig(**values)
+
+    def update(self, changes: Dict[str, Any], actor: str) -> ServerConfig:
+        """校验并替换配置，返回新配置；校验失败时抛出 ValidationError，配置不变"""
+        with self._lock:
+            old = self.current
+            new = ServerConfig.model_validate({**old.model_dump(), **changes}, context={"check_resolution": True})
+            diff = {k: [getattr(old, k), getattr(new, k)] for k in ServerConfig.model_fields
+                    if getattr(old, k) != getattr(new, k)}
+            if not diff:
+                return old
+
+            self.current = new
+            self._save(new)
+            self._audit({"time": time.time(), "actor": actor, "changes": diff})
+        return new
+
+    def _save(self, config: ServerConfig):
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(json.dumps(config.model_dump(), indent=2, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, self.path)
+
+    def _audit(self, entry: Dict[str, Any]):
+        self.audit_path.parent.mkdir(parents=True, exist_ok=True)
+        with self.audit_path.open("a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def audit_log(self, limit: int = 50) -> List[Dict[str, Any]]:
+        """最近的修改记录，新的在前"""
+        if limit <= 0 or not self.audit_path.exists():
+            return []
+        with self.audit_path.open("r", encoding="utf-8") as f:
+            lines = f.readlines()[-limit:]
+        return [json.loads(line) for line in reversed(lines)]
@@ -1,27 +1,80 @@
 #!/usr/bin/env python3
 """
 启动 NovelAI 队列服务器
+
+开发模式（默认）开启自动重载；生产模式用 --prod 或 SERVER_MODE=production 选择：
+关闭重载，可用时使用 uvloop 和 httptools，并可配置进程数、backlog、keep-alive 和并发上限。
 """
 
-import uvicorn
-import sys
+import argparse
+import importlib.util
 import os
+import sys
+
+import uvicorn
+
+
+def _env_int(name: str, default):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="启动 NovelAI 请求队列服务器")
+    parser.add_argument("--prod", action="store_true", default=os.environ.get("SERVER_MODE") == "production",
+                        help="生产模式（也可设置 SERVER_MODE=production）")
+    parser.add_argument("--host", default=os.environ.get("SERVER_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=_env_int("SERVER_PORT", 8000))
+    parser.add_argument("--workers", type=int, default=_env_int("SERVER_WORKERS", 1),
+                        help="进程数；每个进程有独立的队列，同一账号请保持 1")
+    parser.add_argument("--backlog", type=int, default=_env_int("SERVER_BACKLOG", 2048))
+    parser.add_argument("--keep-alive", type=int, default=_env_int("SERVER_KEEP_ALIVE", 30),
+                        help="HTTP keep-alive 超时（秒）")
+    parser.add_argument("--limit-concurrency", type=int, default=_env_int("SERVER_LIMIT_CONCURRENCY", None),
+                        help="最大并发连接数，超过后返回 503")
+    return parser.parse_args()
+
+
+def production_options(args) -> dict:
+    """生产模式下的 uvicorn 参数"""
+    has_uvloop = importlib.util.find_spec("uvloop") is not None
+    has_httptools = importlib.util.find_spec("httptools") is not None
+    return {
+        "reload": False,
+        "workers": args.workers,
+        "loop": "uvloop" if has_uvloop else "asyncio",
+        "http": "httptools" if has_httptools else "h11",
+        "backlog": args.backlog,
+        "timeout_keep_alive": args.keep_alive,
+        "limit_concurrency": args.limit_concurrency,
+        "access_log": False,
+        "log_level": "warning",
+    }
+
 
 def main():
     """启动服务器"""
-    print("启动 NovelAI 请求队列服务器...")
-    print("服务器将运行在: http://localhost:8000")
-    print("API 文档: http://localhost:8000/docs")
-    print("队列状态: http://localhost:8000/queue/status")
+    args = parse_args()
+
+    if args.prod:
+        options = production_options(args)
+        print("启动 NovelAI 请求队列服务器（生产模式）...")
+        print(f"事件循环: {options['loop']}, HTTP 解析器: {options['http']}, 进程数: {options['workers']}")
+    else:
+        options = {"reload": True, "log_level": "info"}
+        print("启动 NovelAI 请求队列服务器...")
+
+    print(f"服务器将运行在: http://localhost:{args.port}")
+    print(f"API 文档: http://localhost:{args.port}/docs")
+    print(f"队列状态: http://localhost:{args.port}/queue/status")
     print("\n按 Ctrl+C 停止服务器")
-    
+
     try:
         uvicorn.run(
             "main:app",
-            host="0.0.0.0",
-            port=8000,
-            reload=True,
-            log_level="info"
+            host=args.host,
+            port=args.port,
+            **options
         )
     except KeyboardInterrupt:
         print("\n服务器已停止")
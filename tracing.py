@@ -0,0 +1,220 @@
+"""
+请求追踪：为每个任务记录各阶段的 span，按头部采样导出为 JSONL 或 OTLP/JSON 文件
+
+配置（环境变量）:
+    TRACE_SAMPLE_RATE   采样率 0.0~1.0，默认 0（关闭）
+    TRACE_FORMAT        导出格式 jsonl / otlp，默认 jsonl
+    TRACE_FILE          导出文件路径，默认 results/traces.jsonl
+"""
+
+import contextvars
+import json
+import os
+import random
+import secrets
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+SERVICE_NAME = "novelai-local-api"
+
+# 当前任务所属的 trace，由端点和队列处理器设置
+_current_trace: contextvars.ContextVar[Optional["Trace"]] = contextvars.ContextVar("current_trace", default=None)
+_current_span_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("current_span_id", default=None)
+
+
+class Span:
+    """单个阶段的耗时记录"""
+
+    __slots__ = ("name", "span_id", "parent_id", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, name: str, parent_id: Optional[str], start_ns: int, attributes: Dict[str, Any]):
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.start_ns = start_ns
+        self.end_ns = start_ns
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+
+class Trace:
+    """一个请求从提交到返回的完整追踪"""
+
+    def __init__(self, tracer: "Tracer", name: str, sampled: bool, attributes: Dict[str, Any]):
+        self.tracer = tracer
+        self.trace_id = secrets.token_hex(16)
+        self.sampled = sampled
+        self.spans: List[Span] = []
+        self.finished = False
+        self.root = self._new_span(name, None, time.time_ns(), attributes)
+
+    def _new_span(self, name: str, parent_id: Optional[str], start_ns: int, attributes: Dict[str, Any]) -> Span:
+        span = Span(name, parent_id, start_ns, attributes)
+        if self.sampled:
+            self.spans.append(span)
+        return span
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """记录一个阶段，嵌套调用时自动挂到当前 span 下"""
+        if not self.sampled:
+            yield None
+            return
+
+        parent_id = _current_span_id.get() or self.root.span_id
+        span = self._new_span(name, parent_id, time.time_ns(), attributes)
+        token = _current_span_id.set(span.span_id)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.end_ns = time.time_ns()
+            _current_span_id.reset(token)
+
+    def record(self, name: str, start: float, end: float, **attributes):
+        """补记一个已经结束的阶段（例如排队等待），时间为 time.time() 秒"""
+        if not self.sampled:
+            return
+        span = self._new_span(name, self.root.span_id, int(start * 1e9), attributes)
+        span.end_ns = int(end * 1e9)
+
+    def set_attribute(self, key: str, value: Any):
+        self.root.attributes[key] = value
+
+    def finish(self, error: Optional[str] = None):
+        """结束整个 trace 并导出，重复调用无效"""
+        if self.finished:
+            return
+        self.finished = True
+        self.root.end_ns = time.time_ns()
+        if error:
+            self.root.error = error
+        if self.sampled:
+            self.tracer.export(self)
+
+
+class Tracer:
+    """负责头部采样和导出"""
+
+    def __init__(self, sample_rate: float = 0.0, export_format: str = "jsonl", path: Optional[Path] = None):
+        if export_format not in ("jsonl", "otlp"):
+            raise ValueError(f"Unsupported trace format: {export_format}")
+        self.sample_rate = sample_rate
+        self.export_format = export_format
+        self.path = path or Path("results") / "traces.jsonl"
+        self._lock = threading.Lock()
+        self._file = None
+
+    @classmethod
+    def from_env(cls) -> "Tracer":
+        return cls(
+            sample_rate=float(os.environ.get("TRACE_SAMPLE_RATE", "0")),
+            export_format=os.environ.get("TRACE_FORMAT", "jsonl"),
+            path=Path(os.environ["TRACE_FILE"]) if "TRACE_FILE" in os.environ else None,
+        )
+
+    def start_trace(self, name: str, **attributes) -> Trace:
+        # 头部采样：在请求入口一次性决定是否记录，之后的 span 都跟随这个决定
+        sampled = self.sample_rate > 0 and (self.sample_rate >= 1 or random.random() < self.sample_rate)
+        return Trace(self, name, sampled, attributes)
+
+    def export(self, trace: Trace):
+        if self.export_format == "otlp":
+            record = self._to_otlp(trace)
+        else:
+            record = self._to_jsonl(trace)
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            if self._file is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._file = self.path.open("a", encoding="utf-8", buffering=1)
+            self._file.write(line)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    @staticmethod
+    def _to_jsonl(trace: Trace) -> Dict[str, Any]:
+        return {
+            "trace_id": trace.trace_id,
+            "name": trace.root.name,
+            "duration_ms": (trace.root.end_ns - trace.root.start_ns) / 1e6,
+            "spans": [
+                {
+                    "span_id": s.span_id,
+                    "parent_id": s.parent_id,
+                    "name": s.name,
+                    "start_ns": s.start_ns,
+                    "duration_ms": (s.end_ns - s.start_ns) / 1e6,
+                    "attributes": s.attributes,
+                    "error": s.error,
+                }
+                for s in trace.spans
+            ],
+        }
+
+    @staticmethod
+    def _to_otlp(trace: Trace) -> Dict[str, Any]:
+        """OTLP/JSON 格式，每行一个 ExportTraceServiceRequest，可直接交给 OTel Collector 的 file receiver"""
+
+        def attrs(d: Dict[str, Any]) -> List[Dict[str, Any]]:
+            out = []
+            for k, v in d.items():
+                if isinstance(v, bool):
+                    value = {"boolValue": v}
+                elif isinstance(v, int):
+                    value = {"intValue": str(v)}
+                elif isinstance(v, float):
+                    value = {"doubleValue": v}
+                else:
+                    value = {"stringValue": str(v)}
+                out.append({"key": k, "value": value})
+            return out
+
+        spans = []
+        for s in trace.spans:
+            span = {
+                "traceId": trace.trace_id,
+                "spanId": s.span_id,
+                "name": s.name,
+                "kind": 2 if s.parent_id is None else 1,
+                "startTimeUnixNano": str(s.start_ns),
+                "endTimeUnixNano": str(s.end_ns),
+                "attributes": attrs(s.attributes),
+                "status": {"code": 2, "message": s.error} if s.error else {"code": 1},
+            }
+            if s.parent_id:
+                span["parentSpanId"] = s.parent_id
+            spans.append(span)
+
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": attrs({"service.name": SERVICE_NAME})},
+                "scopeSpans": [{"scope": {"name": SERVICE_NAME}, "spans": spans}],
+            }]
+        }
+
+
+def use_trace(trace: Optional[Trace]) -> contextvars.Token:
+    """把 trace 设为当前上下文的 trace，返回用于 reset 的 token"""
+    return _current_trace.set(trace)
+
+
+def reset_trace(token: contextvars.Token):
+    _current_trace.reset(token)
+
+
+def span(name: str, **attributes):
+    """在当前 trace 下记录一个阶段；没有 trace 或未采样时什么都不做"""
+    trace = _current_trace.get()
+    if trace is None or not trace.sampled:
+        return nullcontext()
+    return trace.span(name, **attributes)
@@ -0,0 +1,105 @@
+"""
+流量捕获：把每个到达的生成请求（到达时间 + 参数）追加到滚动的 JSONL 文件，供 replay_traffic.py 回放
+
+配置（环境变量）:
+    CAPTURE_FILE        捕获文件路径，未设置时不捕获
+    CAPTURE_MAX_BYTES   单个文件的最大字节数，超过后滚动，默认 50MB
+    CAPTURE_BACKUPS     保留的历史文件数量，默认 5
+
+请求路径上只做一次 list.append，序列化和写盘由后台任务批量完成。
+"""
+
+import asyncio
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+
+class CaptureLog:
+    """滚动的 JSONL 请求捕获日志"""
+
+    def __init__(self, path: Optional[Path], max_bytes: int = 50 * 1024 * 1024, backups: int = 5,
+                 flush_interval: float = 1.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self._pending: List[Dict[str, Any]] = []
+
+    @classmethod
+    def from_env(cls) -> "CaptureLog":
+        path = os.environ.get("CAPTURE_FILE")
+        return cls(
+            path=Path(path) if path else None,
+            max_bytes=int(os.environ.get("CAPTURE_MAX_BYTES", 50 * 1024 * 1024)),
+            backups=int(os.environ.get("CAPTURE_BACKUPS", 5)),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def record(self, endpoint: str, params: Dict[str, Any]):
+        """记录一个到达的请求（在请求路径上调用，不做 I/O）"""
+        if self.path is None:
+            return
+        self._pending.append({"ts": time.time(), "endpoint": endpoint, "params": params})
+
+    async def run(self):
+        """后台任务：定期把缓冲的记录写入文件"""
+        if self.path is None:
+            return
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+        finally:
+            self._write(self._take())
+
+    async def flush(self):
+        batch = self._take()
+        if batch:
+            await asyncio.to_thread(self._write, batch)
+
+    def _take(self) -> List[Dict[str, Any]]:
+        batch, self._pending = self._pending, []
+        return batch
+
+    def _write(self, batch: List[Dict[str, Any]]):
+        if not batch:
+            return
+        data = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in batch).encode("utf-8")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if self.path.exists() and self.path.stat().st_size + len(data) > self.max_bytes:
+            self._rotate()
+        with self.path.open("ab") as f:
+            f.write(data)
+
+    def _rotate(self):
+        # capture.jsonl -> capture.jsonl.1 -> capture.jsonl.2 ...，超出 backups 的最旧文件被删除
+        for i in range(self.backups, 0, -1):
+            src = self.path.with_name(f"{self.path.name}.{i - 1}") if i > 1 else self.path
+            dst = self.path.with_name(f"{self.path.name}.{i}")
+            if src.exists():
+                os.replace(src, dst)
+        if self.backups == 0:
+            self.path.unlink(missing_ok=True)
+
+
+def load_capture(path: Path) -> List[Dict[str, Any]]:
+    """读取捕获文件（包括滚动出去的历史文件），按到达时间排序"""
+    rotated = [p for p in path.parent.glob(f"{path.name}.*") if p.suffix[1:].isdigit()]
+    files = sorted(rotated, key=lambda p: int(p.suffix[1:]), reverse=True) + [path]
+    records = []
+    for f in files:
+        if not f.exists():
+            continue
+        with f.open("r", encoding="utf-8") as fh:
+            for line in fh:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+    records.sort(key=lambda r: r["ts"])
+    return records
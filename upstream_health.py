@@ -0,0 +1,95 @@
+"""
+上游健康状态（熔断器）：错误率过高或没有可用出口时进入降级模式，冷却后自动试探恢复
+
+状态:
+    closed      正常处理
+    open        降级：有缓存的确定性请求直接返回缓存，其余请求立即以 503 拒绝
+    half_open   冷却结束，放行请求试探上游，成功一次即恢复，失败则重新降级
+
+配置（环境变量）:
+    DEGRADED_ERROR_RATE     触发降级的错误率，默认 0.5
+    DEGRADED_MIN_SAMPLES    计算错误率所需的最少样本数，默认 4
+    DEGRADED_WINDOW         参与计算的最近请求数，默认 20
+    DEGRADED_COOLDOWN       降级后多久开始试探恢复（秒），默认 30
+"""
+
+import os
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Optional
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class UpstreamBreaker:
+    """根据最近的请求结果和出口健康检查决定是否进入降级模式"""
+
+    def __init__(self, egress_available: Callable[[], bool], error_rate: float = 0.5, min_samples: int = 4,
+                 window: int = 20, cooldown: float = 30.0):
+        self.egress_available = egress_available
+        self.error_rate = error_rate
+        self.min_samples = min_samples
+        self.cooldown = cooldown
+        self.outcomes = deque(maxlen=window)
+        self.state = CLOSED
+        self.opened_at: Optional[float] = None
+        self.reason: Optional[str] = None
+
+    @classmethod
+    def from_env(cls, egress_available: Callable[[], bool]) -> "UpstreamBreaker":
+        return cls(
+            egress_available,
+            error_rate=float(os.environ.get("DEGRADED_ERROR_RATE", 0.5)),
+            min_samples=int(os.environ.get("DEGRADED_MIN_SAMPLES", 4)),
+            window=int(os.environ.get("DEGRADED_WINDOW", 20)),
+            cooldown=float(os.environ.get("DEGRADED_COOLDOWN", 30)),
+        )
+
+    @property
+    def degraded(self) -> bool:
+        """是否处于降级模式（读取时顺便完成 open -> half_open 的转换）"""
+        if self.state == CLOSED and not self.egress_available():
+            self._trip("no healthy egress")
+        elif self.state == OPEN and time.time() - self.opened_at >= self.cooldown and self.egress_available():
+            self.state = HALF_OPEN
+            print("Upstream breaker half-open, probing NovelAI")
+        return self.state == OPEN
+
+    def retry_after(self) -> int:
+        if self.opened_at is None:
+            return 0
+        return max(1, int(self.cooldown - (time.time() - self.opened_at)))
+
+    def record_success(self):
+        self.outcomes.append(True)
+        if self.state != CLOSED:
+            print("Upstream recovered, leaving degraded mode")
+            self.state = CLOSED
+            self.opened_at = None
+            self.reason = None
+            self.outcomes.clear()
+
+    def record_failure(self, error: str):
+        self.outcomes.append(False)
+        if self.state == HALF_OPEN:
+            self._trip(f"probe failed: {error}")
+            return
+        if self.state == CLOSED and len(self.outcomes) >= self.min_samples:
+            failures = self.outcomes.count(False)
+            if failures / len(self.outcomes) >= self.error_rate:
+                self._trip(f"error rate {failures}/{len(self.outcomes)}, last error: {error}")
+
+    def _trip(self, reason: str):
+        self.state = OPEN
+        self.opened_at = time.time()
+        self.reason = reason
+        print(f"Upstream degraded: {reason}")
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "reason": self.reason,
+            "retry_after": self.retry_after() if self.state == OPEN else None,
+        }
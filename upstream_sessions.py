@@ -0,0 +1,195 @@
+"""
+上游会话池：每个账号保持一个已登录的 NovelAI 会话，由保温任务在空闲期间刷新令牌、保持连接
+
+以前每个任务都新建 ClientSession 并重新登录，空闲一段时间后的第一个请求要先经过 DNS 解析、
+经代理的 TLS 握手和登录才能开始生成。现在会话在任务之间复用，连接留在连接池中；
+保温任务（运行时配置 keep_warm_interval，默认 30 秒，0 表示关闭）在启动时和之后每隔一段时间：
+
+- 为每个账号登录，访问令牌在过期前 TOKEN_REFRESH_MARGIN 秒（默认 600）重新登录。
+  过期时间取自令牌（JWT）的 exp，取不到时按登录后 TOKEN_MAX_AGE 秒（默认 86400）计算
+- 向每个 NovelAI 主机并发发出 KEEP_WARM_CONNECTIONS 个（默认 1）HEAD 请求，
+  连接池中至少保留这么多条已完成握手的连接。空闲连接保留 UPSTREAM_KEEPALIVE 秒（默认 120），
+  应大于 keep_warm_interval
+
+保温只做登录和 HEAD 请求，不从账号池取账号，不占用账号的生成名额；正在生成的账号不需要保温，跳过 HEAD 请求。
+"""
+
+import asyncio
+import base64
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from aiohttp import ClientTimeout
+
+import tracing
+import upstream_stream
+
+# 生成请求发往 image.novelai.net，登录和放大发往 api.novelai.net
+WARM_URLS = ("https://api.novelai.net/", "https://image.novelai.net/")
+WARM_TIMEOUT = ClientTimeout(total=10)
+
+
+def token_expiry(token: str) -> Optional[float]:
+    """读出 JWT 访问令牌的过期时间（Unix 时间），不是 JWT 或没有 exp 时返回 None"""
+    parts = token.split(".")
+    if len(parts) != 3:
+        return None
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(parts[1] + "=" * (-len(parts[1]) % 4)))
+        return float(payload["exp"])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+class UpstreamSession:
+    """一个账号的已登录会话（boilerplate.API），令牌过期前由保温任务或下一个任务重新登录"""
+
+    __slots__ = ("name", "handler", "expires_at", "logged_in_at", "logins", "warmed_at", "last_error", "_lock")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.handler = None
+        self.expires_at = 0.0
+        self.logged_in_at: Optional[float] = None
+        self.logins = 0
+        self.warmed_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self._lock = asyncio.Lock()
+
+    def status(self) -> Dict[str, Any]:
+        now = time.time()
+        return {
+            "account": self.name,
+            "connected": self.handler is not None,
+            "token_expires_in": round(self.expires_at - now) if self.handler is not None else None,
+            "logins": self.logins,
+            "logged_in_at": self.logged_in_at,
+            "warmed_at": self.warmed_at,
+            "last_error": self.last_error,
+        }
+
+
+class SessionPool:
+    def __init__(self, tmp_dir: Path, interval: float = 30, refresh_margin: float = 600, max_token_age: float = 86400,
+                 connections: int = 1, keepalive_timeout: float = 120):
+        self.tmp_dir = tmp_dir
+        self.interval = interval
+        self.refresh_margin = refresh_margin
+        self.max_token_age = max_token_age
+        self.connections = connections
+        self.keepalive_timeout = keepalive_timeout
+        self.sessions: Dict[str, UpstreamSession] = {}
+        self._changed = asyncio.Event()
+
+    @classmethod
+    def from_env(cls, tmp_dir: Path, interval: float) -> "SessionPool":
+        return cls(
+            tmp_dir,
+            interval=interval,
+            refresh_margin=float(os.environ.get("TOKEN_REFRESH_MARGIN", 600)),
+            max_token_age=float(os.environ.get("TOKEN_MAX_AGE", 86400)),
+            connections=int(os.environ.get("KEEP_WARM_CONNECTIONS", 1)),
+            keepalive_timeout=float(os.environ.get("UPSTREAM_KEEPALIVE", 120)),
+        )
+
+    def _session(self, account) -> UpstreamSession:
+        # 没有配置账号时由 API() 自己报告缺少凭据
+        name = account.name if account is not None else "default"
+        session = self.sessions.get(name)
+        if session is None:
+            session = self.sessions[name] = UpstreamSession(name)
+        return session
+
+    async def _login(self, session: UpstreamSession, account):
+        from boilerplate import API
+
+        if session.handler is None:
+            handler = API(username=account.username, password=account.password,
+                          keepalive_timeout=self.keepalive_timeout) if account else API()
+            # 进入上下文时创建会话并登录，登录失败时会话已关闭
+            await handler.__aenter__()
+            # 响应按块写入磁盘，不在内存中保存整张图像
+            upstream_stream.install(handler.api.low_level, self.tmp_dir)
+            session.handler = handler
+        else:
+            await session.handler.login()
+
+        now = time.time()
+        session.logged_in_at = now
+        session.expires_at = token_expiry(session.handler.access_token) or now + self.max_token_age
+        session.logins += 1
+        session.last_error = None
+
+    async def get(self, account, margin: Optional[float] = None):
+        """返回这个账号已登录的 NovelAIAPI，没有登录或令牌在 margin 秒内过期时先登录"""
+        session = self._session(account)
+        margin = self.refresh_margin if margin is None else margin
+        async with session._lock:
+            if session.handler is None or time.time() >= session.expires_at - margin:
+                try:
+                    await self._login(session, account)
+                except Exception as e:
+                    session.last_error = f"{type(e).__name__}: {e}"
+                    raise
+        return session.handler.api
+
+    def invalidate(self, account, error: BaseException):
+        """上游返回 401 时令牌已经失效（例如在别处修改了密码），下一次使用前重新登录"""
+        if getattr(error, "status", None) == 401:
+            session = self.sessions.get(account.name if account is not None else "default")
+            if session is not None:
+                session.expires_at = 0.0
+
+    async def _head(self, session: UpstreamSession, url: str):
+        async with session.handler.session.head(url, allow_redirects=False, timeout=WARM_TIMEOUT):
+            pass
+
+    async def warm(self, account):
+        """刷新快过期的令牌，并让连接池中保留热连接；不占用账号的生成名额"""
+        session = self._session(account)
+        try:
+            with tracing.span("upstream.keep_warm", account=session.name):
+                # 令牌在下一次保温之前就会进入刷新窗口时现在刷新，不让任务承担登录耗时
+                await self.get(account, self.refresh_margin + self.interval)
+                if account.busy:
+                    return
+                await asyncio.gather(*(self._head(session, url) for url in WARM_URLS for _ in range(self.connections)))
+            session.warmed_at = time.time()
+        except Exception as e:
+            session.last_error = f"{type(e).__name__}: {e}"
+            print(f"Keep-warm failed for account {session.name}: {e}")
+
+    def set_interval(self, interval: float):
+        self.interval = interval
+        self._changed.set()
+
+    async def run(self, accounts: List):
+        """后台任务：启动时先为每个账号登录，之后按 interval 保温；interval 为 0 时暂停"""
+        while True:
+            if self.interval > 0:
+                await asyncio.gather(*(self.warm(account) for account in accounts))
+            # 配置修改后立即按新的间隔重新计时
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=self.interval or None)
+            except asyncio.TimeoutError:
+                pass
+            self._changed.clear()
+
+    async def close(self):
+        for session in self.sessions.values():
+            if session.handler is not None:
+                handler, session.handler = session.handler, None
+                try:
+                    await handler.__aexit__(None, None, None)
+                except Exception as e:
+                    print(f"Failed to close upstream session for account {session.name}: {e}")
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "keep_warm_interval": self.interval,
+            "connections": self.connections,
+            "sessions": [session.status() for session in self.sessions.values()],
+        }
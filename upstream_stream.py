@@ -0,0 +1,100 @@
+"""
+把上游返回的图像直接写入磁盘，不在内存中保存整个响应
+
+novelai_api 的 LowLevel._parse_response 会先 `await rsp.read()` 把整个 ZIP 读进内存，
+再解压出每张图像的 bytes；一张高分辨率 PNG 在同一时刻会有压缩包、解压结果和响应副本三份。
+这里替换某个 LowLevel 实例的 _parse_response：ZIP 响应按块写入临时文件，
+再在线程中逐个解压成临时 PNG 文件，产出 (文件名, Path)，内存占用与图像大小无关。
+"""
+
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+from typing import AsyncIterator, List, Tuple
+
+CHUNK_SIZE = 64 * 1024
+# novelai_api 按压缩包处理的 Content-Type
+ZIP_CONTENT_TYPES = ("application/x-zip-compressed", "binary/octet-stream")
+
+
+def temp_file(directory: Path, suffix: str) -> Path:
+    directory.mkdir(parents=True, exist_ok=True)
+    fd, name = tempfile.mkstemp(suffix=suffix, dir=directory)
+    os.close(fd)
+    return Path(name)
+
+
+def clear_stale(directory: Path, max_age: float) -> int:
+    """删除超过 max_age 秒的临时文件（进程崩溃留下的）
+
+    排空交接时新旧进程共用这个目录，不能在启动时清空，只按修改时间清理。
+    """
+    if not directory.exists():
+        return 0
+    removed = 0
+    cutoff = time.time() - max_age
+    for path in directory.iterdir():
+        try:
+            if path.is_file() and path.stat().st_mtime < cutoff:
+                path.unlink()
+                removed += 1
+        except FileNotFoundError:
+            continue
+    return removed
+
+
+def _extract(archive: Path, directory: Path) -> List[Tuple[str, Path]]:
+    files: List[Tuple[str, Path]] = []
+    try:
+        with zipfile.ZipFile(archive) as z:
+            for name in z.namelist():
+                target = temp_file(directory, ".png")
+                files.append((name, target))
+                with z.open(name) as src, target.open("wb") as dst:
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    except BaseException:
+        for _, path in files:
+            path.unlink(missing_ok=True)
+        raise
+    return files
+
+
+async def stream_zip(rsp, directory: Path) -> AsyncIterator[Tuple[str, Path]]:
+    """把 ZIP 响应按块写入磁盘并解压，产出 (文件名, 临时文件路径)；没有被取走的文件会被删除"""
+    archive = temp_file(directory, ".zip")
+    files: List[Tuple[str, Path]] = []
+    try:
+        with archive.open("wb") as f:
+            async for chunk in rsp.content.iter_chunked(CHUNK_SIZE):
+                f.write(chunk)
+        files = await asyncio.to_thread(_extract, archive, directory)
+    finally:
+        archive.unlink(missing_ok=True)
+
+    try:
+        while files:
+            # 先移出列表：产出之后文件归调用方所有
+            name, path = files.pop(0)
+            yield name, path
+    finally:
+        for _, path in files:
+            path.unlink(missing_ok=True)
+
+
+def install(low_level, directory: Path):
+    """让这个 LowLevel 实例把 ZIP 响应写入 directory，其他响应仍交给原实现"""
+    original = low_level._parse_response
+
+    async def parse_response(rsp):
+        if rsp.content_type in ZIP_CONTENT_TYPES:
+            async for item in stream_zip(rsp, directory):
+                yield item
+        else:
+            async for item in original(rsp):
+                yield item
+
+    low_level._parse_response = parse_response
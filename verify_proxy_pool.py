@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+验证代理池行为脚本 - 用本地代理替身确认出口选择、健康检查和故障切换
+
+不需要真实代理或 NovelAI 账号：脚本会在本机启动一个目标服务器和几个简单的 HTTP 转发代理
+（一个快、一个慢、一个不存在的地址），然后检查代理池是否按延迟选择出口、连接失败时是否自动切换。
+"""
+
+import asyncio
+import time
+
+from aiohttp import ClientSession, web
+
+from proxy_pool import ProxyPool
+
+
+class StandInProxy:
+    """最简单的 HTTP 转发代理（只支持绝对地址形式的明文请求）"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.hits = 0
+        self.server = None
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+            lines = head.decode("latin-1").split("\r\n")
+            method, url, _ = lines[0].split(" ", 2)
+            headers = dict(line.split(": ", 1) for line in lines[1:] if ": " in line)
+            length = int(headers.get("Content-Length", 0))
+            body = await reader.readexactly(length) if length else None
+
+            self.hits += 1
+            await asyncio.sleep(self.delay)
+            async with ClientSession() as session:
+                async with session.request(method, url, data=body) as resp:
+                    payload = await resp.read()
+                    status = resp.status
+            writer.write(f"HTTP/1.1 {status} OK\r\nContent-Length: {len(payload)}\r\n"
+                         f"Content-Type: text/plain\r\nConnection: close\r\n\r\n".encode() + payload)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def start(self) -> str:
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        port = self.server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+async def start_target() -> (web.AppRunner, str):
+    async def ok(request):
+        return web.Response(text="ok")
+
+    app = web.Application()
+    app.router.add_route("*", "/", ok)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://127.0.0.1:{port}/"
+
+
+async def send(pool: ProxyPool, url: str) -> str:
+    async with ClientSession() as session:
+        resp = await pool.request(session._request, "GET", url)
+        text = await resp.text()
+        resp.release()
+        return text
+
+
+async def verify_proxy_pool():
+    print("=== 验证代理池出口选择与故障切换 ===")
+    runner, target = await start_target()
+    fast, slow = StandInProxy(0.01), StandInProxy(0.3)
+    fast_url, slow_url = await fast.start(), await slow.start()
+    dead_url = "http://127.0.0.1:9"
+
+    pool = ProxyPool([slow_url, dead_url, fast_url], check_url=target, check_timeout=2)
+    ok = True
+    try:
+        # 1. 主动健康检查后，快的代理应排在最前，不可用的排在最后
+        await pool.check_all()
+        order = [e.proxy for e in pool.ordered()]
+        print("\n1. 健康检查后的出口顺序:")
+        for status in pool.status():
+            print(f"   {status['egress']}: healthy={status['healthy']} latency={status['latency_ms']}ms")
+        if order == [fast_url, slow_url, dead_url]:
+            print("✅ 出口按健康状态和延迟排序")
+        else:
+            print("❌ 出口顺序不符合预期")
+            ok = False
+
+        # 2. 请求应走最快的代理
+        before = fast.hits
+        await send(pool, target)
+        if fast.hits == before + 1:
+            print("✅ 请求通过延迟最低的代理发出")
+        else:
+            print("❌ 请求没有走最快的代理")
+            ok = False
+
+        # 3. 关闭最快的代理，请求应自动切换到下一个出口且成功
+        await fast.stop()
+        before = slow.hits
+        start = time.perf_counter()
+        text = await send(pool, target)
+        elapsed = time.perf_counter() - start
+        if text == "ok" and slow.hits == before + 1 and not pool.egresses[2].healthy:
+            print(f"✅ 最快代理失效后自动切换到下一个出口（{elapsed:.2f}秒）")
+        else:
+            print("❌ 故障切换失败")
+            ok = False
+
+        # 4. 后续请求直接使用健康的出口
+        if pool.ordered()[0].proxy == slow_url:
+            print("✅ 失效的代理被移到队尾，后续任务不再先尝试它")
+        else:
+            print("❌ 失效的代理仍排在前面")
+            ok = False
+    finally:
+        await slow.stop()
+        await runner.cleanup()
+
+    print("\n结论:", "代理池行为符合预期" if ok else "存在问题，请检查上面的输出")
+
+
+if __name__ == "__main__":
+    asyncio.run(verify_proxy_pool())
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+验证流量回放脚本 - 捕获几个新的请求记录，再用 replay_traffic.py 回放，确认全部成功
+
+不需要 NovelAI 账号：脚本会启动 mock 后端和一个指向它的服务器实例（与 replay_traffic.py --launch 相同），
+捕获记录用服务器当前的参数模型生成，参数格式变化（例如新增的布尔字段）导致回放失败时会在这里发现。
+以图像为输入的请求引用的底图先上传到服务器，再和文生图请求一起回放。
+"""
+
+import asyncio
+import hashlib
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+
+from jobs import GenerationParams, Img2ImgParams, UpscaleParams
+from mock_novelai import make_png
+from replay_traffic import launch, replay, wait_ready
+from traffic_capture import CaptureLog, load_capture
+
+SERVER_PORT = 8110
+MOCK_PORT = 8111
+
+
+BASE_IMAGE = make_png(128, 192, {}, fill=3)
+BASE_IMAGE_ID = hashlib.sha256(BASE_IMAGE).hexdigest()
+
+
+async def capture_records(path: Path):
+    """按服务器记录请求的方式写入捕获文件"""
+    capture = CaptureLog(path)
+    capture.record("/generate/img/priv", GenerationParams(prompt="1girl", seed=1).model_dump())
+    capture.record("/generate/img/async", GenerationParams(prompt="1boy", seed=2, truncate=True).model_dump())
+    capture.record("/generate/img2img/priv", Img2ImgParams(prompt="1girl", seed=3, image=BASE_IMAGE_ID).model_dump())
+    capture.record("/generate/upscale/async", UpscaleParams(image=BASE_IMAGE_ID, scale=2).model_dump())
+    await capture.flush()
+
+
+async def upload_inputs(target: str):
+    async with aiohttp.ClientSession() as session:
+        async with session.put(f"{target}/inputs", data=BASE_IMAGE) as resp:
+            resp.raise_for_status()
+
+
+async def verify_replay():
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "capture.jsonl"
+        await capture_records(path)
+        records = load_capture(path)
+
+        processes = launch(SERVER_PORT, MOCK_PORT, latency=0.2, jitter=0)
+        try:
+            target = f"http://127.0.0.1:{SERVER_PORT}"
+            await wait_ready(target)
+            await upload_inputs(target)
+            start = time.time()
+            results = await replay(records, target, speed=0, poll_interval=0.1)
+            elapsed = time.time() - start
+        finally:
+            for p in processes:
+                p.terminate()
+                p.wait()
+
+    for result in results:
+        if result["status"] == 200:
+            print(f"✅ {result['endpoint']} 回放成功（{result['latency']:.2f}秒）")
+        else:
+            print(f"❌ {result['endpoint']} 回放失败: {result['status']}")
+            ok = False
+    if len(results) != len(records):
+        print(f"❌ 回放了 {len(results)} 个请求，捕获了 {len(records)} 个")
+        ok = False
+
+    print(f"\n结论（用时 {elapsed:.1f}秒）:", "回放行为符合预期" if ok else "存在问题，请检查上面的输出")
+
+
+if __name__ == "__main__":
+    asyncio.run(verify_replay())